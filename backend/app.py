@@ -1,21 +1,34 @@
 ﻿from __future__ import annotations
 import asyncio
 import base64
+import bisect
+import contextlib
+import contextvars
+import copy
+import functools
 import hashlib
+import heapq
 import html
+import inspect
+import ipaddress
 import json
 import logging
+import math
 import os
+import random
 import re
 import secrets
 import pickle
 import uuid
 import threading
 import time
-from datetime import datetime, timedelta, date
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone, date
 from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List, Optional, AsyncGenerator, Tuple, Literal, TYPE_CHECKING
+from typing import Any, Callable, Deque, Dict, List, Optional, AsyncGenerator, Tuple, Literal, TYPE_CHECKING
 from urllib.parse import unquote_plus, urlparse
 import io
 import zipfile
@@ -26,7 +39,7 @@ import requests
 from requests import exceptions as req_exc
 import jwt
 from fastapi import FastAPI, Request, HTTPException, status, Depends, UploadFile, File, Form 
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, ValidationError ,Field
@@ -44,11 +57,12 @@ AuthorizedSession = _AuthorizedSession
 from g4f import Provider
 from g4f.client import AsyncClient  # g4f async client (supports streaming)
 from googlesearch import search as google_search
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, ForeignKey, select, Date, or_, JSON, Index , Float
+from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, ForeignKey, select, Date, or_, and_, case, JSON, Index , Float, event, func, update, delete
 from sqlalchemy.dialects.mysql import insert as mysql_insert
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session as SyncSession, declarative_base, sessionmaker
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 try:
@@ -71,6 +85,10 @@ try:  # Ensure google backend is available for ddgs searches.
     DDGS_ENGINES.setdefault("text", {})["google"] = DDGS_Google
 except Exception:  # noqa: BLE001
     DDGS_Google = None  # type: ignore[assignment]
+try:  # Optional: vectorized geofence distances.
+    import numpy as np
+except Exception:  # noqa: BLE001
+    np = None  # type: ignore[assignment]
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("chat-sse")
 PUTER_API_KEY = os.getenv(
@@ -176,6 +194,336 @@ app.mount("/generated", StaticFiles(directory=GEMINI_OUTPUT_PATH), name="generat
 Base = declarative_base()
 engine = create_async_engine(DATABASE_URL, future=True, pool_pre_ping=True)
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# ═══════════════════════════════════════════════════════════════════
+# METRICS - Prometheus text exposition (بدون وابستگی خارجی)
+# ═══════════════════════════════════════════════════════════════════
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# بدون METRICS_TOKEN فقط اتصال مستقیم (نه از طریق proxy) از این شبکه‌ها پذیرفته می‌شود
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",")
+    if item.strip()
+]
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+_DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+_RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+_DEPTH_BUCKETS = (1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0)
+_DELAY_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+def _metric_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    parts = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+class _Counter:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: Any, amount: float = 1.0) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(v) for v in label_values)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_metric_labels(self.labels, key)} {value:g}")
+        return lines
+class _Histogram:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = _LATENCY_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.buckets = buckets
+        # per label set: [bucket counts..., +Inf count, sum]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(v) for v in label_values)
+        row = self.values.get(key)
+        if row is None:
+            row = [0.0] * (len(self.buckets) + 2)
+            self.values[key] = row
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, row in self.values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                labels = _metric_labels(self.labels + ("le",), key + (f"{bound:g}",))
+                lines.append(f"{self.name}_bucket{labels} {cumulative:g}")
+            cumulative += row[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_metric_labels(self.labels + ('le',), key + ('+Inf',))} {cumulative:g}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {row[-1]:g}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, key)} {cumulative:g}")
+        return lines
+_METRICS: List[Any] = []
+def _register_metric(metric: Any) -> Any:
+    _METRICS.append(metric)
+    return metric
+M_STREAM_TTFT = _register_metric(_Histogram(
+    "llm_stream_ttft_seconds", "Time to first token per provider attempt.", ("entry",)))
+M_STREAM_TOKENS_PER_SEC = _register_metric(_Histogram(
+    "llm_stream_tokens_per_second", "Streamed token chunks per second after the first token.", ("entry",), _RATE_BUCKETS))
+M_STREAM_ATTEMPTS = _register_metric(_Counter(
+    "llm_stream_attempts_total", "Streaming provider attempts by outcome.", ("entry", "outcome")))
+M_FALLBACK_DEPTH = _register_metric(_Histogram(
+    "llm_fallback_depth", "Position in FALLBACK_CHAIN of the provider that served the reply.", ("kind",), _DEPTH_BUCKETS))
+M_FALLBACK_EVENTS = _register_metric(_Counter(
+    "llm_fallback_events_total", "Hedges, continuations and exhausted chains in _fallback_stream.", ("event",)))
+M_COMPLETION_SECONDS = _register_metric(_Histogram(
+    "llm_completion_seconds", "Non-streaming completion latency per provider attempt.", ("entry", "outcome")))
+M_WEB_SEARCH_SECONDS = _register_metric(_Histogram(
+    "web_search_seconds", "Google search + page fetch latency.", ("outcome",)))
+M_IMAGE_SECONDS = _register_metric(_Histogram(
+    "image_generation_seconds", "Image generation latency per backend.", ("backend", "outcome")))
+M_DB_QUERY_SECONDS = _register_metric(_Histogram(
+    "db_query_seconds", "Database statement execution time.", ("statement",), _DB_BUCKETS))
+M_DB_ERRORS = _register_metric(_Counter(
+    "db_query_errors_total", "Database statements that raised.", ("statement",)))
+M_NOTIF_LOCAL_DECISIONS = _register_metric(_Counter(
+    "notification_local_decisions_total", "Notifications answered locally vs escalated to the LLM.", ("endpoint", "decision")))
+M_NOTIF_LOCAL_AUDIT = _register_metric(_Counter(
+    "notification_local_audit_total", "Local predictions compared against the LLM label.", ("kind", "band", "outcome")))
+M_TASK_REMINDERS = _register_metric(_Counter(
+    "task_reminders_total", "Task reminder deliveries by outcome.", ("outcome",)))
+M_TASK_REMINDER_DELAY = _register_metric(_Histogram(
+    "task_reminder_delay_seconds", "Delay between a reminder's scheduled time and its delivery.", (), _DELAY_BUCKETS))
+M_GEOFENCE_PINGS = _register_metric(_Counter(
+    "geofence_pings_total", "Location pings by outcome (evaluated, ignored, duplicate: transition already stored by another worker).", ("outcome",)))
+M_GEOFENCE_TRANSITIONS = _register_metric(_Counter(
+    "geofence_transitions_total", "Debounced geofence transitions written as check-ins.", ("action",)))
+M_PREGEN_JOBS = _register_metric(_Counter(
+    "pregen_jobs_total", "Nightly program/briefing pre-generation jobs by outcome.", ("outcome",)))
+M_PREGEN_BRIEFINGS = _register_metric(_Counter(
+    "pregen_briefings_total", "Daily briefings served from pre-generation (hit) or generated on demand (miss).", ("outcome",)))
+M_USER_CONTEXT = _register_metric(_Counter(
+    "user_context_snapshots_total", "User context snapshot reads served from cache (hit) or rebuilt (miss).", ("outcome",)))
+M_SINGLE_FLIGHT = _register_metric(_Counter(
+    "single_flight_calls_total", "Coalesced calls: leaders ran the work, followers joined an identical in-flight call, retries re-ran after the leader was saturated.", ("name", "role")))
+def _timed_async(histogram: _Histogram):
+    """Decorator: observe an async function's duration with an ok/error outcome label."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - started, outcome)
+        return wrapper
+    return decorator
+def _statement_kind(statement: str) -> str:
+    head = statement.lstrip()[:6].upper()
+    for kind in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        if head.startswith(kind):
+            return kind.lower()
+    return "other"
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _db_before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_query_started", []).append(time.perf_counter())
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _db_after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("_query_started")
+    if started:
+        M_DB_QUERY_SECONDS.observe(time.perf_counter() - started.pop(), _statement_kind(statement))
+@event.listens_for(engine.sync_engine, "handle_error")
+def _db_handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("_query_started"):
+        conn.info["_query_started"].pop()
+    M_DB_ERRORS.inc(_statement_kind(exception_context.statement or ""))
+def _render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+# ═══════════════════════════════════════════════════════════════════
+# SINGLE-FLIGHT - concurrent identical LLM/search calls share one execution
+# ═══════════════════════════════════════════════════════════════════
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+
+def _single_flight_normalize(value: Any) -> Any:
+    # فقط فاصلهٔ ابتدا/انتها نادیده گرفته می‌شود؛ فاصله‌های داخل متن ممکن است معنادار باشند
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, BaseModel):
+        value = value.dict()
+    if isinstance(value, dict):
+        return {str(key): _single_flight_normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_single_flight_normalize(item) for item in value]
+    return value
+
+
+class _SingleFlight:
+    """
+    In-flight calls by key. The first caller starts the work as its own task; identical
+    callers arriving before it finishes await the same task. Nothing is cached after
+    completion. A caller that goes away (client disconnect, timeout) does not cancel the
+    work for the others; the work is cancelled only when no caller is left.
+    The work runs in the leader's context, so LLM admission is charged to the leader's key;
+    when that fails with LLMSaturatedError, followers try again under their own key.
+    """
+    def __init__(self) -> None:
+        self._calls: Dict[str, List[Any]] = {}  # key -> [task, waiters]
+
+    def _forget(self, key: str, entry: List[Any]) -> None:
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+    async def run(self, name: str, key: str, factory: Callable[[], Any]) -> Any:
+        while True:
+            entry = self._calls.get(key)
+            if entry is not None and entry[0].done():
+                self._forget(key, entry)
+                entry = None
+            leader = entry is None
+            if leader:
+                task = asyncio.ensure_future(factory())
+                entry = [task, 0]
+                self._calls[key] = entry
+                task.add_done_callback(lambda _task, entry=entry: self._forget(key, entry))
+            M_SINGLE_FLIGHT.inc(name, "leader" if leader else "follower")
+            task = entry[0]
+            entry[1] += 1
+            try:
+                result = await asyncio.shield(task)
+            except LLMSaturatedError:
+                if leader:
+                    raise
+                # سهمیهٔ leader پر بود نه لزوماً سهمیهٔ این کاربر؛ دوباره با کلید خودش
+                M_SINGLE_FLIGHT.inc(name, "retry")
+                continue
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0 and not task.done():
+                    # کسی منتظر نیست؛ درخواست بعدی باید کار تازه‌ای شروع کند نه به task لغوشده بپیوندد
+                    self._forget(key, entry)
+                    task.cancel()
+            # followerها کپی می‌گیرند تا تغییر نتیجه در یک درخواست به بقیه نرسد
+            return result if leader else copy.deepcopy(result)
+
+
+_SINGLE_FLIGHT = _SingleFlight()
+
+
+def _single_flight(name: str):
+    """Decorator: coalesce concurrent calls whose normalized arguments are identical."""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not SINGLE_FLIGHT_ENABLED:
+                return await func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            raw = json.dumps(
+                [name, _single_flight_normalize(bound.arguments)],
+                ensure_ascii=False, sort_keys=True, default=str,
+            )
+            key = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+            return await _SINGLE_FLIGHT.run(name, key, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
+# ═══════════════════════════════════════════════════════════════════
+# REQUEST TRACING - request id + per-stage spans
+# ═══════════════════════════════════════════════════════════════════
+TRACE_LOG_ENABLED = os.getenv("TRACE_LOG_ENABLED", "1") == "1"
+trace_log = logging.getLogger("chat-sse.trace")
+class _RequestTrace:
+    """Spans for one request, measured relative to the request start (ms)."""
+    def __init__(self, request_id: str, method: str = "", path: str = ""):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        # برای پاسخ‌های SSE لاگ نهایی را event_gen می‌نویسد نه middleware
+        self.deferred = False
+        self.logged = False
+
+    def _ms(self, at: float) -> float:
+        return round((at - self.started) * 1000, 1)
+
+    def add_span(self, name: str, start: float, end: float, **attrs: Any) -> None:
+        span: Dict[str, Any] = {"name": name, "start_ms": self._ms(start), "duration_ms": round((end - start) * 1000, 1)}
+        if attrs:
+            span.update(attrs)
+        self.spans.append(span)
+
+    def mark(self, name: str, **attrs: Any) -> None:
+        now = time.perf_counter()
+        self.add_span(name, now, now, **attrs)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs: Any):
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as exc:
+            attrs.setdefault("error", type(exc).__name__)
+            raise
+        finally:
+            self.add_span(name, start, time.perf_counter(), **attrs)
+
+    def to_payload(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "total_ms": self._ms(time.perf_counter()),
+            "spans": list(self.spans),
+        }
+
+    def log(self, **extra: Any) -> None:
+        if self.logged or not TRACE_LOG_ENABLED:
+            return
+        self.logged = True
+        record = {"event": "request_trace", "method": self.method, "path": self.path}
+        record.update(self.to_payload())
+        record.update(extra)
+        trace_log.info(json.dumps(record, ensure_ascii=False, default=str))
+_CURRENT_TRACE: contextvars.ContextVar[Optional[_RequestTrace]] = contextvars.ContextVar("request_trace", default=None)
+def _trace_span(name: str, **attrs: Any):
+    """Span on the current request trace; no-op outside a traced request."""
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return contextlib.nullcontext(attrs)
+    return trace.span(name, **attrs)
+# پشت reverse proxy همهٔ درخواست‌ها IP پروکسی را دارند؛ فقط وقتی پروکسی مطمئن است X-Forwarded-For خوانده شود
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+def _client_ip(request: Request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for", "")
+        if forwarded.strip():
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+@app.middleware("http")
+async def _request_trace_middleware(request: Request, call_next):
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    trace = _RequestTrace(request_id[:64], request.method, request.url.path)
+    request.state.request_id = trace.request_id
+    request.state.trace = trace
+    _CURRENT_TRACE.set(trace)
+    # سهمیهٔ LLM درخواست‌های بدون احراز هویت به IP کلاینت نوشته می‌شود؛ get_current_user آن را با کاربر عوض می‌کند
+    _CURRENT_USER_KEY.set(f"ip:{_client_ip(request)}")
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = trace.request_id
+    if not trace.deferred and trace.spans:
+        trace.log(status=response.status_code)
+    return response
 bearer_scheme = HTTPBearer(auto_error=False)
 # فقط برای استفاده داخلی سرویس؛ کاربر به آن دسترسی ندارد:
 # می‌توانید این ترتیب را بعداً با health-check پویا کنید.
@@ -196,6 +544,29 @@ FALLBACK_CHAIN = [
 PER_ATTEMPT_TIMEOUT = 15.0  # ثانیه
 STREAM_INIT_TIMEOUT = 30.0  # ثانیه - timeout برای شروع stream
 STREAM_PING_EVERY = 15.0    # ثانیه (برای زنده نگه‌داشتن اتصال SSE)
+# مسابقهٔ speculative بین providerها: اگر provider فعلی در مدت آستانه هیچ توکنی نداد،
+# provider بعدی هم‌زمان شروع می‌شود و هر کدام زودتر توکن داد برنده است.
+STREAM_HEDGE_ENABLED = os.getenv("STREAM_HEDGE_ENABLED", "1") == "1"
+STREAM_HEDGE_MAX_LANES = int(os.getenv("STREAM_HEDGE_MAX_LANES", "2"))
+STREAM_HEDGE_DEFAULT_DELAY = float(os.getenv("STREAM_HEDGE_DEFAULT_DELAY", "4.0"))
+STREAM_HEDGE_MIN_DELAY = float(os.getenv("STREAM_HEDGE_MIN_DELAY", "1.5"))
+STREAM_HEDGE_MAX_DELAY = float(os.getenv("STREAM_HEDGE_MAX_DELAY", "8.0"))
+STREAM_HEDGE_TTFT_SAMPLES = int(os.getenv("STREAM_HEDGE_TTFT_SAMPLES", "50"))
+# اگر provider وسط پاسخ قطع شد، متن ارسال‌شده به provider بعدی داده می‌شود تا فقط ادامه را بنویسد.
+STREAM_CONTINUATION_ENABLED = os.getenv("STREAM_CONTINUATION_ENABLED", "1") == "1"
+STREAM_CONTINUATION_OVERLAP_WINDOW = int(os.getenv("STREAM_CONTINUATION_OVERLAP_WINDOW", "80"))
+STREAM_CONTINUATION_PROMPT = (
+    "پاسخ قبلی‌ات وسط کار قطع شد. دقیقاً از همان نقطه‌ای که متن بالا تمام شده ادامه بده؛ "
+    "هیچ بخشی از آن را تکرار نکن و مقدمه یا توضیح اضافه ننویس."
+)
+# کنترل هم‌زمانی فراخوانی‌های LLM (per-user و per-provider)
+LLM_MAX_STREAMS_PER_USER = int(os.getenv("LLM_MAX_STREAMS_PER_USER", "3"))
+LLM_MAX_COMPLETIONS_PER_USER = int(os.getenv("LLM_MAX_COMPLETIONS_PER_USER", "4"))
+LLM_GLOBAL_CONCURRENCY = int(os.getenv("LLM_GLOBAL_CONCURRENCY", "64"))
+LLM_PROVIDER_CONCURRENCY = int(os.getenv("LLM_PROVIDER_CONCURRENCY", "16"))
+LLM_ADMISSION_MAX_WAIT = float(os.getenv("LLM_ADMISSION_MAX_WAIT", "2.0"))
+LLM_ADMISSION_RETRY_AFTER = float(os.getenv("LLM_ADMISSION_RETRY_AFTER", "5"))
+LLM_ADMISSION_TICKET_TTL = float(os.getenv("LLM_ADMISSION_TICKET_TTL", "900"))
 MAX_FILE_BYTES = 10_000_000  # حداکثر 10 مگابایت برای ورودی فایل
 MAX_FILE_TEXT_CHARS = 6000  # حداکثر کاراکتر inject شده از هر فایل
 IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tiff"}
@@ -400,6 +771,43 @@ class MoodSnapshot(Base):
     notes = Column(Text, nullable=True)
     
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+class MoodHourlyAggregate(Base):
+    """Per-user UTC-hour sums of mood snapshots (count, sums and sums of squares)"""
+    __tablename__ = "mood_hourly_aggregates"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    hour = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    energy_sum = Column(Integer, nullable=False, default=0)
+    energy_sq = Column(Integer, nullable=False, default=0)
+    mood_sum = Column(Integer, nullable=False, default=0)
+    mood_sq = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (Index("ux_mood_hourly_user_hour", "user_id", "hour", unique=True),)
+class MoodDailyAggregate(Base):
+    """Per-user UTC-day sums of mood snapshots for long-range trends"""
+    __tablename__ = "mood_daily_aggregates"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    energy_sum = Column(Integer, nullable=False, default=0)
+    energy_sq = Column(Integer, nullable=False, default=0)
+    mood_sum = Column(Integer, nullable=False, default=0)
+    mood_sq = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (Index("ux_mood_daily_user_day", "user_id", "day", unique=True),)
+class MaintenanceJob(Base):
+    """Progress marker of a one-time background job (e.g. a backfill); one worker holds its lease"""
+    __tablename__ = "maintenance_jobs"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), nullable=False, unique=True)
+    owner = Column(String(64), nullable=False)
+    lease_until = Column(DateTime, nullable=False)
+    cursor = Column(Integer, nullable=False, default=0)  # last processed source id
+    target = Column(Integer, nullable=False, default=0)  # last source id the job covers
+    completed = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 class Habit(Base):
     """Habits for tracking daily/weekly routines"""
     __tablename__ = "habits"
@@ -428,6 +836,29 @@ class HabitLog(Base):
     notes = Column(Text, nullable=True)
     
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ux_habit_log_day", "habit_id", "logged_date", unique=True),
+    )
+class HabitStats(Base):
+    """Incrementally maintained streak/completion state per habit (O(1) reads)"""
+    __tablename__ = "habit_stats"
+    habit_id = Column(Integer, ForeignKey("habits.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    
+    current_streak = Column(Integer, nullable=False, default=0)  # run ending at last_met_idx
+    longest_streak = Column(Integer, nullable=False, default=0)
+    periods_met = Column(Integer, nullable=False, default=0)  # days (Daily) / weeks (Weekly) reaching target
+    total_completions = Column(Integer, nullable=False, default=0)
+    first_logged = Column(Date, nullable=True)
+    last_logged = Column(Date, nullable=True)
+    
+    # period index = day ordinal (Daily) or Saturday-week ordinal (Weekly)
+    last_period_idx = Column(Integer, nullable=True)
+    last_period_count = Column(Integer, nullable=False, default=0)
+    last_met_idx = Column(Integer, nullable=True)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 # ═══════════════════════════════════════════════════════════════════
 # PHASE 2: DAILY PROGRAM & SMART SCHEDULING
 # ═══════════════════════════════════════════════════════════════════
@@ -450,6 +881,20 @@ class DailyProgram(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     __table_args__ = (Index('ix_user_program_date', 'user_id', 'date'),)
+class PrecomputedDay(Base):
+    """Off-peak pre-generated program + briefing of one user-day"""
+    __tablename__ = "precomputed_days"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    date = Column(Date, nullable=False)  # local date of the user
+    program_id = Column(String(36), nullable=True)  # DailyProgram written by the pre-generator (None: user's own)
+    briefing = Column(JSON, nullable=True)
+    briefing_raw = Column(Text, nullable=True)
+    source_digest = Column(String(64), nullable=False, default="")  # _day_task_digests() at generation time
+    generated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (Index("ux_precomputed_day", "user_id", "date", unique=True),)
 class SchedulingAnalysis(Base):
     """Smart scheduling analysis results"""
     __tablename__ = "scheduling_analyses"
@@ -463,6 +908,94 @@ class SchedulingAnalysis(Base):
     improvements = Column(JSON, default=list)  # JSON array of suggestions
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+class StoredNotification(Base):
+    """Notifications and messages ingested from the user's devices"""
+    __tablename__ = "notifications"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    external_id = Column(String(128))  # client-side id, unique per user
+    kind = Column(String(20), default="notification")  # notification, message
+    sender = Column(String(255))
+    title = Column(String(500), default="")
+    body = Column(Text, default="")
+    category = Column(String(30), default="other")  # work, personal, social, system, other
+    urgency = Column(String(20), default="medium")  # critical, high, medium, low
+    triage = Column(String(20))  # critical, important, normal, spam
+    suggested_action = Column(String(500))
+    sentiment = Column(Float)  # -1..1
+    topics = Column(JSON, default=list)
+    is_read = Column(Boolean, default=False)
+    processed = Column(Boolean, default=False)
+    received_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_notification_user_received_category", "user_id", "received_at", "category"),
+        Index("ux_notification_user_external", "user_id", "external_id", unique=True),
+    )
+class StoredNotificationSummary(Base):
+    """Generated NotificationSummary results"""
+    __tablename__ = "notification_summaries"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    summary_id = Column(String(64), nullable=False)
+    summary_date = Column(Date, nullable=False)
+    payload = Column(JSON, nullable=False)  # NotificationSummary as JSON
+    generated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_notification_summary_user_date", "user_id", "summary_date"),
+        Index("ix_notification_summary_user_sid", "user_id", "summary_id"),
+    )
+class NotificationDailyRollup(Base):
+    """Per-user, per-day (UTC) notification aggregates for trend queries"""
+    __tablename__ = "notification_daily_rollups"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    total = Column(Integer, default=0)
+    read_count = Column(Integer, default=0)
+    critical_count = Column(Integer, default=0)
+    important_count = Column(Integer, default=0)
+    category_counts = Column(JSON, default=dict)
+    sender_counts = Column(JSON, default=dict)  # top senders only
+    topic_counts = Column(JSON, default=dict)
+    sentiment_sum = Column(Float, default=0.0)
+    sentiment_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (Index("ux_notification_rollup_user_day", "user_id", "day", unique=True),)
+class NotificationSummaryState(Base):
+    """Running notification summary per user (for incremental summarization)"""
+    __tablename__ = "notification_summary_states"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
+    window_start = Column(DateTime, nullable=False)
+    window_hours = Column(Integer, nullable=False)
+    focus_area = Column(String(255))
+    item_count = Column(Integer, default=0)
+    seen_keys = Column(JSON, default=list)  # hashes of items already folded into payload
+    payload = Column(JSON)  # NotificationSummary as JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+class NotificationSnooze(Base):
+    """Snoozed notification categories; released_at is set once the snooze ends or is cancelled"""
+    __tablename__ = "notification_snoozes"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    category = Column(String(30))  # None = all categories
+    snoozed_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    released_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_notification_snooze_pending", "released_at", "expires_at"),
+        Index("ix_notification_snooze_user_category", "user_id", "category"),
+    )
 
 # =========================
 # Pydantic Models (مثل Dart)
@@ -574,6 +1107,53 @@ class CategorizeRequest(BaseModel):
     body: str
 
 
+class BatchCategorizeItem(BaseModel):
+    id: Optional[str] = None
+    title: str
+    body: str
+    sender: Optional[str] = None
+
+
+class BatchCategorizeRequest(BaseModel):
+    notifications: List[BatchCategorizeItem]
+
+
+class BatchCategorizeResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    result: NotificationCategory
+    source: str = "llm"  # llm, local, duplicate, sender_cache, fallback
+
+
+class BatchCategorizeResponse(BaseModel):
+    results: List[BatchCategorizeResult]
+    unique_items: int = 0
+    llm_calls: int = 0
+
+
+class NotificationIngestItem(BaseModel):
+    id: Optional[str] = None
+    kind: str = "notification"  # notification, message
+    sender: Optional[str] = None
+    title: str = ""
+    body: str = ""
+    received_at: Optional[datetime] = None
+    is_read: bool = False
+    category: Optional[str] = None
+    urgency: Optional[str] = None
+    sentiment: Optional[float] = None
+    topics: List[str] = []
+
+
+class NotificationIngestRequest(BaseModel):
+    notifications: List[NotificationIngestItem]
+
+
+class NotificationIngestResponse(BaseModel):
+    ingested: int = 0
+    duplicates: int = 0
+
+
 class SnoozeRequest(BaseModel):
     snooze_minutes: int
     category: Optional[str] = None
@@ -646,6 +1226,23 @@ class TaskRecurrence(Base):
     
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class TaskOccurrence(Base):
+    """Materialized (or deleted) occurrences of a TaskRecurrence"""
+    __tablename__ = "task_occurrences"
+
+    id = Column(Integer, primary_key=True)
+    recurrence_id = Column(Integer, ForeignKey("task_recurrences.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    task_id = Column(Integer, ForeignKey("user_tasks.id"), nullable=True, index=True)  # None once deleted
+    occurrence_at = Column(DateTime, nullable=False)
+    status = Column(String(32), nullable=False, default="materialized")  # materialized, deleted
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ux_task_occurrence_recurrence_at', 'recurrence_id', 'occurrence_at', unique=True),
+    )
+
 class TaskReminder(Base):
     """Reminder history and scheduling"""
     __tablename__ = "task_reminders"
@@ -663,6 +1260,18 @@ class TaskReminder(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
+class ReminderBucketLease(Base):
+    """Lease on a time bucket of task reminders; one worker dispatches each bucket"""
+    __tablename__ = "reminder_bucket_leases"
+
+    id = Column(Integer, primary_key=True)
+    bucket_start = Column(DateTime, nullable=False, unique=True)
+    owner = Column(String(64), nullable=False)
+    lease_until = Column(DateTime, nullable=False)
+    completed = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 class GeoFence(Base):
     """Location-based reminder geofences"""
     __tablename__ = "geofences"
@@ -708,6 +1317,49 @@ class LocationCheckIn(Base):
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 
+class SyncCounter(Base):
+    """Per-user change sequence; the row lock serializes a user's writers so seq order is commit order."""
+    __tablename__ = "sync_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    seq = Column(Integer, nullable=False, default=0)
+    seeded = Column(Boolean, nullable=False, default=False)  # existing rows copied into sync_changes
+
+
+class SyncChange(Base):
+    """Latest change per synced entity (compacted change log + tombstones)"""
+    __tablename__ = "sync_changes"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    seq = Column(Integer, nullable=False)
+    entity = Column(String(16), nullable=False)  # task, habit, goal, mood
+    entity_id = Column(String(36), nullable=False)  # public UUID of the entity
+    op = Column(String(8), nullable=False)  # upsert, delete
+    changed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ux_sync_change_user_seq", "user_id", "seq", unique=True),
+        Index("ux_sync_change_entity", "user_id", "entity", "entity_id", unique=True),
+    )
+
+
+class IdempotencyRecord(Base):
+    """Idempotency keys of replayed client writes and the resource each one created"""
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    key = Column(String(64), nullable=False)
+    scope = Column(String(16), nullable=False)  # task, habit_log, mood
+    resource_id = Column(String(36), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    __table_args__ = (
+        Index("ux_idempotency_user_key", "user_id", "key", unique=True),
+    )
+
+
 class InstagramIdeaRequest(BaseModel):
     topic: str
     audience: Optional[str] = None
@@ -733,6 +1385,7 @@ class TaskCreateRequest(BaseModel):
     location: Optional[str] = None
     subtasks: Optional[List[Subtask]] = None
     tags: Optional[List[str]] = None
+    reminder_before_minutes: Optional[int] = None
 
 class TaskUpdateRequest(BaseModel):
     title: Optional[str] = None
@@ -742,6 +1395,7 @@ class TaskUpdateRequest(BaseModel):
     due_date: Optional[str] = None
     subtasks: Optional[List[Subtask]] = None
     notes: Optional[str] = None
+    reminder_before_minutes: Optional[int] = None
 
 class TaskResponse(BaseModel):
     task_id: str
@@ -766,6 +1420,7 @@ class TaskListResponse(BaseModel):
     tasks: List[TaskResponse]
     overdue_count: int
     today_count: int
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page
 
 class RecurrencePattern(BaseModel):
     pattern: str  # daily, weekly, monthly, custom
@@ -781,6 +1436,47 @@ class RecurringTaskRequest(BaseModel):
     priority: int = 3
     estimated_duration_minutes: Optional[int] = None
     tags: Optional[List[str]] = None
+    start_date: Optional[str] = None  # ISO datetime of the first occurrence (default: now)
+    reminder_before_minutes: Optional[int] = None
+
+class TaskCalendarItem(BaseModel):
+    task_id: Optional[str]  # None for occurrences beyond the materialized horizon
+    title: str
+    category: str
+    status: str
+    priority: int
+    due_date: datetime
+    series_id: Optional[str] = None  # task_id of the recurring master task
+    virtual: bool = False
+
+class TaskCalendarResponse(BaseModel):
+    start: datetime
+    end: datetime
+    items: List[TaskCalendarItem]
+
+class LocationPing(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    accuracy_meters: Optional[float] = None
+    recorded_at: Optional[str] = None  # ISO datetime on the device (default: now)
+
+class LocationCheckInBatchRequest(BaseModel):
+    pings: List[LocationPing]
+
+class GeoFenceEvent(BaseModel):
+    geofence_id: str
+    name: str
+    task_id: Optional[str] = None
+    action: str  # entry, exit
+    latitude: float
+    longitude: float
+    recorded_at: datetime
+
+class LocationCheckInResponse(BaseModel):
+    processed: int
+    ignored: int
+    events: List[GeoFenceEvent]
+    inside: List[str]  # geofence_ids the user is currently inside
 
 class InstagramIdeaResponse(BaseModel):
     topic: str
@@ -1059,6 +1755,31 @@ class MoodHistoryResponse(BaseModel):
     avg_energy: float
     avg_mood: float
     trend: str  # improving, stable, declining
+class MoodTrendPoint(BaseModel):
+    start: datetime  # UTC start of the hour/day bucket
+    count: int
+    avg_energy: float
+    avg_mood: float
+    std_energy: float
+    std_mood: float
+class MoodTrendResponse(BaseModel):
+    """Mood trend over a window, computed from aggregates"""
+    days: int
+    granularity: str  # day, hour
+    points: List[MoodTrendPoint]
+    count: int
+    avg_energy: Optional[float] = None
+    avg_mood: Optional[float] = None
+    energy_slope: float  # points per day
+    mood_slope: float
+    trend: str  # improving, stable, declining
+class MoodHeatmapResponse(BaseModel):
+    """7 x 24 matrices: rows Saturday..Friday, columns local hour 0..23"""
+    days: int
+    timezone: str
+    counts: List[List[int]]
+    avg_energy: List[List[Optional[float]]]
+    avg_mood: List[List[Optional[float]]]
 class HabitCreateRequest(BaseModel):
     """Create a new habit"""
     name: str
@@ -1079,10 +1800,37 @@ class HabitResponse(BaseModel):
     longest_streak: int = 0
     total_completed: int = 0
     completed_today: bool = False
+    completion_rate: float = 0.0  # met periods / periods since the habit started
+    period_progress: float = 0.0  # this day's/week's count toward target_count
+    archived: bool = False
 class HabitLogRequest(BaseModel):
     """Log habit completion"""
     count: int = 1
     notes: Optional[str] = None
+    logged_date: Optional[str] = None  # ISO date (default: today)
+class BulkTaskCreateItem(TaskCreateRequest):
+    idempotency_key: Optional[str] = Field(None, max_length=64)
+class BulkHabitLogItem(HabitLogRequest):
+    habit_id: str
+    idempotency_key: Optional[str] = Field(None, max_length=64)
+class BulkMoodSnapshotItem(MoodSnapshotRequest):
+    recorded_at: Optional[str] = None  # ISO datetime on the device (default: now)
+    idempotency_key: Optional[str] = Field(None, max_length=64)
+class BulkWriteRequest(BaseModel):
+    """Queued offline writes replayed together"""
+    tasks: List[BulkTaskCreateItem] = []
+    habit_logs: List[BulkHabitLogItem] = []
+    mood_snapshots: List[BulkMoodSnapshotItem] = []
+class BulkItemResult(BaseModel):
+    index: int
+    status: int  # 201 created, 200 replayed, 400/404/409 rejected
+    id: Optional[str] = None
+    replayed: bool = False
+    error: Optional[str] = None
+class BulkWriteResponse(BaseModel):
+    tasks: List[BulkItemResult]
+    habit_logs: List[BulkItemResult]
+    mood_snapshots: List[BulkItemResult]
 # ═══════════════════════════════════════════════════════════════════
 # PHASE 2: DAILY PROGRAM & SMART SCHEDULING REQUESTS/RESPONSES
 # ═══════════════════════════════════════════════════════════════════
@@ -1113,6 +1861,8 @@ class DailyProgramResponse(BaseModel):
     focus_theme: Optional[str] = None
     is_completed: bool = False
     created_at: str
+    unscheduled: List[Dict[str, Any]] = []  # items that did not fit the day
+    solver_ms: Optional[float] = None
 class SchedulingRecommendationRequest(BaseModel):
     """Request scheduling analysis"""
     pass
@@ -1648,9 +2398,10 @@ def _start_telegram_bot() -> None:
     except Exception as exc:  # noqa: BLE001
         _TELEGRAM_BOT = None
         log.warning("Failed to start Telegram bot: %s", exc)
-async def _send_push_notification(user_id: int, title: str, body: str) -> None:
+async def _send_push_notification(user_id: int, title: str, body: str) -> bool:
     """
     Push notifications via FCM HTTP v1; fallback to webhook if provided.
+    Returns whether any channel accepted the message.
     """
     sent = False
     async def _get_tokens() -> List[str]:
@@ -1695,6 +2446,7 @@ async def _send_push_notification(user_id: int, title: str, body: str) -> None:
         except Exception as exc:  # noqa: BLE001
             log.warning("Push webhook failed: %s", exc)
     log.info("Push notification => user=%s | %s | %s", user_id, title, body)
+    return sent
 SESSIONS: Dict[str, List[Message]] = {}
 SESSIONS_LOCK = asyncio.Lock()
 def _estimate_tokens_for_text(text: str) -> int:
@@ -1710,9 +2462,14 @@ def _trim_messages_to_budget(messages: List[Message], token_budget: int, max_mes
     while trimmed and trimmed[0].role == "system" and len(prefix) < 2:
         prefix.append(trimmed.pop(0))
     body = trimmed
-    while body and (_estimate_tokens_for_messages(prefix + body) > token_budget or len(prefix + body) > max_messages):
-        body.pop(0)
-    return prefix + body
+    # هزینهٔ هر پیام یک بار حساب می‌شود تا trim روی تاریخچه‌های بلند خطی بماند
+    costs = [_estimate_tokens_for_text(m.content) + 4 for m in body]
+    total = _estimate_tokens_for_messages(prefix) + sum(costs)
+    start = 0
+    while start < len(body) and (total > token_budget or len(prefix) + len(body) - start > max_messages):
+        total -= costs[start]
+        start += 1
+    return prefix + body[start:]
 async def _summarize_messages_for_history(messages: List[Message]) -> str:
     if not messages:
         return "گفت‌وگوی قبلی خلاصه‌ای نداشت."
@@ -1752,7 +2509,8 @@ async def _maybe_compact_session(session_id: str) -> None:
         return
     older = body[:-SESSION_RECENT_MESSAGES]
     recent = body[-SESSION_RECENT_MESSAGES:]
-    summary_text = await _summarize_messages_for_history(older)
+    with _trace_span("compaction", messages=len(older)):
+        summary_text = await _summarize_messages_for_history(older)
     summary_msg = Message(
         role="system",
         content=f"خلاصه‌ی مکالمات قبلی (برای حفظ محدودیت توکن): {summary_text}",
@@ -1923,23 +2681,25 @@ async def _ingest_file_uri(uri: str) -> Dict[str, Optional[Any]]:
     uri = uri.strip()
     if not uri:
         raise HTTPException(status_code=400, detail="آدرس فایل خالی است.")
-    if uri.startswith("http://") or uri.startswith("https://"):
-        name, data, charset = await _fetch_remote_file_bytes(uri)
-    else:
-        name, data, charset = _read_local_file_bytes(uri)
-    return _ingest_bytes(name, data, charset)
+    with _trace_span("file_ingestion", source="url" if uri.startswith(("http://", "https://")) else "local"):
+        if uri.startswith("http://") or uri.startswith("https://"):
+            name, data, charset = await _fetch_remote_file_bytes(uri)
+        else:
+            name, data, charset = _read_local_file_bytes(uri)
+        return _ingest_bytes(name, data, charset)
 async def _ingest_upload_file(upload: UploadFile) -> Dict[str, Optional[Any]]:
     name = upload.filename or "upload"
-    if hasattr(upload, "seek"):
-        await upload.seek(0)  # type: ignore[func-returns-value]
-    data = await upload.read()
-    if len(data) > MAX_FILE_BYTES:
-        raise HTTPException(status_code=400, detail="حجم فایل بیش از حد مجاز است (max 10MB).")
-    content_type = upload.content_type or ""
-    charset = None
-    if "charset=" in content_type:
-        charset = content_type.split("charset=", 1)[1].strip() or None
-    return _ingest_bytes(name, data, charset)
+    with _trace_span("file_ingestion", source="upload"):
+        if hasattr(upload, "seek"):
+            await upload.seek(0)  # type: ignore[func-returns-value]
+        data = await upload.read()
+        if len(data) > MAX_FILE_BYTES:
+            raise HTTPException(status_code=400, detail="حجم فایل بیش از حد مجاز است (max 10MB).")
+        content_type = upload.content_type or ""
+        charset = None
+        if "charset=" in content_type:
+            charset = content_type.split("charset=", 1)[1].strip() or None
+        return _ingest_bytes(name, data, charset)
 def _read_local_file_text(path_str: str) -> str:
     path = Path(path_str)
     if not path.is_absolute():
@@ -2179,27 +2939,27 @@ def _strip_html(raw: str) -> str:
     text = re.sub(r"\s+", " ", text)
     text = re.sub(r"https?://\S+", "", text)
     return text.strip()
+def _extract_main_body(html_text: str) -> Optional[str]:
+    """
+    Heuristic extraction of main article text to avoid menus/ads.
+    """
+    candidates: List[str] = []
+    patterns = [
+        r"(?is)<article[^>]*>(.*?)</article>",
+        r"(?is)<main[^>]*>(.*?)</main>",
+        r'(?is)<div[^>]*(id|class)="?(content|post|article|main|entry)[^>]*>(.*?)</div>',
+    ]
+    for pattern in patterns:
+        for match in re.finditer(pattern, html_text):
+            groups = match.groups()
+            body_html = groups[-1] if groups else match.group(0)
+            text = _strip_html(body_html)
+            if len(text) >= 200:
+                candidates.append(text)
+    if not candidates:
+        return None
+    return max(candidates, key=len)
 async def _fetch_page_details(url: str, limit: int = 1500) -> Optional[Dict[str, str]]:
-    def _extract_main_body(html_text: str) -> Optional[str]:
-        """
-        Heuristic extraction of main article text to avoid menus/ads.
-        """
-        candidates: List[str] = []
-        patterns = [
-            r"(?is)<article[^>]*>(.*?)</article>",
-            r"(?is)<main[^>]*>(.*?)</main>",
-            r'(?is)<div[^>]*(id|class)="?(content|post|article|main|entry)[^>]*>(.*?)</div>',
-        ]
-        for pattern in patterns:
-            for match in re.finditer(pattern, html_text):
-                groups = match.groups()
-                body_html = groups[-1] if groups else match.group(0)
-                text = _strip_html(body_html)
-                if len(text) >= 200:
-                    candidates.append(text)
-        if not candidates:
-            return None
-        return max(candidates, key=len)
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
         "(KHTML, like Gecko) Chrome/119.0 Safari/537.36",
@@ -2498,6 +3258,10 @@ async def _agent_task_worker() -> None:
     finally:
         log.info("Agent scheduler worker stopped.")
 async def _run_deep_research(body: DeepResearchRequest) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+    messages, google_sources = await _deep_research_messages(body)
+    raw_text = await _fallback_completion(messages, temperature=0.35)
+    return raw_text, google_sources
+async def _deep_research_messages(body: DeepResearchRequest) -> Tuple[List[Dict[str, str]], Optional[List[Dict[str, Any]]]]:
     research_prompt = None
     google_sources: Optional[List[Dict[str, Any]]] = None
     languages = body.languages or [body.language, "en"]
@@ -2536,8 +3300,8 @@ async def _run_deep_research(body: DeepResearchRequest) -> Tuple[str, Optional[L
         },
         {"role": "user", "content": user_prompt},
     ]
-    raw_text = await _fallback_completion(messages, temperature=0.35)
-    return raw_text, google_sources
+    return messages, google_sources
+@_single_flight("search_queries")
 async def _suggest_search_queries(
     prompt_text: str,
     language: str = "fa",
@@ -2603,6 +3367,8 @@ def _parse_model_list(model_value: Optional[str]) -> List[str]:
         return []
     models = [item.strip() for item in model_value.split(",") if item.strip()]
     return models
+@_single_flight("web_search_summary")
+@_timed_async(M_WEB_SEARCH_SECONDS)
 async def _google_search_summary(
     query: str,
     fetch_pages: bool = False,
@@ -2901,6 +3667,11 @@ async def _get_user_by_id(user_id: int) -> Optional[User]:
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
 ) -> User:
+    with _trace_span("auth"):
+        user = await _authenticate_bearer(credentials)
+    _CURRENT_USER_KEY.set(str(user.id))
+    return user
+async def _authenticate_bearer(credentials: Optional[HTTPAuthorizationCredentials]) -> User:
     if credentials is None or credentials.scheme.lower() != "bearer":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="توکن ارسال نشده است.")
     token = credentials.credentials
@@ -2916,6 +3687,173 @@ async def get_current_user(
     if user is None or user.phone != phone:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="کاربر یافت نشد.")
     return user
+# ═══════════════════════════════════════════════════════════════════
+# LLM ADMISSION CONTROL - per-user caps + per-provider budget
+# ═══════════════════════════════════════════════════════════════════
+# کاربر فعلی درخواست برای سهمیهٔ completionها (در get_current_user مقدار می‌گیرد؛ بدون احراز هویت ip:<client>)
+_CURRENT_USER_KEY: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_user_key", default=None)
+class LLMSaturatedError(Exception):
+    """No LLM capacity for this request right now; surfaced to clients as 429 + Retry-After."""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+class _LLMGovernor:
+    """
+    Admission controller for LLM calls.
+    - per-user caps on concurrent streams / completions (immediate 429 when exceeded)
+    - a global in-flight budget; waiters queue up to LLM_ADMISSION_MAX_WAIT seconds and
+      are served fairly: users with fewer in-flight calls go first, then FIFO
+    - a per-`model@provider` concurrency budget checked on every attempt
+    """
+    def __init__(self) -> None:
+        self.user_active: Dict[Tuple[str, str], int] = {}
+        self.global_active = 0
+        self.provider_active: Dict[str, int] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        # tickets → زمان صدور؛ برای آزاد کردن ticketهایی که هیچ‌وقت release نشدند
+        self._tickets: Dict[int, Tuple[str, str, float]] = {}
+
+    def _user_total(self, user_key: str) -> int:
+        return sum(count for (key, _), count in self.user_active.items() if key == user_key)
+
+    def _expire_stale(self) -> None:
+        cutoff = time.monotonic() - LLM_ADMISSION_TICKET_TTL
+        for ticket_id, (_, _, issued) in list(self._tickets.items()):
+            if issued < cutoff:
+                log.warning("Releasing stale LLM admission ticket %s", ticket_id)
+                self.release(ticket_id)
+
+    def _wake_next(self) -> None:
+        # ظرفیت همین‌جا برای waiter رزرو می‌شود تا بین wake و ادامهٔ آن کسی جلو نزند
+        while self._waiters and self.global_active < LLM_GLOBAL_CONCURRENCY:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self.global_active += 1
+                fut.set_result(True)
+
+    def retry_after(self) -> int:
+        return max(1, int(round(LLM_ADMISSION_RETRY_AFTER)))
+
+    async def admit(self, user_key: Optional[str], kind: str) -> int:
+        """Reserve capacity for one LLM call; returns a ticket for release()."""
+        self._expire_stale()
+        user_key = user_key or "anonymous"
+        cap = LLM_MAX_STREAMS_PER_USER if kind == "stream" else LLM_MAX_COMPLETIONS_PER_USER
+        if self.user_active.get((user_key, kind), 0) >= cap:
+            raise LLMSaturatedError(f"too many concurrent {kind} requests for user", self.retry_after())
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self.global_active >= LLM_GLOBAL_CONCURRENCY or self._waiters:
+            loop = asyncio.get_running_loop()
+            fut: asyncio.Future = loop.create_future()
+            self._seq += 1
+            heapq.heappush(self._waiters, (self._user_total(user_key), self._seq, fut))
+            self._wake_next()
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), timeout=LLM_ADMISSION_MAX_WAIT)
+            except BaseException as exc:
+                if fut.done() and not fut.cancelled():
+                    # ظرفیت رزرو شده بود ولی درخواست دیگر منتظر نیست
+                    self.global_active = max(0, self.global_active - 1)
+                    self._wake_next()
+                else:
+                    fut.cancel()
+                if isinstance(exc, asyncio.TimeoutError):
+                    raise LLMSaturatedError("LLM capacity saturated", self.retry_after())
+                raise
+            if self.user_active.get((user_key, kind), 0) >= cap:
+                # درخواست‌های دیگر همین کاربر در مدت انتظار سهمیه را پر کرده‌اند
+                self.global_active = max(0, self.global_active - 1)
+                self._wake_next()
+                raise LLMSaturatedError(f"too many concurrent {kind} requests for user", self.retry_after())
+        else:
+            self.global_active += 1
+        self.user_active[(user_key, kind)] = self.user_active.get((user_key, kind), 0) + 1
+        self._seq += 1
+        self._tickets[self._seq] = (user_key, kind, time.monotonic())
+        return self._seq
+
+    def release(self, ticket_id: Optional[int]) -> None:
+        info = self._tickets.pop(ticket_id, None) if ticket_id is not None else None
+        if info is None:
+            return
+        user_key, kind, _ = info
+        self.global_active = max(0, self.global_active - 1)
+        remaining = self.user_active.get((user_key, kind), 0) - 1
+        if remaining > 0:
+            self.user_active[(user_key, kind)] = remaining
+        else:
+            self.user_active.pop((user_key, kind), None)
+        self._wake_next()
+
+    def try_acquire_provider(self, entry: str) -> bool:
+        if self.provider_active.get(entry, 0) >= LLM_PROVIDER_CONCURRENCY:
+            return False
+        self.provider_active[entry] = self.provider_active.get(entry, 0) + 1
+        return True
+
+    def release_provider(self, entry: str) -> None:
+        remaining = self.provider_active.get(entry, 0) - 1
+        if remaining > 0:
+            self.provider_active[entry] = remaining
+        else:
+            self.provider_active.pop(entry, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "global_active": self.global_active,
+            "global_limit": LLM_GLOBAL_CONCURRENCY,
+            "waiting": len(self._waiters),
+            "providers": dict(self.provider_active),
+        }
+_LLM_GOVERNOR = _LLMGovernor()
+def _saturated_http_error(exc: LLMSaturatedError) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="سرور در حال حاضر شلوغ است؛ لطفاً چند لحظه بعد دوباره تلاش کنید.",
+        headers={"Retry-After": str(int(exc.retry_after))},
+    )
+@app.exception_handler(LLMSaturatedError)
+async def _llm_saturated_handler(request: Request, exc: LLMSaturatedError):
+    http_exc = _saturated_http_error(exc)
+    return JSONResponse(status_code=http_exc.status_code, content={"detail": http_exc.detail}, headers=http_exc.headers)
+def _metrics_peer_allowed(request: Request) -> bool:
+    # درخواستی که از reverse proxy محلی آمده هم peer loopback دارد؛ هدر forward یعنی از بیرون آمده
+    if request.headers.get("x-forwarded-for") or request.headers.get("forwarded"):
+        return False
+    try:
+        peer = ipaddress.ip_address(request.client.host) if request.client else None
+    except ValueError:
+        return False
+    return peer is not None and any(peer in network for network in METRICS_ALLOWED_NETWORKS)
+@app.get("/metrics")
+async def metrics_endpoint(request: Request) -> Response:
+    """
+    Prometheus scrape endpoint. با METRICS_TOKEN Bearer لازم است؛ بدون آن فقط scraperی که مستقیم
+    از METRICS_ALLOWED_NETWORKS (پیش‌فرض loopback) وصل شده جواب می‌گیرد.
+    """
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization", "")
+        if not secrets.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="توکن نامعتبر است.")
+    elif not _metrics_peer_allowed(request):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="دسترسی به metrics مجاز نیست.")
+    snapshot = _LLM_GOVERNOR.snapshot()
+    gauges = [
+        "# HELP llm_inflight_calls LLM calls currently admitted.",
+        "# TYPE llm_inflight_calls gauge",
+        f"llm_inflight_calls {snapshot['global_active']}",
+        "# HELP llm_admission_waiting Requests waiting for LLM capacity.",
+        "# TYPE llm_admission_waiting gauge",
+        f"llm_admission_waiting {snapshot['waiting']}",
+        "# HELP llm_provider_inflight In-flight calls per model@provider.",
+        "# TYPE llm_provider_inflight gauge",
+    ]
+    for entry, active in snapshot["providers"].items():
+        gauges.append(f"llm_provider_inflight{_metric_labels(('entry',), (entry,))} {active}")
+    body = _render_metrics() + "\n".join(gauges) + "\n"
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
 def _extract_message_text(response: Any) -> Optional[str]:
     """استخراج متن پاسخ از حالت non-stream."""
     if response is None:
@@ -2933,6 +3871,7 @@ def _extract_message_text(response: Any) -> Optional[str]:
     if content is None:
         content = getattr(primary, "text", None)
     return _normalize_token_piece(content)
+@_single_flight("completion")
 async def _execute_fallback_completion(
     messages: List[Dict[str, str]],
     temperature: float = 0.6,
@@ -2941,9 +3880,21 @@ async def _execute_fallback_completion(
     """
     Run the completion fallback chain and return (text, model, provider_label).
     When web_search=True the provider-native search capability is requested.
+    Identical concurrent calls (double-fired requests, retries) share one chain run.
     """
+    ticket = await _LLM_GOVERNOR.admit(_CURRENT_USER_KEY.get(), "completion")
+    try:
+        return await _run_completion_chain(messages, temperature, web_search)
+    finally:
+        _LLM_GOVERNOR.release(ticket)
+async def _run_completion_chain(
+    messages: List[Dict[str, str]],
+    temperature: float,
+    web_search: bool,
+) -> Tuple[str, str, Optional[str]]:
     client = AsyncClient()
     last_error: Optional[str] = None
+    saturated = 0
     for entry in FALLBACK_CHAIN:
         model, provider_label = _parse_entry(entry)
         resolved_provider = _resolve_provider(provider_label)
@@ -2951,6 +3902,10 @@ async def _execute_fallback_completion(
         if not can_use:
             last_error = skip_reason
             continue
+        if not _LLM_GOVERNOR.try_acquire_provider(entry):
+            saturated += 1
+            last_error = f"{entry} saturated"
+            continue
         kwargs: Dict[str, Any] = {
             "model": model,
             "messages": messages,
@@ -2962,14 +3917,22 @@ async def _execute_fallback_completion(
             kwargs["web_search"] = True
         if provider_kwargs:
             kwargs.update(provider_kwargs)
+        started = time.perf_counter()
         try:
             response = await client.chat.completions.create(**kwargs)
         except Exception as exc:  # noqa: BLE001
             last_error = repr(exc)
+            M_COMPLETION_SECONDS.observe(time.perf_counter() - started, entry, "error")
             continue
+        finally:
+            _LLM_GOVERNOR.release_provider(entry)
         text = _extract_message_text(response)
+        M_COMPLETION_SECONDS.observe(time.perf_counter() - started, entry, "ok" if text else "empty")
         if text:
+            M_FALLBACK_DEPTH.observe(FALLBACK_CHAIN.index(entry) + 1, "completion")
             return text, model, provider_label
+    if saturated and last_error and last_error.endswith("saturated"):
+        raise LLMSaturatedError(f"all providers busy: {last_error}", _LLM_GOVERNOR.retry_after())
     raise RuntimeError(f"all providers failed to return text: {last_error}")
 async def _fallback_completion(
     messages: List[Dict[str, str]],
@@ -3045,72 +4008,344 @@ async def _run_structured_completion(system_prompt: str, user_prompt: str, tempe
     if parsed is None:
         raise HTTPException(status_code=502, detail="پاسخ مدل JSON معتبر نداد.")
     return parsed, raw_text
-
-# ═══════════════════════════════════════════════════════════════════
-# GOAL TRACKING HELPER FUNCTIONS
-# ═══════════════════════════════════════════════════════════════════
-async def _update_goal_progress_auto(user_id: int, goal_id: int) -> int:
-    """Auto-update goal progress based on linked tasks and habits"""
-    async with async_session() as session:
-        goal = await session.get(UserGoal, goal_id)
-        if not goal or not goal.auto_progress_enabled:
-            return goal.progress_percentage if goal else 0
-        
-        # Get linked task completion percentage
-        task_ids = goal.linked_task_ids or []
-        habit_ids = goal.linked_habit_ids or []
-        
-        total_progress = 0
-        weight_sum = 0
-        
-        if task_ids:
-            stmt = select(UserTask).where(UserTask.task_id.in_(task_ids))
-            result = await session.execute(stmt)
-            tasks = result.scalars().all()
-            
-            completed_tasks = sum(1 for t in tasks if t.status == "completed")
-            if tasks:
-                task_progress = (completed_tasks / len(tasks)) * 100 * 0.6  # 60% weight
-                total_progress += task_progress
-                weight_sum += 0.6
-        
-        if habit_ids:
-            stmt = select(Habit).where(Habit.habit_id.in_(habit_ids))
-            result = await session.execute(stmt)
-            habits = result.scalars().all()
-            
-            # Get recent habit logs
-            today = datetime.utcnow().date()
-            habit_progress = 0
-            if habits:
-                for habit in habits:
-                    log_stmt = select(HabitLog).where(
-                        HabitLog.habit_id == habit.id,
-                        HabitLog.logged_date == today
-                    )
-                    log_result = await session.execute(log_stmt)
-                    has_log = log_result.scalar_one_or_none() is not None
-                    if has_log:
-                        habit_progress += (1 / len(habits)) * 100 * 0.4  # 40% weight
-                total_progress += habit_progress
-                weight_sum += 0.4
-        
-        new_progress = int(total_progress / weight_sum) if weight_sum > 0 else goal.progress_percentage
-        new_progress = min(100, max(0, new_progress))
-        
-        if new_progress != goal.progress_percentage:
-            # Log the change
-            log_entry = GoalProgressLog(
-                goal_id=goal_id,
-                user_id=user_id,
-                old_progress=goal.progress_percentage,
-                new_progress=new_progress,
-                reason="auto_update"
-            )
-            session.add(log_entry)
-            
-            goal.progress_percentage = new_progress
-            goal.last_auto_update = datetime.utcnow()
+class _IncrementalJSONParser:
+    """
+    Push parser for JSON arriving token by token. Leading prose and ``` fences are
+    skipped until the first '{' or '['. Every value whose path is at most
+    `max_depth` deep is reported once it is complete, as (path, value), e.g.
+    (("important_messages", 0), {...}) or (("summary",), "...").
+    The scan is linear; the root is assembled from its top-level children instead
+    of being parsed again at the end.
+    """
+    def __init__(self, max_depth: int = 2):
+        self.max_depth = max_depth
+        self.buffer = ""
+        self.pos = 0
+        self.root_start: Optional[int] = None
+        self.root: Any = None
+        self.done = False
+        self.failed = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        # هر frame: [kind, start, key/index, child_start, expect_key]
+        self._stack: List[List[Any]] = []
+        self._top: Any = None
+
+    @staticmethod
+    def _begin_child(frame: List[Any], at: int) -> None:
+        if frame[3] is None:
+            frame[3] = at
+            if frame[0] == "[" and frame[2] is None:
+                frame[2] = 0
+
+    def _path(self) -> Tuple[Any, ...]:
+        return tuple(frame[2] for frame in self._stack)
+
+    def _complete_child(self, end: int, events: List[Tuple[Tuple[Any, ...], Any]]) -> None:
+        frame = self._stack[-1]
+        start = frame[3]
+        if start is None:
+            return
+        frame[3] = None
+        if len(self._stack) <= self.max_depth:
+            try:
+                value = json.loads(self.buffer[start:end])
+            except json.JSONDecodeError:
+                self.failed = True
+                return
+            if len(self._stack) == 1:
+                if isinstance(self._top, dict):
+                    self._top[frame[2]] = value
+                else:
+                    self._top.append(value)
+            events.append((self._path(), value))
+
+    def feed(self, text: str) -> List[Tuple[Tuple[Any, ...], Any]]:
+        events: List[Tuple[Tuple[Any, ...], Any]] = []
+        if self.done or self.failed or not text:
+            self.buffer += text or ""
+            return events
+        self.buffer += text
+        buf = self.buffer
+        i = self.pos
+        end = len(buf)
+        while i < end:
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    frame = self._stack[-1] if self._stack else None
+                    if frame is not None and frame[0] == "{" and frame[4]:
+                        try:
+                            frame[2] = json.loads(buf[self._string_start:i + 1])
+                        except json.JSONDecodeError:
+                            self.failed = True
+                            break
+                i += 1
+                continue
+            if self.root_start is None:
+                if ch in "{[":
+                    self.root_start = i
+                    self._top = {} if ch == "{" else []
+                    self._stack.append([ch, i, None, None, ch == "{"])
+                i += 1
+                continue
+            frame = self._stack[-1]
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+                if not (frame[0] == "{" and frame[4]):
+                    self._begin_child(frame, i)
+            elif ch in "{[":
+                self._begin_child(frame, i)
+                self._stack.append([ch, i, None, None, ch == "{"])
+            elif ch in "}]":
+                if (ch == "}") != (frame[0] == "{"):
+                    self.failed = True
+                    break
+                self._complete_child(i, events)
+                if self.failed:
+                    break
+                self._stack.pop()
+                if not self._stack:
+                    self.root = self._top
+                    self.done = True
+                    i += 1
+                    break
+            elif ch == ",":
+                self._complete_child(i, events)
+                if self.failed:
+                    break
+                if frame[0] == "{":
+                    frame[4] = True
+                else:
+                    frame[2] = (frame[2] or 0) + 1
+            elif ch == ":":
+                if frame[0] == "{":
+                    frame[4] = False
+            elif not ch.isspace():
+                self._begin_child(frame, i)
+            i += 1
+        self.pos = i
+        return events
+    def result(self, expected: Optional[type] = None) -> Optional[Any]:
+        """
+        Parsed root if complete (and of the `expected` type); otherwise the usual tolerant
+        parse of the whole buffer, e.g. when a '[' or '{' in leading prose became the root.
+        """
+        if self.done and (expected is None or isinstance(self.root, expected)):
+            return self.root
+        return _try_json_loads(self.buffer)
+async def _iter_completion_stream(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.35,
+) -> AsyncGenerator[str, None]:
+    """
+    Streamed text from the fallback chain for structured (JSON) prompts.
+    Providers are tried in order until one yields a first piece; a failure after
+    that is raised, since a partially parsed object cannot be spliced.
+    """
+    client = AsyncClient()
+    last_error: Optional[str] = None
+    for entry in FALLBACK_CHAIN:
+        model, provider_label = _parse_entry(entry)
+        can_use, skip_reason, provider_kwargs = _provider_requirements(provider_label)
+        if not can_use:
+            last_error = skip_reason
+            continue
+        if not _LLM_GOVERNOR.try_acquire_provider(entry):
+            last_error = f"{entry} saturated"
+            continue
+        kwargs: Dict[str, Any] = {"model": model, "messages": messages, "temperature": temperature}
+        resolved_provider = _resolve_provider(provider_label)
+        if resolved_provider:
+            kwargs["provider"] = resolved_provider
+        if provider_kwargs:
+            kwargs.update(provider_kwargs)
+        produced = False
+        try:
+            loop = asyncio.get_event_loop()
+            stream = await asyncio.wait_for(
+                loop.run_in_executor(None, lambda: client.chat.completions.stream(**kwargs)),
+                timeout=STREAM_INIT_TIMEOUT,
+            )
+            agen = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(agen.__anext__(), timeout=PER_ATTEMPT_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                piece = _normalize_token_piece(_extract_text_piece(chunk))
+                if piece:
+                    produced = True
+                    yield piece
+        except Exception as exc:  # noqa: BLE001
+            if produced:
+                raise
+            last_error = repr(exc)
+            log.warning("Structured stream attempt failed for %s: %s", entry, exc)
+            continue
+        finally:
+            _LLM_GOVERNOR.release_provider(entry)
+        if produced:
+            return
+        last_error = f"{entry} returned no text"
+    raise RuntimeError(f"all providers failed to stream text: {last_error}")
+async def _stream_structured_completion(
+    messages: List[Dict[str, str]],
+    temperature: float,
+    item_builders: Dict[str, Any],
+    finalize: Any,
+    request: Request,
+    ticket: int,
+) -> AsyncGenerator[bytes, None]:
+    """
+    SSE stream for a structured completion:
+      partial  {"key", "index", "item"}  – each array item under a key in item_builders,
+                                            validated by its builder as soon as it closes
+      field    {"key", "value"}          – every other top-level key once complete
+      result   <final response model>    – finalize(parsed, raw_text) -> BaseModel (or awaitable)
+      done
+    `ticket` comes from _admit_stream_or_429 before the response starts and is released here.
+    """
+    parser = _IncrementalJSONParser(max_depth=2)
+    started = time.time()
+    try:
+        async for piece in _iter_completion_stream(messages, temperature=temperature):
+            if await request.is_disconnected():
+                return
+            for path, value in parser.feed(piece):
+                key = path[0]
+                if len(path) == 2 and key in item_builders:
+                    try:
+                        item = item_builders[key](value)
+                    except (ValidationError, TypeError, ValueError) as exc:
+                        yield _sse_event("warn", json.dumps({"key": key, "index": path[1], "error": str(exc)[:200]}))
+                        continue
+                    yield _sse_event("partial", json.dumps({"key": key, "index": path[1], "item": item}, ensure_ascii=False, default=str))
+                elif len(path) == 1 and key not in item_builders:
+                    yield _sse_event("field", json.dumps({"key": key, "value": value}, ensure_ascii=False, default=str))
+        parsed = parser.result(dict)
+        candidates = [parsed]
+        if parser.done and parsed is parser.root:
+            # ریشهٔ incremental ممکن است از پرانتزی در متن قبل از JSON شروع شده باشد
+            candidates.append(_try_json_loads(parser.buffer))
+        candidates = [candidate for candidate in candidates if candidate is not None]
+        if not candidates:
+            yield _sse_event("error", json.dumps({"message": "invalid json", "detail": "پاسخ مدل JSON معتبر نداد."}))
+            yield _sse_event("done", json.dumps({"reason": "invalid_json"}))
+            return
+        final = None
+        error: Optional[Exception] = None
+        for candidate in candidates:
+            try:
+                final = finalize(candidate, parser.buffer)
+                if inspect.isawaitable(final):
+                    final = await final
+                break
+            except (ValidationError, TypeError, ValueError) as exc:
+                error = exc
+        if final is None:
+            yield _sse_event("error", json.dumps({"message": "invalid structure", "detail": str(error)[:200]}))
+            yield _sse_event("done", json.dumps({"reason": "invalid_structure"}))
+            return
+        yield _sse_event("result", json.dumps(final.dict(), ensure_ascii=False, default=str))
+        yield _sse_event("done", json.dumps({"latency_ms": int((time.time() - started) * 1000)}))
+    except Exception as exc:  # noqa: BLE001
+        log.error("Structured stream failed: %s", exc)
+        yield _sse_event("error", json.dumps({"message": "stream failed", "detail": str(exc)[:200]}))
+        yield _sse_event("done", json.dumps({"reason": "failed_fallback"}))
+    finally:
+        _LLM_GOVERNOR.release(ticket)
+async def _admit_stream_or_429(user_key: str) -> int:
+    """Admit a stream before its StreamingResponse starts, so saturation is a real 429."""
+    try:
+        return await _LLM_GOVERNOR.admit(user_key, "stream")
+    except LLMSaturatedError as exc:
+        raise _saturated_http_error(exc) from exc
+async def _sse_result_only(result: BaseModel, reason: str) -> AsyncGenerator[bytes, None]:
+    yield _sse_event("result", json.dumps(result.dict(), ensure_ascii=False, default=str))
+    yield _sse_event("done", json.dumps({"reason": reason}))
+def _sse_response(gen: AsyncGenerator[bytes, None]) -> StreamingResponse:
+    return StreamingResponse(
+        gen,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+# ═══════════════════════════════════════════════════════════════════
+# GOAL TRACKING HELPER FUNCTIONS
+# ═══════════════════════════════════════════════════════════════════
+async def _update_goal_progress_auto(user_id: int, goal_id: int) -> int:
+    """Auto-update goal progress based on linked tasks and habits"""
+    async with async_session() as session:
+        goal = await session.get(UserGoal, goal_id)
+        if not goal or not goal.auto_progress_enabled:
+            return goal.progress_percentage if goal else 0
+        
+        # Get linked task completion percentage
+        task_ids = goal.linked_task_ids or []
+        habit_ids = goal.linked_habit_ids or []
+        
+        total_progress = 0
+        weight_sum = 0
+        
+        if task_ids:
+            stmt = select(UserTask).where(UserTask.task_id.in_(task_ids))
+            result = await session.execute(stmt)
+            tasks = result.scalars().all()
+            
+            completed_tasks = sum(1 for t in tasks if t.status == "completed")
+            if tasks:
+                task_progress = (completed_tasks / len(tasks)) * 100 * 0.6  # 60% weight
+                total_progress += task_progress
+                weight_sum += 0.6
+        
+        if habit_ids:
+            stmt = select(Habit).where(Habit.habit_id.in_(habit_ids))
+            result = await session.execute(stmt)
+            habits = result.scalars().all()
+            
+            # Get recent habit logs
+            today = datetime.utcnow().date()
+            habit_progress = 0
+            if habits:
+                for habit in habits:
+                    log_stmt = select(HabitLog).where(
+                        HabitLog.habit_id == habit.id,
+                        HabitLog.logged_date == today
+                    )
+                    log_result = await session.execute(log_stmt)
+                    has_log = log_result.scalar_one_or_none() is not None
+                    if has_log:
+                        habit_progress += (1 / len(habits)) * 100 * 0.4  # 40% weight
+                total_progress += habit_progress
+                weight_sum += 0.4
+        
+        new_progress = int(total_progress / weight_sum) if weight_sum > 0 else goal.progress_percentage
+        new_progress = min(100, max(0, new_progress))
+        
+        if new_progress != goal.progress_percentage:
+            # Log the change
+            log_entry = GoalProgressLog(
+                goal_id=goal_id,
+                user_id=user_id,
+                old_progress=goal.progress_percentage,
+                new_progress=new_progress,
+                reason="auto_update"
+            )
+            session.add(log_entry)
+            
+            goal.progress_percentage = new_progress
+            goal.last_auto_update = datetime.utcnow()
             await session.commit()
         
         return new_progress
@@ -3206,6 +4441,7 @@ async def _search_memories(user_id: int, query: Optional[str], limit: int = 5) -
         stmt = stmt.order_by(AIMemory.created_at.desc()).limit(max(1, min(limit, 50)))
         result = await session.execute(stmt)
         return result.scalars().all()
+@_single_flight("image_prompt")
 async def _enhance_image_prompt(prompt: str, size: Optional[str] = None) -> str:
     """
     Upgrade a user image prompt for better visual outputs by first hitting a text model.
@@ -3288,6 +4524,7 @@ async def _stream_attempt(
     """Stream a single provider attempt using the AsyncClient interface."""
     stream_client = client or AsyncClient()
     start = time.time()
+    metric_entry = f"{model}@{provider_label}"
     request_messages = [m.dict() for m in messages]
     kwargs = {"model": model, "messages": request_messages}
     if provider:
@@ -3321,6 +4558,7 @@ async def _stream_attempt(
         )
     except asyncio.TimeoutError:
         log.error("Stream initialization timed out after %s seconds", STREAM_INIT_TIMEOUT)
+        M_STREAM_ATTEMPTS.inc(metric_entry, "init_timeout")
         yield _sse_event("error", json.dumps({
             "message": "stream initialization timeout",
             "detail": f"سرور برای شروع stream بیش از {STREAM_INIT_TIMEOUT} ثانیه زمان لازم داشت"
@@ -3329,6 +4567,7 @@ async def _stream_attempt(
         return
     except Exception as init_err:
         log.error("Failed to initialize stream: %s", init_err)
+        M_STREAM_ATTEMPTS.inc(metric_entry, "init_error")
         yield _sse_event("error", json.dumps({
             "message": "stream initialization failed",
             "detail": str(init_err)[:200]
@@ -3337,6 +4576,7 @@ async def _stream_attempt(
         return
     if stream is None:
         log.error("Stream object is None after initialization")
+        M_STREAM_ATTEMPTS.inc(metric_entry, "init_error")
         yield _sse_event("error", json.dumps({
             "message": "stream object is None",
             "detail": "stream initialization returned None"
@@ -3347,6 +4587,7 @@ async def _stream_attempt(
         agen = stream.__aiter__()
     except Exception as iter_err:
         log.error("Failed to get stream iterator: %s", iter_err)
+        M_STREAM_ATTEMPTS.inc(metric_entry, "init_error")
         yield _sse_event("error", json.dumps({
             "message": "stream iterator initialization failed",
             "detail": str(iter_err)[:200]
@@ -3355,6 +4596,8 @@ async def _stream_attempt(
         return
     last_ping = start
     collected_chunks: List[str] = []
+    first_token_at: Optional[float] = None
+    outcome = "cancelled"
     try:
         # ارسال typing indicator برای generating
         yield _sse_event("typing", json.dumps({
@@ -3369,18 +4612,32 @@ async def _stream_attempt(
                 break
             if await request.is_disconnected():
                 log.info("Client disconnected; aborting stream.")
+                outcome = "disconnected"
                 return
             text_piece = _normalize_token_piece(_extract_text_piece(chunk))
             if text_piece:
+                if first_token_at is None:
+                    first_token_at = time.time()
+                    M_STREAM_TTFT.observe(first_token_at - start, metric_entry)
                 collected_chunks.append(text_piece)
                 yield _sse_event("token", json.dumps({"text": text_piece}))
             now = time.time()
             if now - last_ping >= STREAM_PING_EVERY:
                 last_ping = now
                 yield _sse_event("ping", json.dumps({"t": int(now)}))
+        outcome = "ok" if collected_chunks else "empty"
     except asyncio.TimeoutError:
+        outcome = "timeout"
+        raise
+    except Exception:
+        outcome = "error"
         raise
     finally:
+        M_STREAM_ATTEMPTS.inc(metric_entry, outcome)
+        if first_token_at is not None and len(collected_chunks) > 1:
+            elapsed = time.time() - first_token_at
+            if elapsed > 0:
+                M_STREAM_TOKENS_PER_SEC.observe((len(collected_chunks) - 1) / elapsed, metric_entry)
         close_callable = getattr(stream, "aclose", None) or getattr(agen, "aclose", None)
         if callable(close_callable):
             try:
@@ -3405,6 +4662,91 @@ async def _stream_attempt(
         ]
     
     yield _sse_event("done", json.dumps(done_payload))
+_PROVIDER_TTFT: Dict[str, Deque[float]] = {}
+def _record_provider_ttft(entry: str, seconds: float) -> None:
+    samples = _PROVIDER_TTFT.get(entry)
+    if samples is None:
+        samples = deque(maxlen=STREAM_HEDGE_TTFT_SAMPLES)
+        _PROVIDER_TTFT[entry] = samples
+    samples.append(seconds)
+def _hedge_delay_for(entry: str) -> float:
+    """
+    Adaptive hedge threshold: 1.5x the observed p90 time-to-first-token of this
+    model@provider, clamped to [STREAM_HEDGE_MIN_DELAY, STREAM_HEDGE_MAX_DELAY].
+    """
+    samples = _PROVIDER_TTFT.get(entry)
+    if not samples or len(samples) < 5:
+        return STREAM_HEDGE_DEFAULT_DELAY
+    ordered = sorted(samples)
+    p90 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+    return min(STREAM_HEDGE_MAX_DELAY, max(STREAM_HEDGE_MIN_DELAY, p90 * 1.5))
+def _sse_event_name(chunk: bytes) -> str:
+    if not chunk.startswith(b"event: "):
+        return ""
+    end = chunk.find(b"\n")
+    return chunk[7:end if end != -1 else None].decode("utf-8", errors="ignore")
+def _sse_event_data(chunk: bytes) -> Dict[str, Any]:
+    try:
+        data = json.loads(chunk.decode("utf-8").split("data:", 1)[1].strip())
+    except Exception:  # noqa: BLE001
+        return {}
+    return data if isinstance(data, dict) else {}
+def _continuation_messages(messages: List[Message], prefix: str) -> List[Message]:
+    """Conversation for resuming a cut-off reply: the emitted text as an assistant prefix."""
+    return list(messages) + [
+        Message(role="assistant", content=prefix),
+        Message(role="user", content=STREAM_CONTINUATION_PROMPT),
+    ]
+def _splice_continuation(prefix: str, buffered: str, final: bool, min_overlap: int = 8) -> Optional[str]:
+    """
+    Drop whatever the continuing provider repeated from `prefix`. Returns None while
+    more text is needed to decide (the head of the continuation may still turn out
+    to be a restart of the answer).
+    """
+    if not final:
+        if len(buffered) < STREAM_CONTINUATION_OVERLAP_WINDOW:
+            return None
+        if len(buffered) <= len(prefix) and prefix.startswith(buffered):
+            return None
+    if prefix and buffered.startswith(prefix):
+        return buffered[len(prefix):]
+    if len(buffered) >= min_overlap and prefix.startswith(buffered):
+        return ""
+    for size in range(min(len(prefix), len(buffered)), min_overlap - 1, -1):
+        if prefix.endswith(buffered[:size]):
+            return buffered[size:]
+    return buffered
+class _StreamLane:
+    """One in-flight provider attempt feeding the shared race queue."""
+    def __init__(self, attempt: int, entry: str, model: str, provider: Optional[str]):
+        self.attempt = attempt
+        self.entry = entry
+        self.model = model
+        self.provider = provider
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.traced = False
+        self.task: Optional[asyncio.Task] = None
+        self.error_detail: Optional[str] = None
+        # فقط برای laneهایی که ادامهٔ یک پاسخ قطع‌شده را می‌نویسند
+        self.continuation_prefix: Optional[str] = None
+        self.continuation_buffer = ""
+async def _pump_stream_lane(lane: _StreamLane, agen: AsyncGenerator[bytes, None], queue: asyncio.Queue) -> None:
+    """Forward every event of a lane into the queue as (lane, chunk, exc, finished)."""
+    try:
+        async for ev in agen:
+            await queue.put((lane, ev, None, False))
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:  # noqa: BLE001
+        await queue.put((lane, None, exc, True))
+        return
+    finally:
+        try:
+            await agen.aclose()
+        except Exception:
+            pass
+    await queue.put((lane, None, None, True))
 async def _fallback_stream(
     messages: List[Message],
     request: Request,
@@ -3412,79 +4754,284 @@ async def _fallback_stream(
     sources: Optional[List[Dict[str, Any]]] = None,
     image_payload: Optional[Tuple[bytes, str]] = None,
 ) -> AsyncGenerator[bytes, None]:
+    """
+    Stream from the fallback chain. The top provider starts alone; if it has not
+    produced a token within its adaptive hedge delay, the next provider is started
+    in parallel (up to STREAM_HEDGE_MAX_LANES). The first lane to emit a token wins
+    and the others are cancelled. With hedging disabled this degrades to the plain
+    sequential fallback.
+
+    If the committed provider dies mid-reply, the next one is asked to continue from
+    the text already sent (as an assistant prefix); only the continuation is streamed
+    and the splice points are reported in the final `done` payload.
+    """
     client = AsyncClient()
     last_error: Optional[str] = None
-
-    for idx, entry in enumerate(FALLBACK_CHAIN, start=1):
-        model, provider = _parse_entry(entry)
-        resolved_provider = _resolve_provider(provider)
-        can_use, skip_reason, provider_kwargs = _provider_requirements(provider)
-
-        yield _sse_event(
-            "meta",
-            json.dumps({"attempt": idx, "model": model, "provider": provider}),
-        )
-
-        if not can_use:
-            last_error = skip_reason
-            yield _sse_event(
-                "warn",
-                json.dumps(
-                    {
+    queue: asyncio.Queue = asyncio.Queue()
+    pending_entries = list(enumerate(FALLBACK_CHAIN, start=1))
+    lanes: List[_StreamLane] = []
+    committed: Optional[_StreamLane] = None
+    typing_sent: set[bytes] = set()
+    hedged = False
+    emitted_parts: List[str] = []
+    splices: List[Dict[str, Any]] = []
+    continuation_prefix: Optional[str] = None
+    trace = _CURRENT_TRACE.get()
+
+    def _trace_lane(lane: _StreamLane, outcome: str) -> None:
+        if trace is None or lane.traced:
+            return
+        lane.traced = True
+        attrs: Dict[str, Any] = {"attempt": lane.attempt, "entry": lane.entry, "outcome": outcome}
+        if lane.first_token_at is not None:
+            attrs["ttft_ms"] = round((lane.first_token_at - lane.started_at) * 1000, 1)
+        if lane.continuation_prefix is not None or lane.continuation_buffer:
+            attrs["continuation"] = True
+        trace.add_span("provider_attempt", lane.started_at, time.perf_counter(), **attrs)
+
+    def _start_next_lane(speculative: bool) -> List[bytes]:
+        """Start the next usable provider; returns the SSE events to emit."""
+        nonlocal last_error
+        events: List[bytes] = []
+        while pending_entries:
+            idx, entry = pending_entries.pop(0)
+            model, provider = _parse_entry(entry)
+            can_use, skip_reason, provider_kwargs = _provider_requirements(provider)
+            meta: Dict[str, Any] = {"attempt": idx, "model": model, "provider": provider}
+            if speculative:
+                meta["speculative"] = True
+            events.append(_sse_event("meta", json.dumps(meta)))
+            if not can_use:
+                last_error = skip_reason
+                events.append(_sse_event(
+                    "warn",
+                    json.dumps({
                         "attempt": idx,
                         "error": "skipped",
                         "detail": skip_reason,
                         "model": model,
                         "provider": provider,
-                    }
-                ),
-            )
-            continue
-
-        if await request.is_disconnected():
-            log.info("Client disconnected; aborting stream.")
-            return
-
-        try:
+                    }),
+                ))
+                continue
+            if not _LLM_GOVERNOR.try_acquire_provider(entry):
+                last_error = f"{entry} saturated"
+                events.append(_sse_event(
+                    "warn",
+                    json.dumps({
+                        "attempt": idx,
+                        "error": "saturated",
+                        "detail": "provider concurrency budget reached",
+                        "model": model,
+                        "provider": provider,
+                    }),
+                ))
+                continue
+            lane = _StreamLane(idx, entry, model, provider)
+            lane_messages = messages
+            if continuation_prefix:
+                lane.continuation_prefix = continuation_prefix
+                lane_messages = _continuation_messages(messages, continuation_prefix)
             agen = _stream_attempt(
                 client,
                 model,
-                resolved_provider,
+                _resolve_provider(provider),
                 provider,
-                messages,
+                lane_messages,
                 request,
                 web_search,
                 sources,
                 provider_kwargs,
                 image_payload,
             )
+            lane.task = asyncio.create_task(_pump_stream_lane(lane, agen, queue))
+            # release حتی اگر task پیش از شروع cancel شود
+            lane.task.add_done_callback(lambda _task, held=entry: _LLM_GOVERNOR.release_provider(held))
+            lanes.append(lane)
+            break
+        return events
+
+    def _lane_warn(lane: _StreamLane, error: str, detail: Optional[str]) -> bytes:
+        return _sse_event(
+            "warn",
+            json.dumps({
+                "attempt": lane.attempt,
+                "error": error,
+                "detail": (detail or "")[:200],
+                "model": lane.model,
+                "provider": lane.provider,
+            }),
+        )
 
-            async for ev in agen:
-                yield ev
-
-            # اگر استریم provider بدون خطا تموم شد، دیگه سراغ بعدی نرو
-            return
+    def _release_continuation(lane: _StreamLane, final: bool) -> List[bytes]:
+        released = _splice_continuation(lane.continuation_prefix or "", lane.continuation_buffer, final)
+        if released is None:
+            return []
+        lane.continuation_prefix = None
+        lane.continuation_buffer = ""
+        if not released:
+            return []
+        emitted_parts.append(released)
+        return [_sse_event("token", json.dumps({"text": released}))]
+
+    def _forward_committed(lane: _StreamLane, chunk: bytes, name: str) -> List[bytes]:
+        if name == "token":
+            text_piece = _sse_event_data(chunk).get("text") or ""
+            if lane.continuation_prefix is None:
+                emitted_parts.append(text_piece)
+                return [chunk]
+            lane.continuation_buffer += text_piece
+            return _release_continuation(lane, final=False)
+        if name == "done":
+            events = _release_continuation(lane, final=True) if lane.continuation_prefix is not None else []
+            if splices or trace is not None:
+                payload = _sse_event_data(chunk)
+                if splices:
+                    payload["text"] = "".join(emitted_parts)
+                    payload["splices"] = splices
+                if trace is not None:
+                    _trace_lane(lane, "ok")
+                    payload["trace"] = trace.to_payload()
+                chunk = _sse_event("done", json.dumps(payload))
+            return events + [chunk]
+        return [chunk]
 
-        except Exception as e:
-            last_error = repr(e)
-            log.exception("Attempt %d failed for %s@%s: %s", idx, model, provider, e)
-            yield _sse_event(
-                "warn",
-                json.dumps(
-                    {
-                        "attempt": idx,
-                        "error": "exception",
-                        "detail": str(e)[:200],
-                        "model": model,
-                        "provider": provider,
-                    }
-                ),
+    try:
+        while True:
+            if not lanes:
+                if not pending_entries:
+                    break
+                if await request.is_disconnected():
+                    log.info("Client disconnected; aborting stream.")
+                    return
+                for ev in _start_next_lane(speculative=False):
+                    yield ev
+                if not lanes:
+                    break
+            timeout: Optional[float] = None
+            can_hedge = (
+                STREAM_HEDGE_ENABLED
+                and committed is None
+                and pending_entries
+                and len(lanes) < STREAM_HEDGE_MAX_LANES
             )
-            await asyncio.sleep(min(2.0, 0.25 * idx))
-
+            if can_hedge:
+                newest = lanes[-1]
+                deadline = newest.started_at + _hedge_delay_for(newest.entry)
+                timeout = max(0.0, deadline - time.perf_counter())
+            try:
+                lane, chunk, exc, finished = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                log.info(
+                    "No first token from %s after %.1fs; hedging with next provider.",
+                    lanes[-1].entry,
+                    time.perf_counter() - lanes[-1].started_at,
+                )
+                hedged = True
+                M_FALLBACK_EVENTS.inc("hedge")
+                for ev in _start_next_lane(speculative=True):
+                    yield ev
+                continue
+            if lane not in lanes:
+                continue  # late event from a cancelled loser
+            if finished:
+                lanes.remove(lane)
+                if lane is committed:
+                    if exc is None:
+                        _trace_lane(lane, "ok")
+                        return
+                    _trace_lane(lane, "failed_midstream")
+                    last_error = repr(exc)
+                    log.warning("Attempt %d failed mid-stream for %s: %s", lane.attempt, lane.entry, exc)
+                    yield _lane_warn(lane, "exception", str(exc))
+                    committed = None
+                    prefix = "".join(emitted_parts)
+                    if STREAM_CONTINUATION_ENABLED and prefix:
+                        M_FALLBACK_EVENTS.inc("continuation")
+                        continuation_prefix = prefix
+                        splices.append({
+                            "at": len(prefix),
+                            "from_attempt": lane.attempt,
+                            "from_model": lane.model,
+                            "from_provider": lane.provider,
+                            "error": str(exc)[:200],
+                        })
+                    else:
+                        emitted_parts.clear()
+                    await asyncio.sleep(min(2.0, 0.25 * lane.attempt))
+                    continue
+                if exc is not None:
+                    _trace_lane(lane, "exception")
+                    last_error = repr(exc)
+                    log.warning("Attempt %d failed for %s: %s", lane.attempt, lane.entry, exc)
+                    yield _lane_warn(lane, "exception", str(exc))
+                else:
+                    _trace_lane(lane, "no_tokens")
+                    last_error = lane.error_detail or "stream ended without tokens"
+                    yield _lane_warn(lane, "no_tokens", last_error)
+                if not lanes:
+                    await asyncio.sleep(min(2.0, 0.25 * lane.attempt))
+                continue
+            name = _sse_event_name(chunk)
+            if committed is not None:
+                if lane is committed:
+                    for ev in _forward_committed(lane, chunk, name):
+                        yield ev
+                continue
+            if name == "token":
+                committed = lane
+                lane.first_token_at = time.perf_counter()
+                _record_provider_ttft(lane.entry, lane.first_token_at - lane.started_at)
+                M_FALLBACK_DEPTH.observe(lane.attempt, "stream")
+                if trace is not None:
+                    trace.mark("first_token", attempt=lane.attempt, entry=lane.entry)
+                for other in list(lanes):
+                    if other is not lane and other.task is not None:
+                        other.task.cancel()
+                        lanes.remove(other)
+                        _trace_lane(other, "cancelled")
+                if lane.continuation_prefix is not None and splices:
+                    splices[-1].update({
+                        "to_attempt": lane.attempt,
+                        "to_model": lane.model,
+                        "to_provider": lane.provider,
+                    })
+                if hedged or lane.continuation_prefix is not None:
+                    commit_meta: Dict[str, Any] = {
+                        "attempt": lane.attempt,
+                        "model": lane.model,
+                        "provider": lane.provider,
+                        "committed": True,
+                    }
+                    if lane.continuation_prefix is not None:
+                        commit_meta["continuation"] = True
+                    yield _sse_event("meta", json.dumps(commit_meta))
+                for ev in _forward_committed(lane, chunk, name):
+                    yield ev
+            elif name == "typing":
+                if chunk not in typing_sent:
+                    typing_sent.add(chunk)
+                    yield chunk
+            elif name == "error":
+                # خطای init این lane؛ فقط برای گزارش نگه می‌داریم و به کلاینت نمی‌فرستیم
+                payload = _sse_event_data(chunk)
+                lane.error_detail = str(payload.get("detail") or payload.get("message") or "stream error")
+    finally:
+        for lane in lanes:
+            _trace_lane(lane, "aborted")
+            if lane.task is not None and not lane.task.done():
+                lane.task.cancel()
+        pending = [lane.task for lane in lanes if lane.task is not None]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    M_FALLBACK_EVENTS.inc("exhausted")
     error_payload = {"message": "all providers failed", "last_error": last_error}
     yield _sse_event("error", json.dumps(error_payload))
-    yield _sse_event("done", json.dumps({"reason": "failed_fallback"}))
+    failed_payload: Dict[str, Any] = {"reason": "failed_fallback"}
+    if trace is not None:
+        failed_payload["trace"] = trace.to_payload()
+    yield _sse_event("done", json.dumps(failed_payload))
 
 @app.post("/tools/web-search", response_model=MCPWebSearchResponse)
 async def tool_web_search(body: MCPWebSearchRequest, current_user: User = Depends(get_current_user)) -> MCPWebSearchResponse:
@@ -3679,6 +5226,7 @@ async def tool_image_generation(
     last_error: Optional[str] = None
     local_error: Optional[str] = None
     # ابتدا سرویس local را امتحان می‌کنیم (سریع‌تر است)
+    started = time.perf_counter()
     try:
         images = await _generate_image_local_service(
             prompt=enhanced_prompt,
@@ -3693,6 +5241,7 @@ async def tool_image_generation(
     except Exception as exc:
         local_error = str(exc)
         log.warning("Local image generator failed: %s", exc)
+    M_IMAGE_SECONDS.observe(time.perf_counter() - started, "local", "ok" if images else "error")
     if images:
         return MCPImageGenerationResponse(
             model="local",
@@ -3704,6 +5253,7 @@ async def tool_image_generation(
     images = []
     # اگر local کار نکرد، به سراغ g4f با بهتری timeout می‌رویم
     for model_name in model_candidates:
+        started = time.perf_counter()
         try:
             images = await _generate_image_g4f(
                 prompt=enhanced_prompt,
@@ -3714,13 +5264,14 @@ async def tool_image_generation(
                 size=body.size,
                 n=body.n,
             )
-            if images:
-                chosen_model = model_name
-                break
         except HTTPException as exc:
             last_error = exc.detail if isinstance(exc.detail, str) else str(exc.detail)
         except Exception as exc:
             last_error = str(exc)
+        M_IMAGE_SECONDS.observe(time.perf_counter() - started, "g4f", "ok" if images else "error")
+        if images:
+            chosen_model = model_name
+            break
     if not images:
         detail = last_error or local_error or "تولید تصویر موفق نبود. لطفاً دوباره امتحان کنید."
         raise HTTPException(status_code=502, detail=detail)
@@ -3877,14 +5428,34 @@ async def _run_chat_stream_core(
     incoming_messages: List[Message],
     image_payload: Optional[Tuple[bytes, str]],
 ) -> StreamingResponse:
-    session_id = body.session_id
-
     # دیگر نیازی به file_urls بعد از ingest نداریم
     body.file_urls = None
 
+    try:
+        admission_ticket = await _LLM_GOVERNOR.admit(str(current_user.id), "stream")
+    except LLMSaturatedError as exc:
+        raise _saturated_http_error(exc) from exc
+    try:
+        return await _build_chat_stream_response(req, body, incoming_messages, image_payload, admission_ticket)
+    except BaseException:
+        _LLM_GOVERNOR.release(admission_ticket)
+        raise
+async def _build_chat_stream_response(
+    req: Request,
+    body: ChatRequest,
+    incoming_messages: List[Message],
+    image_payload: Optional[Tuple[bytes, str]],
+    admission_ticket: int,
+) -> StreamingResponse:
+    session_id = body.session_id
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.deferred = True
+
     # build history + current messages
-    combined_messages = await _combined_session_messages(session_id, incoming_messages)
-    combined_messages = _apply_request_context_budget(combined_messages)
+    with _trace_span("session_load", messages=len(incoming_messages)):
+        combined_messages = await _combined_session_messages(session_id, incoming_messages)
+        combined_messages = _apply_request_context_budget(combined_messages)
 
     # expert domain system prompt
     expert_prompt = _get_expert_system_prompt(body.expert_domain)
@@ -3899,12 +5470,16 @@ async def _run_chat_stream_core(
         # برای expert domains همیشه web_search فعال کن
         body.web_search = True
 
-    messages_for_stream, search_sources, provider_web_search = await _prepare_messages_with_search(
-        combined_messages,
-        body.web_search,
-    )
+    with _trace_span("web_search", enabled=bool(body.web_search)) as search_attrs:
+        messages_for_stream, search_sources, provider_web_search = await _prepare_messages_with_search(
+            combined_messages,
+            body.web_search,
+        )
+        search_attrs["sources"] = len(search_sources or [])
 
     async def event_gen():
+        if trace is not None:
+            _CURRENT_TRACE.set(trace)
         assistant_chunks: List[str] = []
         agen = _fallback_stream(
             messages_for_stream,
@@ -3986,6 +5561,7 @@ async def _run_chat_stream_core(
             )
             yield _sse_event("done", json.dumps({"reason": "internal"}))
         finally:
+            _LLM_GOVERNOR.release(admission_ticket)
             # سعی کن generator را ببندی
             try:
                 await agen.aclose()
@@ -4001,6 +5577,8 @@ async def _run_chat_stream_core(
                 await _store_session_messages(session_id, incoming_messages, assistant_text)
             except Exception as e:
                 log.error("Failed to store session messages: %s", e)
+            if trace is not None:
+                trace.log(status=200, stream=True, chars=len(assistant_text or ""))
 
     return StreamingResponse(
         event_gen(),
@@ -4261,7 +5839,13 @@ async def create_content_calendar(body: ContentCalendarRequest, current_user: Us
 @app.post("/research/deep", response_model=DeepResearchResponse)
 async def run_deep_research(body: DeepResearchRequest, current_user: User = Depends(get_current_user)):
     raw_text, google_sources = await _run_deep_research(body)
-    parsed = _try_json_loads(raw_text)
+    return _build_deep_research_response(body, _try_json_loads(raw_text), raw_text, google_sources)
+def _build_deep_research_response(
+    body: DeepResearchRequest,
+    parsed: Any,
+    raw_text: str,
+    google_sources: Optional[List[Dict[str, Any]]],
+) -> DeepResearchResponse:
     summary, sections, outline, ai_sources = _ensure_research_payload(parsed, raw_text)
     if not body.include_outline:
         outline = None
@@ -4275,6 +5859,26 @@ async def run_deep_research(body: DeepResearchRequest, current_user: User = Depe
         sources=merged_sources,
         raw_text=raw_text,
     )
+@app.post("/research/deep/stream")
+async def run_deep_research_stream(req: Request, body: DeepResearchRequest, current_user: User = Depends(get_current_user)):
+    """
+    نسخهٔ SSE از /research/deep: هر section به محض کامل شدن در JSON مدل
+    به صورت event «partial» ارسال می‌شود و در پایان DeepResearchResponse کامل در «result».
+    """
+    messages, google_sources = await _deep_research_messages(body)
+
+    def _section_item(value: Any) -> Dict[str, Any]:
+        return _ensure_research_payload({"sections": [value]}, "")[1][0].dict()
+
+    ticket = await _admit_stream_or_429(str(current_user.id))
+    return _sse_response(_stream_structured_completion(
+        messages,
+        temperature=0.35,
+        item_builders={"sections": _section_item},
+        finalize=lambda parsed, raw_text: _build_deep_research_response(body, parsed, raw_text, google_sources),
+        request=req,
+        ticket=ticket,
+    ))
 # ============================================================================
 # Smart Assistant Endpoints (NLP reminders, phone actions, modes, notification intel)
 # ============================================================================
@@ -4319,24 +5923,44 @@ async def parse_smart_intent(body: SmartIntentRequest, current_user: User = Depe
     if not isinstance(payload, dict):
         payload = {"value": payload}
     return SmartIntentResponse(action=action, payload=payload, raw_text=raw_text)
-@app.post("/assistant/daily-briefing", response_model=GenericAIResponse)
-async def daily_briefing(body: DailyBriefingRequest, current_user: User = Depends(get_current_user)):
-    system_prompt = (
-        "تو یک منشی شخصی هستی. فقط JSON بده با کلیدهای "
-        '{"briefing": str, "highlights": [], "next_actions": [], "reminders": [], "tone": "friendly"}. '
-        "خلاصه را کوتاه و عملی بنویس. پیشنهاد اولویت را در next_actions بده."
-    )
-    user_prompt = (
+DAILY_BRIEFING_SYSTEM_PROMPT = (
+    "تو یک منشی شخصی هستی. فقط JSON بده با کلیدهای "
+    '{"briefing": str, "highlights": [], "next_actions": [], "reminders": [], "tone": "friendly"}. '
+    "خلاصه را کوتاه و عملی بنویس. پیشنهاد اولویت را در next_actions بده."
+)
+def _user_context_line(context: Optional["_UserContext"]) -> str:
+    """Server-side snapshot of the user as one prompt line (empty when not available)."""
+    return f"وضعیت کاربر: {context.prompt()}\n" if context is not None else ""
+def _daily_briefing_prompt(body: DailyBriefingRequest, context: Optional["_UserContext"] = None) -> str:
+    return (
         f"زمان: {body.now or 'نامشخص'} ({body.timezone or 'Asia/Tehran'})\n"
+        f"{_user_context_line(context)}"
         f"تسک‌ها: {_to_json(body.tasks) if body.tasks else '[]'}\n"
         f"پیام‌های مهم: {_to_json(body.messages) if body.messages else '[]'}\n"
         f"انرژی: {body.energy or 'نامشخص'} | خواب: {body.sleep or 'نامشخص'}\n"
         f"کانتکست: {_to_json(body.context) if body.context else '{}'}\n"
         "یک daily briefing کوتاه بده."
     )
-    parsed, raw_text = await _run_structured_completion(system_prompt, user_prompt, temperature=0.3)
+async def _generate_daily_briefing(
+    body: DailyBriefingRequest, context: Optional["_UserContext"] = None
+) -> Tuple[Dict[str, Any], str]:
+    parsed, raw_text = await _run_structured_completion(
+        DAILY_BRIEFING_SYSTEM_PROMPT, _daily_briefing_prompt(body, context), temperature=0.3
+    )
     if not isinstance(parsed, dict):
         raise HTTPException(status_code=502, detail="خلاصه ساختار JSON ندارد.")
+    return parsed, raw_text
+@app.post("/assistant/daily-briefing", response_model=GenericAIResponse)
+async def daily_briefing(body: DailyBriefingRequest, current_user: User = Depends(get_current_user)):
+    # درخواست بدون دادهٔ سمت کلاینت از خروجی شبانه سرو می‌شود (اگر تسکی از آن به بعد تغییر نکرده باشد)
+    generic = not (body.tasks or body.messages or body.context or body.energy or body.sleep)
+    if generic:
+        cached = await _precomputed_briefing(current_user.id, body.timezone)
+        if cached is not None:
+            M_PREGEN_BRIEFINGS.inc("hit")
+            return GenericAIResponse(payload=cached[0], raw_text=cached[1])
+        M_PREGEN_BRIEFINGS.inc("miss")
+    parsed, raw_text = await _generate_daily_briefing(body, await _user_context(current_user.id))
     return GenericAIResponse(payload=parsed, raw_text=raw_text)
 @app.post("/assistant/next-action", response_model=GenericAIResponse)
 async def next_action(body: NextActionRequest, current_user: User = Depends(get_current_user)):
@@ -4346,6 +5970,7 @@ async def next_action(body: NextActionRequest, current_user: User = Depends(get_
         "بهینه کن بر اساس زمان باقی‌مانده و انرژی کاربر."
     )
     user_prompt = (
+        f"{_user_context_line(await _user_context(current_user.id))}"
         f"زمان در دسترس (دقیقه): {body.available_minutes or 'نامشخص'}\n"
         f"انرژی: {body.energy or 'نامشخص'} | مود: {body.mode or 'نامشخص'}\n"
         f"تسک‌ها: {_to_json(body.tasks) if body.tasks else '[]'}\n"
@@ -4365,6 +5990,7 @@ async def decide_mode(body: SmartIntentRequest, current_user: User = Depends(get
     user_prompt = (
         f"متن کاربر: {body.text}\n"
         f"زمان: {body.now or 'نامشخص'} ({body.timezone or 'Asia/Tehran'})\n"
+        f"{_user_context_line(await _user_context(current_user.id))}"
         f"مود فعلی: {body.mode or 'نامشخص'} | انرژی: {body.energy or 'نامشخص'}\n"
         f"کانتکست: {_to_json(body.context) if body.context else '{}'}"
     )
@@ -4375,78 +6001,138 @@ async def decide_mode(body: SmartIntentRequest, current_user: User = Depends(get
 
 
 
-@app.post(
-    "/notifications/summarize",
-    response_model=NotificationSummary,
-    summary="Generate AI summary of notifications and messages",
-)
-async def summarize_notifications(req: SummarizeRequest) -> NotificationSummary:
-    """
-    این همون اندپوینتیه که Flutter می‌زنه:
-    apiClient.postJson('/user/notifications/summarize', body: {...})
-    و انتظارش اینه که خود NotificationSummary رو در ریشه‌ی JSON بگیره.
-    """
-
-    system_prompt = """
-    You are an AI assistant that summarizes a user's notifications and messages.
-    You MUST return STRICT JSON that matches exactly this schema, with these keys:
+NOTIFICATION_SUMMARY_SYSTEM_PROMPT = """
+You are an AI assistant that summarizes a user's notifications and messages.
+You MUST return STRICT JSON that matches exactly this schema, with these keys:
 
+{
+  "total_notifications": int,
+  "read_count": int,
+  "unread_count": int,
+  "important_messages": [
     {
-      "summary_id": "string",
-      "total_notifications": int,
-      "read_count": int,
-      "unread_count": int,
-      "important_messages": [
-        {
-          "message_id": "string",
-          "sender": "string",
-          "subject": "string",
-          "preview": "string",
-          "importance": "critical|high|medium|low",
-          "keywords": ["string", ...],
-          "received_at": "ISO 8601 datetime string"
-        }
-      ],
-      "critical_alerts": [
-        {
-          "alert_id": "string",
-          "title": "string",
-          "description": "string",
-          "severity": "critical|high|medium",
-          "action": "string or null",
-          "created_at": "ISO 8601 datetime string"
-        }
-      ],
-      "action_items": [
-        {
-          "item_id": "string",
-          "title": "string",
-          "description": "string",
-          "due_date": "YYYY-MM-DD or null",
-          "assignee": "string or null",
-          "priority": "high|medium|low",
-          "source": "string",
-          "completed": true or false
-        }
-      ],
-      "ai_generated_summary": "string or null",
-      "sentiment_score": float,
-      "dominant_topic": "string",
-      "key_people": ["string", ...],
-      "generated_at": "ISO 8601 datetime string"
+      "message_id": "string",
+      "sender": "string",
+      "subject": "string",
+      "preview": "string",
+      "importance": "critical|high|medium|low",
+      "keywords": ["string", ...],
+      "received_at": "ISO 8601 datetime string"
     }
+  ],
+  "critical_alerts": [
+    {
+      "alert_id": "string",
+      "title": "string",
+      "description": "string",
+      "severity": "critical|high|medium",
+      "action": "string or null",
+      "created_at": "ISO 8601 datetime string"
+    }
+  ],
+  "action_items": [
+    {
+      "item_id": "string",
+      "title": "string",
+      "description": "string",
+      "due_date": "YYYY-MM-DD or null",
+      "assignee": "string or null",
+      "priority": "high|medium|low",
+      "source": "string",
+      "completed": true or false
+    }
+  ],
+  "ai_generated_summary": "string or null",
+  "sentiment_score": float,
+  "dominant_topic": "string",
+  "key_people": ["string", ...],
+  "generated_at": "ISO 8601 datetime string"
+}
 
-    Do NOT include any other top-level keys or text.
-    """
-
+Do NOT include any other top-level keys or text.
+"""
+def _notification_summary_user_prompt(req: SummarizeRequest) -> str:
     user_payload = {
         "notifications": req.notifications,
         "messages": req.messages,
         "focus_area": req.focus_area,
         "hours_back": req.hours_back,
     }
-    user_prompt = json.dumps(user_payload, ensure_ascii=False)
+    return json.dumps(user_payload, ensure_ascii=False)
+NOTIF_SUMMARY_WINDOW_HOURS = int(os.getenv("NOTIF_SUMMARY_WINDOW_HOURS", "24"))
+NOTIF_SUMMARY_MAX_LIST_ITEMS = int(os.getenv("NOTIF_SUMMARY_MAX_LIST_ITEMS", "50"))
+NOTIF_SUMMARY_MAX_SEEN_KEYS = int(os.getenv("NOTIF_SUMMARY_MAX_SEEN_KEYS", "5000"))
+
+NOTIFICATION_SUMMARY_UPDATE_SYSTEM_PROMPT = NOTIFICATION_SUMMARY_SYSTEM_PROMPT + """
+The input contains "previous_summary" (what is already summarized) and ONLY the NEW
+notifications/messages that arrived since then.
+- total_notifications, read_count, unread_count, important_messages, critical_alerts,
+  action_items and sentiment_score must describe the NEW items only.
+- ai_generated_summary, dominant_topic and key_people must describe everything
+  (previous_summary plus the new items).
+"""
+
+_SUMMARY_STATE_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _summary_state_lock(user_id: int) -> asyncio.Lock:
+    lock = _SUMMARY_STATE_LOCKS.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _SUMMARY_STATE_LOCKS[user_id] = lock
+    return lock
+
+
+def _summary_item_key(kind: str, item: Any) -> str:
+    if isinstance(item, dict) and item.get("id") is not None:
+        raw = f"{kind}:id:{item['id']}"
+    else:
+        raw = f"{kind}:" + json.dumps(item, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
 
+
+def _merge_summary_items(newer: List[Any], older: List[Any], key_attr: str) -> List[Any]:
+    """Newest first, deduplicated by id (a newer item replaces the older one), capped."""
+    merged: List[Any] = []
+    seen: set = set()
+    for item in list(newer) + list(older):
+        key = getattr(item, key_attr) or getattr(item, "title", "") or getattr(item, "subject", "")
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(item)
+    return merged[:NOTIF_SUMMARY_MAX_LIST_ITEMS]
+
+
+def _merge_notification_summaries(
+    previous: NotificationSummary,
+    delta: NotificationSummary,
+    previous_items: int,
+    new_items: int,
+) -> NotificationSummary:
+    """خلاصهٔ آیتم‌های جدید (delta) را در خلاصهٔ جاری ادغام می‌کند؛ شمارش‌ها جمع و sentiment وزن‌دار."""
+    total_items = previous_items + new_items
+    sentiment = previous.sentiment_score
+    if total_items:
+        sentiment = (previous.sentiment_score * previous_items + delta.sentiment_score * new_items) / total_items
+    key_people = list(dict.fromkeys(list(delta.key_people) + list(previous.key_people)))[:10]
+    return NotificationSummary(
+        summary_id=previous.summary_id,
+        total_notifications=previous.total_notifications + (delta.total_notifications or new_items),
+        read_count=previous.read_count + delta.read_count,
+        unread_count=previous.unread_count + delta.unread_count,
+        important_messages=_merge_summary_items(delta.important_messages, previous.important_messages, "message_id"),
+        critical_alerts=_merge_summary_items(delta.critical_alerts, previous.critical_alerts, "alert_id"),
+        action_items=_merge_summary_items(delta.action_items, previous.action_items, "item_id"),
+        ai_generated_summary=delta.ai_generated_summary or previous.ai_generated_summary,
+        sentiment_score=round(max(-1.0, min(1.0, sentiment)), 3),
+        dominant_topic=delta.dominant_topic or previous.dominant_topic,
+        key_people=key_people,
+        generated_at=datetime.utcnow(),
+    )
+
+
+async def _summarize_with_llm(system_prompt: str, user_prompt: str) -> NotificationSummary:
     parsed, raw_text = await _run_structured_completion(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
@@ -4454,16 +6140,515 @@ async def summarize_notifications(req: SummarizeRequest) -> NotificationSummary:
     )
 
     try:
-        summary = NotificationSummary(**parsed)
+        return NotificationSummary(**parsed)
     except ValidationError as e:
         # مدل JSON معیوب داده
         raise HTTPException(status_code=502, detail=f"ساختار خلاصه نامعتبر است: {e}")
 
-    # TODO: اینجا می‌تونی summary رو تو DB ذخیره کنی
 
+def _notification_summary_update_prompt(
+    previous: NotificationSummary,
+    fresh: List[Tuple[str, Any, str]],
+    req: SummarizeRequest,
+) -> str:
+    user_payload = {
+        "previous_summary": {
+            "total_notifications": previous.total_notifications,
+            "ai_generated_summary": previous.ai_generated_summary,
+            "dominant_topic": previous.dominant_topic,
+            "key_people": previous.key_people,
+            "sentiment_score": previous.sentiment_score,
+        },
+        "notifications": [item for kind, item, _ in fresh if kind == "notification"],
+        "messages": [item for kind, item, _ in fresh if kind == "message"],
+        "focus_area": req.focus_area,
+        "hours_back": req.hours_back,
+    }
+    return json.dumps(user_payload, ensure_ascii=False)
+
+
+class _NotificationSummaryRun:
+    """
+    One summarize call against the stored incremental state: full rebuild when the window
+    (hours_back or NOTIF_SUMMARY_WINDOW_HOURS) ran out or focus_area changed, otherwise only
+    unseen items are sent together with the previous summary and merged back in.
+    """
+    __slots__ = ("user_id", "req", "state", "now", "window_hours", "tagged", "fresh", "previous_keys", "rebuild")
+
+    def __init__(self, user_id: int, req: SummarizeRequest, state: Optional[NotificationSummaryState]) -> None:
+        self.user_id = user_id
+        self.req = req
+        self.state = state
+        self.now = datetime.utcnow()
+        self.window_hours = req.hours_back or NOTIF_SUMMARY_WINDOW_HOURS
+        self.tagged = [("notification", item, _summary_item_key("notification", item)) for item in req.notifications]
+        self.tagged += [("message", item, _summary_item_key("message", item)) for item in req.messages]
+        self.previous_keys = list(state.seen_keys or []) if state else []
+        seen = set(self.previous_keys)
+        self.fresh = [entry for entry in self.tagged if entry[2] not in seen]
+        self.rebuild = (
+            state is None
+            or not state.payload
+            or self.now - state.window_start >= timedelta(hours=self.window_hours)
+            or state.window_hours != self.window_hours
+            or (state.focus_area or None) != (req.focus_area or None)
+        )
+
+    @classmethod
+    async def load(cls, user_id: int, req: SummarizeRequest) -> "_NotificationSummaryRun":
+        async with async_session() as session:
+            result = await session.execute(
+                select(NotificationSummaryState).where(NotificationSummaryState.user_id == user_id)
+            )
+            return cls(user_id, req, result.scalar_one_or_none())
+
+    @property
+    def unchanged(self) -> bool:
+        return not self.rebuild and not self.fresh
+
+    def previous(self) -> NotificationSummary:
+        return NotificationSummary(**self.state.payload)
+
+    def prompts(self) -> Tuple[str, str]:
+        if self.rebuild:
+            return NOTIFICATION_SUMMARY_SYSTEM_PROMPT, _notification_summary_user_prompt(self.req)
+        return (
+            NOTIFICATION_SUMMARY_UPDATE_SYSTEM_PROMPT,
+            _notification_summary_update_prompt(self.previous(), self.fresh, self.req),
+        )
+
+    def complete(self, result: NotificationSummary) -> NotificationSummary:
+        """Model output -> the summary to return (a rebuild as is, a delta merged into the previous one)."""
+        if self.rebuild:
+            # شناسه را سرور می‌دهد؛ شناسهٔ مدل ("string"، "summary_1") خلاصهٔ پنجره‌های قبل را بازنویسی می‌کرد
+            result.summary_id = str(uuid.uuid4())
+            return result
+        return _merge_notification_summaries(self.previous(), result, self.state.item_count or 0, len(self.fresh))
+
+    @staticmethod
+    def _version(state: Optional[NotificationSummaryState]) -> Optional[Tuple[Any, ...]]:
+        if state is None:
+            return None
+        return (state.id, state.window_start, state.item_count, state.seen_keys, state.updated_at)
+
+    async def save_state(self, summary: NotificationSummary) -> bool:
+        """
+        Write the new state unless it moved on since load() (another summarize committed in
+        between); then nothing is written and the next call sees these items as fresh again.
+        Callers hold _summary_state_lock.
+        """
+        if self.rebuild:
+            keys = [key for _, _, key in self.tagged]
+            item_count = len(self.tagged)
+            window_start = self.now
+        else:
+            keys = self.previous_keys + [key for _, _, key in self.fresh]
+            item_count = (self.state.item_count or 0) + len(self.fresh)
+            window_start = self.state.window_start
+        log.info(
+            "Notification summary for user %s: %s with %d new of %d items",
+            self.user_id,
+            "rebuild" if self.rebuild else "incremental",
+            len(self.fresh),
+            len(self.tagged),
+        )
+        # session در طول فراخوانی LLM باز نمی‌ماند؛ state دوباره خوانده و به‌روز می‌شود
+        async with async_session() as session:
+            result = await session.execute(
+                select(NotificationSummaryState).where(NotificationSummaryState.user_id == self.user_id)
+            )
+            state = result.scalar_one_or_none()
+            if self._version(state) != self._version(self.state):
+                log.info("Notification summary state of user %s changed during the call; not saved", self.user_id)
+                return False
+            if state is None:
+                state = NotificationSummaryState(user_id=self.user_id)
+                session.add(state)
+            state.window_start = window_start
+            state.window_hours = self.window_hours
+            state.focus_area = self.req.focus_area
+            state.item_count = item_count
+            state.seen_keys = list(dict.fromkeys(keys))[-NOTIF_SUMMARY_MAX_SEEN_KEYS:]
+            state.payload = json.loads(summary.json())
+            await session.commit()
+        return True
+
+    async def store(self, summary: NotificationSummary) -> None:
+        # فقط آیتم‌های جدید ingest می‌شوند (آیتم‌های بدون id هم تکراری ذخیره نمی‌شوند)
+        items = [_ingest_item_from_dict(item, kind) for kind, item, _ in self.fresh]
+        try:
+            await _ingest_notifications(self.user_id, [item for item in items if item is not None])
+            await _store_notification_summary(self.user_id, summary)
+        except Exception as exc:  # noqa: BLE001
+            log.warning("Persisting notification summary failed for user %s: %s", self.user_id, exc)
+
+
+@app.post(
+    "/notifications/summarize",
+    response_model=NotificationSummary,
+    summary="Generate AI summary of notifications and messages",
+)
+async def summarize_notifications(
+    req: SummarizeRequest,
+    current_user: User = Depends(get_current_user),
+) -> NotificationSummary:
+    """
+    این همون اندپوینتیه که Flutter می‌زنه:
+    apiClient.postJson('/user/notifications/summarize', body: {...})
+    و انتظارش اینه که خود NotificationSummary رو در ریشه‌ی JSON بگیره.
+
+    خلاصه به‌صورت افزایشی نگه داشته می‌شود: فقط آیتم‌هایی که قبلاً دیده نشده‌اند
+    به‌همراه خلاصهٔ قبلی به مدل داده می‌شوند. بازسازی کامل فقط وقتی پنجره
+    (hours_back یا NOTIF_SUMMARY_WINDOW_HOURS) تمام شود یا focus_area عوض شود.
+    """
+    async with _summary_state_lock(current_user.id):
+        run = await _NotificationSummaryRun.load(current_user.id, req)
+        if run.unchanged:
+            return run.previous()
+        system_prompt, user_prompt = run.prompts()
+        summary = run.complete(await _summarize_with_llm(system_prompt, user_prompt))
+        saved = await run.save_state(summary)
+    if saved:
+        await run.store(summary)
     return summary
 
 
+@app.post("/notifications/summarize/stream")
+async def summarize_notifications_stream(
+    req: Request,
+    body: SummarizeRequest,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    نسخهٔ SSE از /notifications/summarize: آیتم‌های important_messages، critical_alerts
+    و action_items هر کدام به محض کامل شدن ارسال می‌شوند (event «partial»)
+    و در پایان NotificationSummary کامل در event «result».
+    همان state افزایشی استفاده می‌شود: در حالت افزایشی partialها مربوط به آیتم‌های جدیدند
+    و result خلاصهٔ ادغام‌شده است. state بعد از پایان stream زیر قفل کاربر ذخیره می‌شود.
+    """
+    run = await _NotificationSummaryRun.load(current_user.id, body)
+    if run.unchanged:
+        return _sse_response(_sse_result_only(run.previous(), "unchanged"))
+    system_prompt, user_prompt = run.prompts()
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    async def _finalize(parsed: Any, raw_text: str) -> NotificationSummary:
+        summary = run.complete(NotificationSummary(**parsed))
+        saved = False
+        try:
+            # state زیر قفل دوباره خوانده می‌شود؛ اگر summarize دیگری در این فاصله ذخیره کرده باشد
+            # این نتیجه ذخیره نمی‌شود (نه بازنویسی، نه ادغام دوباره)
+            async with _summary_state_lock(current_user.id):
+                saved = await run.save_state(summary)
+        except Exception as exc:  # noqa: BLE001
+            log.warning("Saving streamed notification summary state failed for user %s: %s", current_user.id, exc)
+        if saved:
+            await run.store(summary)
+        return summary
+
+    ticket = await _admit_stream_or_429(str(current_user.id))
+    return _sse_response(_stream_structured_completion(
+        messages,
+        temperature=0.35,
+        item_builders={
+            "important_messages": lambda value: ImportantMessage(**value).dict(),
+            "critical_alerts": lambda value: CriticalAlert(**value).dict(),
+            "action_items": lambda value: ActionItem(**value).dict(),
+        },
+        finalize=_finalize,
+        request=req,
+        ticket=ticket,
+    ))
+
+
+# =========================
+# 1b) Notification store + daily rollups
+# =========================
+
+NOTIF_INGEST_MAX_ITEMS = int(os.getenv("NOTIF_INGEST_MAX_ITEMS", "1000"))
+NOTIF_ROLLUP_TOP_SENDERS = int(os.getenv("NOTIF_ROLLUP_TOP_SENDERS", "50"))
+NOTIF_INSIGHTS_DAYS = int(os.getenv("NOTIF_INSIGHTS_DAYS", "30"))
+NOTIF_RECENT_DAYS = int(os.getenv("NOTIF_RECENT_DAYS", "7"))
+
+_IMPORTANT_URGENCIES = ("critical", "high")
+_IMPORTANT_TRIAGE = ("critical", "important")
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """DB ستون‌های DateTime را naive و به وقت UTC نگه می‌دارد."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _ingest_item_from_dict(item: Any, kind: str) -> Optional[NotificationIngestItem]:
+    """اعلان/پیام آزادِ کلاینت (مثل ورودی /notifications/summarize) را به NotificationIngestItem تبدیل می‌کند."""
+    if not isinstance(item, dict):
+        return None
+    sender = item.get("sender") or item.get("from") or item.get("app")
+    try:
+        return NotificationIngestItem(
+            id=str(item["id"]) if item.get("id") is not None else None,
+            kind=kind,
+            sender=str(sender) if sender else None,
+            title=str(item.get("title") or item.get("subject") or ""),
+            body=str(item.get("body") or item.get("text") or item.get("message") or item.get("preview") or ""),
+            received_at=item.get("received_at") or item.get("timestamp") or item.get("created_at"),
+            is_read=bool(item.get("is_read") or item.get("read")),
+            category=item.get("category"),
+            urgency=item.get("urgency") or item.get("importance"),
+            sentiment=item.get("sentiment"),
+            topics=item.get("topics") or item.get("keywords") or [],
+        )
+    except ValidationError:
+        return None
+
+
+def _stored_notification_from_item(user_id: int, item: NotificationIngestItem, now: datetime) -> StoredNotification:
+    # دسته‌بندی هنگام ingest فقط با رده‌بند محلی است؛ موارد مبهم «other» می‌مانند
+    profile: Optional[Dict[str, Optional[str]]] = None
+    if NOTIF_LOCAL_CLASSIFIER_ENABLED and not (item.category and item.urgency):
+        kind, confidence, _ = _LOCAL_NOTIFICATION_CLASSIFIER.predict(item.title, item.body)
+        if confidence >= NOTIF_LOCAL_MIN_CONFIDENCE:
+            profile = _LOCAL_NOTIFICATION_PROFILES.get(kind)
+    return StoredNotification(
+        user_id=user_id,
+        external_id=item.id,
+        kind=item.kind,
+        sender=(item.sender or "")[:255] or None,
+        title=item.title[:500],
+        body=item.body,
+        category=item.category or (profile["category"] if profile else "other"),
+        urgency=item.urgency or (profile["urgency"] if profile else "medium"),
+        triage=profile["triage"] if profile else None,
+        suggested_action=profile["action"] if profile else None,
+        sentiment=item.sentiment,
+        topics=[str(topic) for topic in item.topics][:20],
+        is_read=item.is_read,
+        received_at=_naive_utc(item.received_at) or now,
+    )
+
+
+def _aggregate_notification_rows(rows: List[Tuple[Any, ...]]) -> Dict[str, Any]:
+    """rows: (category, sender, is_read, urgency, triage, sentiment, topics) -> ستون‌های NotificationDailyRollup"""
+    categories: Dict[str, int] = {}
+    senders: Dict[str, int] = {}
+    topics: Dict[str, int] = {}
+    values: Dict[str, Any] = {
+        "total": 0, "read_count": 0, "critical_count": 0, "important_count": 0,
+        "sentiment_sum": 0.0, "sentiment_count": 0,
+    }
+    for category, sender, is_read, urgency, triage, sentiment, row_topics in rows:
+        values["total"] += 1
+        values["read_count"] += 1 if is_read else 0
+        if urgency == "critical" or triage == "critical":
+            values["critical_count"] += 1
+        if urgency in _IMPORTANT_URGENCIES or triage in _IMPORTANT_TRIAGE:
+            values["important_count"] += 1
+        if sentiment is not None:
+            values["sentiment_sum"] += float(sentiment)
+            values["sentiment_count"] += 1
+        categories[category or "other"] = categories.get(category or "other", 0) + 1
+        if sender:
+            senders[sender] = senders.get(sender, 0) + 1
+        for topic in row_topics or []:
+            topics[topic] = topics.get(topic, 0) + 1
+    top_senders = sorted(senders.items(), key=lambda kv: kv[1], reverse=True)[:NOTIF_ROLLUP_TOP_SENDERS]
+    values["category_counts"] = categories
+    values["sender_counts"] = dict(top_senders)
+    values["topic_counts"] = topics
+    return values
+
+
+async def _refresh_notification_rollups(user_id: int, days: List[date]) -> None:
+    """Recompute the rollup row of each touched day from the raw rows (idempotent)."""
+    for attempt in range(2):
+        try:
+            async with async_session() as session:
+                for day in sorted(set(days)):
+                    start = datetime.combine(day, datetime.min.time())
+                    result = await session.execute(
+                        select(
+                            StoredNotification.category,
+                            StoredNotification.sender,
+                            StoredNotification.is_read,
+                            StoredNotification.urgency,
+                            StoredNotification.triage,
+                            StoredNotification.sentiment,
+                            StoredNotification.topics,
+                        ).where(
+                            StoredNotification.user_id == user_id,
+                            StoredNotification.received_at >= start,
+                            StoredNotification.received_at < start + timedelta(days=1),
+                        )
+                    )
+                    values = _aggregate_notification_rows(result.all())
+                    rollup_result = await session.execute(
+                        select(NotificationDailyRollup).where(
+                            NotificationDailyRollup.user_id == user_id,
+                            NotificationDailyRollup.day == day,
+                        )
+                    )
+                    rollup = rollup_result.scalar_one_or_none()
+                    if rollup is None:
+                        session.add(NotificationDailyRollup(user_id=user_id, day=day, **values))
+                    else:
+                        for key, value in values.items():
+                            setattr(rollup, key, value)
+                await session.commit()
+            return
+        except IntegrityError:
+            # ingest هم‌زمان همان روز را ساخته؛ یک بار دیگر با ردیف موجود
+            if attempt:
+                raise
+
+
+async def _ingest_notifications(user_id: int, items: List[NotificationIngestItem]) -> NotificationIngestResponse:
+    now = datetime.utcnow()
+    seen: set = set()
+    unique: List[NotificationIngestItem] = []
+    for item in items:
+        if item.id:
+            if item.id in seen:
+                continue
+            seen.add(item.id)
+        unique.append(item)
+
+    fresh: List[NotificationIngestItem] = []
+    for attempt in range(2):
+        try:
+            async with async_session() as session:
+                external_ids = [item.id for item in unique if item.id]
+                existing: set = set()
+                for offset in range(0, len(external_ids), 500):
+                    result = await session.execute(
+                        select(StoredNotification.external_id).where(
+                            StoredNotification.user_id == user_id,
+                            StoredNotification.external_id.in_(external_ids[offset:offset + 500]),
+                        )
+                    )
+                    existing.update(result.scalars().all())
+                fresh = [item for item in unique if not item.id or item.id not in existing]
+                session.add_all([_stored_notification_from_item(user_id, item, now) for item in fresh])
+                await session.commit()
+            break
+        except IntegrityError:
+            # درخواست موازی همان external_id را زودتر نوشته؛ دوباره با SELECT جدید
+            if attempt:
+                raise
+
+    touched_days = [(_naive_utc(item.received_at) or now).date() for item in fresh]
+    if touched_days:
+        await _refresh_notification_rollups(user_id, touched_days)
+    return NotificationIngestResponse(ingested=len(fresh), duplicates=len(items) - len(fresh))
+
+
+async def _store_notification_summary(user_id: int, summary: NotificationSummary) -> None:
+    """Insert or update (by summary_id) the stored summary; incremental updates reuse the window's id."""
+    summary_id = summary.summary_id or str(uuid.uuid4())
+    generated_at = _naive_utc(summary.generated_at)
+    payload = json.loads(summary.json())
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotificationSummary).where(
+                StoredNotificationSummary.user_id == user_id,
+                StoredNotificationSummary.summary_id == summary_id,
+            )
+        )
+        stored = result.scalars().first()
+        if stored is None:
+            session.add(StoredNotificationSummary(
+                user_id=user_id,
+                summary_id=summary_id,
+                summary_date=generated_at.date(),
+                payload=payload,
+                generated_at=generated_at,
+            ))
+        else:
+            stored.summary_date = generated_at.date()
+            stored.payload = payload
+            stored.generated_at = generated_at
+        await session.commit()
+
+
+async def _load_notification_rollups(user_id: int, days: int) -> List[NotificationDailyRollup]:
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    async with async_session() as session:
+        result = await session.execute(
+            select(NotificationDailyRollup).where(
+                NotificationDailyRollup.user_id == user_id,
+                NotificationDailyRollup.day >= since,
+            ).order_by(NotificationDailyRollup.day)
+        )
+        return list(result.scalars().all())
+
+
+def _merge_rollup_counts(rollups: List[NotificationDailyRollup], column: str) -> Dict[str, int]:
+    merged: Dict[str, int] = {}
+    for rollup in rollups:
+        for key, count in (getattr(rollup, column) or {}).items():
+            merged[key] = merged.get(key, 0) + int(count)
+    return merged
+
+
+def _top_keys(counts: Dict[str, int], limit: int) -> List[str]:
+    return [key for key, _ in sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:limit]]
+
+
+def _trends_from_rollups(rollups: List[NotificationDailyRollup], days: int, today: date) -> NotificationTrends:
+    total = sum(rollup.total or 0 for rollup in rollups)
+    sentiment_n = sum(rollup.sentiment_count or 0 for rollup in rollups)
+    sentiment_sum = sum(rollup.sentiment_sum or 0.0 for rollup in rollups)
+
+    # موضوع‌هایی که نرخ روزانه‌شان در یک‌چهارم آخر بازه خیلی بیشتر از قبل است
+    recent_days = max(1, days // 4)
+    cutoff = today - timedelta(days=recent_days - 1)
+    recent = _merge_rollup_counts([r for r in rollups if r.day >= cutoff], "topic_counts")
+    before = _merge_rollup_counts([r for r in rollups if r.day < cutoff], "topic_counts")
+    earlier_days = max(1, days - recent_days)
+    emerging: List[Tuple[float, str]] = []
+    for topic, count in recent.items():
+        if count < 2:
+            continue
+        recent_rate = count / recent_days
+        earlier_rate = before.get(topic, 0) / earlier_days
+        if recent_rate > 1.5 * earlier_rate:
+            emerging.append((recent_rate / (earlier_rate or 1e-9), topic))
+    emerging.sort(reverse=True)
+
+    return NotificationTrends(
+        total_notifications=total,
+        average_per_day=total // days,
+        top_senders=_top_keys(_merge_rollup_counts(rollups, "sender_counts"), 5),
+        category_breakdown=_merge_rollup_counts(rollups, "category_counts"),
+        average_sentiment=round(sentiment_sum / sentiment_n, 3) if sentiment_n else 0.0,
+        emerging_topics=[topic for _, topic in emerging[:5]],
+    )
+
+
+@app.post(
+    "/notifications/ingest",
+    response_model=NotificationIngestResponse,
+    summary="Store notifications/messages from the device",
+)
+async def ingest_notifications(
+    req: NotificationIngestRequest,
+    current_user: User = Depends(get_current_user),
+) -> NotificationIngestResponse:
+    """
+    کلاینت اعلان‌ها/پیام‌های جدید را اینجا می‌فرستد؛ تکراری‌ها (همان id) نادیده گرفته می‌شوند
+    و rollup روزهای تغییرکرده دوباره ساخته می‌شود. بقیهٔ اندپوینت‌های این بخش فقط از DB می‌خوانند.
+    """
+    if len(req.notifications) > NOTIF_INGEST_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"حداکثر {NOTIF_INGEST_MAX_ITEMS} اعلان در هر درخواست مجاز است.")
+    if not req.notifications:
+        return NotificationIngestResponse()
+    return await _ingest_notifications(current_user.id, req.notifications)
+
+
 # =========================
 # 2) GET /user/notifications/summary/today
 # =========================
@@ -4473,22 +6658,27 @@ async def summarize_notifications(req: SummarizeRequest) -> NotificationSummary:
     response_model=TodaySummaryResponse,
     summary="Get today's notification summary",
 )
-async def get_today_summary() -> TodaySummaryResponse:
+async def get_today_summary(current_user: User = Depends(get_current_user)) -> TodaySummaryResponse:
     """
     Flutter انتظار داره:
     response['summary'] رو به NotificationSummary تبدیل کنه.
+    آخرین summary ذخیره‌شدهٔ امروز (UTC) از DB.
     """
 
     today = datetime.utcnow().date()
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotificationSummary.payload).where(
+                StoredNotificationSummary.user_id == current_user.id,
+                StoredNotificationSummary.summary_date == today,
+            ).order_by(StoredNotificationSummary.generated_at.desc()).limit(1)
+        )
+        payload = result.scalar_one_or_none()
 
-    # TODO: از DB آخرین summary همین روز رو دربیار
-    # fake مثال:
-    stored_summary: Optional[NotificationSummary] = None
-
-    if stored_summary is None:
+    if payload is None:
         return TodaySummaryResponse(summary=None)
 
-    return TodaySummaryResponse(summary=stored_summary)
+    return TodaySummaryResponse(summary=NotificationSummary(**payload))
 
 
 # =========================
@@ -4500,27 +6690,43 @@ async def get_today_summary() -> TodaySummaryResponse:
     response_model=ImportantMessagesResponse,
     summary="Get AI-filtered important messages",
 )
-async def get_important_messages(limit: int = Query(20, ge=1, le=100)) -> ImportantMessagesResponse:
+async def get_important_messages(
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user),
+) -> ImportantMessagesResponse:
     """
     Flutter:
     GET /user/messages/important?limit=20
     بعد response['messages'] رو parse می‌کنه.
     """
 
-    # TODO: از DB ایمیل/پیام‌ها رو بیار، با سیگنال‌ها/AI رتبه‌بندی کن
-    # فعلاً یه لیست ساختگی:
-    now = datetime.utcnow()
+    since = datetime.utcnow() - timedelta(days=NOTIF_RECENT_DAYS)
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotification).where(
+                StoredNotification.user_id == current_user.id,
+                StoredNotification.received_at >= since,
+                StoredNotification.kind == "message",
+                or_(
+                    StoredNotification.urgency.in_(_IMPORTANT_URGENCIES),
+                    StoredNotification.triage.in_(_IMPORTANT_TRIAGE),
+                ),
+            ).order_by(StoredNotification.received_at.desc()).limit(limit)
+        )
+        rows = result.scalars().all()
+
     messages: List[ImportantMessage] = [
         ImportantMessage(
-            message_id="msg_1",
-            sender="boss@example.com",
-            subject="Quarterly report",
-            preview="Please send me the quarterly report...",
-            importance="high",
-            keywords=["report", "deadline"],
-            received_at=now - timedelta(hours=2),
+            message_id=row.external_id or str(row.id),
+            sender=row.sender or "",
+            subject=row.title or "",
+            preview=(row.body or "")[:200],
+            importance=row.urgency or "medium",
+            keywords=row.topics or [],
+            received_at=row.received_at,
         )
-    ][:limit]
+        for row in rows
+    ]
 
     return ImportantMessagesResponse(messages=messages)
 
@@ -4534,19 +6740,33 @@ async def get_important_messages(limit: int = Query(20, ge=1, le=100)) -> Import
     response_model=CriticalAlertsResponse,
     summary="Get critical alerts",
 )
-async def get_critical_alerts(limit: int = Query(10, ge=1, le=100)) -> CriticalAlertsResponse:
-    # TODO: از DB نوتیف‌های بحرانی رو بیار
-    now = datetime.utcnow()
+async def get_critical_alerts(
+    limit: int = Query(10, ge=1, le=100),
+    current_user: User = Depends(get_current_user),
+) -> CriticalAlertsResponse:
+    since = datetime.utcnow() - timedelta(days=NOTIF_RECENT_DAYS)
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotification).where(
+                StoredNotification.user_id == current_user.id,
+                StoredNotification.received_at >= since,
+                StoredNotification.processed.is_(False),
+                or_(StoredNotification.urgency == "critical", StoredNotification.triage == "critical"),
+            ).order_by(StoredNotification.received_at.desc()).limit(limit)
+        )
+        rows = result.scalars().all()
+
     alerts: List[CriticalAlert] = [
         CriticalAlert(
-            alert_id="alert_1",
-            title="Low account balance",
-            description="Your balance is under 10€.",
+            alert_id=row.external_id or str(row.id),
+            title=row.title or "",
+            description=row.body or "",
             severity="critical",
-            action="open_banking_app",
-            created_at=now - timedelta(minutes=30),
+            action=row.suggested_action,
+            created_at=row.received_at,
         )
-    ][:limit]
+        for row in rows
+    ]
 
     return CriticalAlertsResponse(alerts=alerts)
 
@@ -4560,24 +6780,49 @@ async def get_critical_alerts(limit: int = Query(10, ge=1, le=100)) -> CriticalA
     response_model=InsightsResponse,
     summary="Get personalized insights from messages",
 )
-async def get_message_insights() -> InsightsResponse:
+async def get_message_insights(current_user: User = Depends(get_current_user)) -> InsightsResponse:
     """
-    اینجا می‌تونی واقعاً از LLM استفاده کنی، با همون helper.
-    برای سادگی فعلاً fake برمی‌گردونم.
+    از rollupهای روزانه و آخرین summaryهای ذخیره‌شده ساخته می‌شود (بدون LLM).
     """
 
-    # TODO: پیام‌های کاربر رو از DB بگیر و به LLM بده
-    most_contacted = [{"name": "Ali", "email": "ali@example.com", "count": 25}]
+    rollups = await _load_notification_rollups(current_user.id, NOTIF_INSIGHTS_DAYS)
+    senders = _merge_rollup_counts(rollups, "sender_counts")
+    most_contacted = [{"name": name, "count": senders[name]} for name in _top_keys(senders, 5)]
+    categories = _merge_rollup_counts(rollups, "category_counts")
+    total = sum(categories.values()) or 1
     conversation_topics = [
-        {"topic": "work", "score": 0.7},
-        {"topic": "personal", "score": 0.3},
+        {"topic": topic, "score": round(categories[topic] / total, 2)} for topic in _top_keys(categories, 5)
     ]
     sentiment_trend = [
-        {"date": "2025-01-01", "score": 0.1},
-        {"date": "2025-01-02", "score": 0.3},
+        {"date": rollup.day.isoformat(), "score": round(rollup.sentiment_sum / rollup.sentiment_count, 3)}
+        for rollup in rollups
+        if rollup.sentiment_count
     ]
-    pending_actions = [{"message_id": "m1", "title": "Reply to manager"}]
-    follow_ups_needed = [{"message_id": "m2", "title": "Send report"}]
+
+    pending_actions = [
+        {"message_id": item.source, "title": item.title}
+        for item in await _recent_action_items(current_user.id)
+    ]
+    # پیام‌های مهمِ خوانده‌نشده که بیش از یک روز بی‌جواب مانده‌اند
+    now = datetime.utcnow()
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotification.external_id, StoredNotification.id, StoredNotification.title).where(
+                StoredNotification.user_id == current_user.id,
+                StoredNotification.received_at >= now - timedelta(days=NOTIF_RECENT_DAYS),
+                StoredNotification.received_at < now - timedelta(days=1),
+                StoredNotification.kind == "message",
+                StoredNotification.is_read.is_(False),
+                or_(
+                    StoredNotification.urgency.in_(_IMPORTANT_URGENCIES),
+                    StoredNotification.triage.in_(_IMPORTANT_TRIAGE),
+                ),
+            ).order_by(StoredNotification.received_at.desc()).limit(10)
+        )
+        follow_ups_needed = [
+            {"message_id": external_id or str(row_id), "title": title or ""}
+            for external_id, row_id, title in result.all()
+        ]
 
     return InsightsResponse(
         most_contacted=most_contacted,
@@ -4588,6 +6833,382 @@ async def get_message_insights() -> InsightsResponse:
     )
 
 
+# =========================
+# 5b) Local notification classifier (fast path before the LLM)
+# =========================
+
+NOTIF_LOCAL_CLASSIFIER_ENABLED = os.getenv("NOTIF_LOCAL_CLASSIFIER_ENABLED", "1") == "1"
+# احتمال مدل خطی باید حداقل این مقدار باشد تا بدون LLM جواب بدهیم
+NOTIF_LOCAL_MIN_CONFIDENCE = float(os.getenv("NOTIF_LOCAL_MIN_CONFIDENCE", "0.85"))
+NOTIF_LOCAL_RULE_CONFIDENCE = float(os.getenv("NOTIF_LOCAL_RULE_CONFIDENCE", "0.95"))
+# درصدی از جواب‌های محلی مطمئن که برای سنجش دقت باز هم به LLM فرستاده می‌شوند
+NOTIF_LOCAL_AUDIT_RATE = float(os.getenv("NOTIF_LOCAL_AUDIT_RATE", "0.02"))
+NOTIF_LOCAL_HASH_BITS = int(os.getenv("NOTIF_LOCAL_HASH_BITS", "18"))
+NOTIF_LOCAL_TRAIN_EPOCHS = int(os.getenv("NOTIF_LOCAL_TRAIN_EPOCHS", "15"))
+# JSONL اختیاری با سطرهای {"title": ..., "body": ..., "label": ...} برای تکمیل داده‌های آموزشی
+NOTIF_LOCAL_TRAIN_PATH = os.getenv("NOTIF_LOCAL_TRAIN_PATH", "")
+
+# kind -> پاسخ در هر دو taxonomy (categorize و triage)
+_LOCAL_NOTIFICATION_PROFILES: Dict[str, Dict[str, Optional[str]]] = {
+    "security": {
+        "category": "system", "urgency": "critical", "triage": "critical", "label": "هشدار امنیتی",
+        "action": "اگر این فعالیت کار شما نبوده، فوراً رمز عبور را عوض کنید.",
+    },
+    "otp": {
+        "category": "system", "urgency": "high", "triage": "important", "label": "کد تایید",
+        "action": "کد را فقط در همان برنامه وارد کنید و برای کسی نفرستید.",
+    },
+    "bank": {
+        "category": "personal", "urgency": "high", "triage": "important", "label": "تراکنش بانکی",
+        "action": "تراکنش را با سوابق خود تطبیق دهید.",
+    },
+    "delivery": {
+        "category": "personal", "urgency": "medium", "triage": "normal", "label": "مرسوله",
+        "action": "وضعیت مرسوله را پیگیری کنید.",
+    },
+    "promo": {"category": "other", "urgency": "low", "triage": "spam", "label": "تبلیغ", "action": None},
+    "social": {"category": "social", "urgency": "low", "triage": "normal", "label": "شبکه اجتماعی", "action": None},
+    "system": {"category": "system", "urgency": "low", "triage": "normal", "label": "سیستمی", "action": None},
+}
+# "other" یعنی مدل نظری ندارد و اعلان همیشه به LLM می‌رود
+_LOCAL_NOTIFICATION_LABELS = list(_LOCAL_NOTIFICATION_PROFILES) + ["other"]
+
+_AMOUNT_RE = re.compile(r"\d[\d,]*\s*(ریال|تومان|rial|toman|irr|usd|\$)|مانده|موجودی|balance")
+# کلمهٔ «تخفیف/sale» به‌تنهایی در پیام‌های واقعی هم می‌آید؛ قانون promo علامت تبلیغ هم لازم دارد:
+# درصد یا مبلغ، کد تخفیف، لینک یا پانویس لغو عضویت
+_PROMO_MARK_RE = re.compile(
+    r"\d+\s*(%|درصد)|\d[\d,]*\s*(ریال|تومان|usd|\$)|\$\s*\d|"
+    r"(کد\s*تخفیف|coupon|promo\s*code|code)\s*[:：]?\s*[a-z0-9]{4,}|"
+    r"https?://|www\.|\b[a-z0-9-]+\.(ir|com|shop)\b|"
+    r"لغو\s*(عضویت\s*)?(11|\d{1,3}\b)|to\s+unsubscribe|unsubscribe\s+(here|at|link)|opt[- ]out|reply\s+stop"
+)
+# قانون delivery فقط با کد رهگیری یا شمارهٔ سفارش
+_TRACKING_RE = re.compile(
+    r"(کد\s*رهگیری|شماره\s*(سفارش|مرسوله|پیگیری)|سفارش\s*(شماره|#)|tracking(\s*(number|no\.?|id|#))?|"
+    r"order\s*(#|no\.?|number|id))\s*[:：#]?\s*[a-z0-9-]*\d[a-z0-9-]{3,}|\b[a-z]{2}\d{9}[a-z]{2}\b"
+)
+# ترتیب مهم است: اولین قانونِ منطبق برنده است
+_LOCAL_NOTIFICATION_RULES: List[Tuple[str, "re.Pattern[str]", Optional["re.Pattern[str]"]]] = [
+    ("security", re.compile(
+        r"ورود\s+(جدید|مشکوک|ناموفق)|رمز\s+عبور\s+(شما\s+)?(تغییر|بازنشانی)|"
+        r"new\s+(sign[- ]?in|login)|suspicious\s+(activity|login|sign[- ]?in)|"
+        r"password\s+(was\s+|has\s+been\s+)?(changed|reset)|unrecognized\s+device"
+    ), None),
+    ("otp", re.compile(
+        r"(کد|رمز)\s*(تایید|تأیید|ورود|فعال\s*سازی|یکبار\s*مصرف|پویا|دوم)|"
+        r"verification\s+code|one[- ]time\s+(password|code)|\botp\b|\b2fa\b|"
+        r"(code|کد)\s*[:：]?\s*\d{4,8}\b"
+    ), None),
+    ("bank", re.compile(
+        r"برداشت|واریز|انتقال\s+وجه|بانک|کارت\s*\d|حساب\s*\d|\b(debited|credited|withdrawal|deposit)\b"
+    ), _AMOUNT_RE),
+    ("delivery", re.compile(
+        r"مرسوله|بسته\s*(شما|پستی)|کد\s*رهگیری|سفارش\s+(شما|شماره).{0,30}(ارسال|تحویل|آماده)|"
+        r"\b(shipped|out\s+for\s+delivery|delivered|tracking\s+number|your\s+(order|package))\b"
+    ), _TRACKING_RE),
+    ("promo", re.compile(
+        r"کد\s*تخفیف|تخفیف|جشنواره|حراج|فروش\s+ویژه|"
+        r"\b(sale|discount|promo|coupon)\b|\d+\s*%\s*off"
+    ), _PROMO_MARK_RE),
+]
+
+# داده‌های آموزشی پایه برای مدل خطی؛ قانون‌ها موارد واضح را می‌گیرند و مدل برای بقیه است
+_LOCAL_NOTIFICATION_SEED: List[Tuple[str, str]] = [
+    ("ورود به حساب از دستگاه جدید در تهران", "security"),
+    ("تلاش ناموفق برای ورود به حساب کاربری شما ثبت شد", "security"),
+    ("Someone tried to sign in to your account from a new device", "security"),
+    ("Security alert for your Google Account", "security"),
+    ("کد تایید شما در دیجی‌کالا 48213 است", "otp"),
+    ("رمز یکبار مصرف: 771920 این رمز تا ۲ دقیقه معتبر است", "otp"),
+    ("Your verification code is 552019", "otp"),
+    ("Use 3381 to log in to your account. Do not share this code", "otp"),
+    ("برداشت از حساب 1234 مبلغ 1,500,000 ریال مانده 8,200,000", "bank"),
+    ("واریز به کارت شما 2,000,000 تومان", "bank"),
+    ("بانک ملت: خرید 450,000 ریال موجودی 3,100,000", "bank"),
+    ("Your account was debited 45.20 USD balance 1203.11", "bank"),
+    ("سفارش شما ارسال شد و تا فردا تحویل می‌شود", "delivery"),
+    ("مرسوله پستی شما در مرکز مبادله تهران است", "delivery"),
+    ("پیک در مسیر است، سفارش شما تا ۱۰ دقیقه دیگر می‌رسد", "delivery"),
+    ("Your package is out for delivery", "delivery"),
+    ("جشنواره تخفیف تا ۷۰ درصد فقط امروز", "promo"),
+    ("با کد تخفیف NOWRUZ خرید اول را ارزان‌تر بخرید", "promo"),
+    ("پیشنهاد ویژه برای شما: اشتراک یک‌ساله با نصف قیمت", "promo"),
+    ("Flash sale: 50% off everything this weekend", "promo"),
+    ("علی عکس شما را لایک کرد", "social"),
+    ("سارا در اینستاگرام شما را دنبال کرد", "social"),
+    ("۳ پیام جدید در گروه خانواده", "social"),
+    ("John commented on your post", "social"),
+    ("New follower: maryam_art started following you", "social"),
+    ("به‌روزرسانی جدید برنامه آماده نصب است", "system"),
+    ("باتری گوشی کمتر از ۱۵ درصد است", "system"),
+    ("فضای ذخیره‌سازی تقریباً پر شده است", "system"),
+    ("Software update available for your device", "system"),
+    ("Backup completed successfully", "system"),
+    ("جلسه تیم محصول ساعت ۱۰ فردا", "other"),
+    ("مدیر پروژه گزارش هفتگی را خواسته است", "other"),
+    ("مامان: کی میای خونه؟", "other"),
+    ("Reminder: dentist appointment tomorrow at 4pm", "other"),
+    ("Invoice #2231 is due next week", "other"),
+    ("Meeting moved to Thursday, please confirm", "other"),
+    # کلمه‌های تبلیغ/مرسوله در پیام‌های عادی
+    ("We need to talk about the sale of the company tomorrow", "other"),
+    ("We discussed the discount policy for Q3", "other"),
+    ("Unsubscribe me from that group chat please", "other"),
+    ("Did you grab your order from the cafe?", "other"),
+    ("Your talk was delivered really well", "other"),
+    ("درباره تخفیف قرارداد فردا صحبت کنیم", "other"),
+]
+
+_PERSIAN_NORMALIZE_TABLE = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "أ": "ا", "إ": "ا", "ؤ": "و",
+    "‌": " ", "‏": " ", "‎": " ", "ً": None, "ٌ": None, "ٍ": None,
+    "َ": None, "ُ": None, "ِ": None, "ّ": None, "ْ": None, "ـ": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    "٬": ",", "٫": ".", "،": ",",
+})
+
+
+def _normalize_notification_text(text: str) -> str:
+    """Unify Arabic/Persian letters and digits, drop diacritics and ZWNJ, lowercase."""
+    return " ".join((text or "").translate(_PERSIAN_NORMALIZE_TABLE).lower().split())
+
+
+class _HashedLinearClassifier:
+    """Multinomial logistic regression over hashed word/bigram/char-trigram features (sparse, pure Python)."""
+
+    def __init__(self, labels: List[str], bits: int = 18):
+        self.labels = list(labels)
+        self.mask = (1 << bits) - 1
+        self.weights: Dict[int, List[float]] = {}
+        self.bias = [0.0] * len(self.labels)
+
+    def features(self, text: str) -> Dict[int, float]:
+        feats: Dict[int, float] = {}
+        mask = self.mask
+        prev = "<s>"
+        for token in text.split():
+            keys = [f"w:{token}", f"b:{prev} {token}"]
+            padded = f"#{token}#"
+            keys.extend(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+            for key in keys:
+                idx = zlib.crc32(key.encode("utf-8")) & mask
+                feats[idx] = feats.get(idx, 0.0) + 1.0
+            prev = token
+        norm = math.sqrt(sum(v * v for v in feats.values())) or 1.0
+        return {idx: value / norm for idx, value in feats.items()}
+
+    def predict_proba(self, feats: Dict[int, float]) -> List[float]:
+        scores = list(self.bias)
+        for idx, value in feats.items():
+            row = self.weights.get(idx)
+            if row is None:
+                continue
+            for j, weight in enumerate(row):
+                scores[j] += weight * value
+        peak = max(scores)
+        exps = [math.exp(score - peak) for score in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def fit(self, examples: List[Tuple[str, str]], epochs: int, lr: float = 0.5, l2: float = 1e-4) -> int:
+        data = [(self.features(text), self.labels.index(label)) for text, label in examples if label in self.labels]
+        rng = random.Random(0)
+        n_labels = len(self.labels)
+        for _ in range(max(0, epochs)):
+            rng.shuffle(data)
+            for feats, target in data:
+                grads = self.predict_proba(feats)
+                grads[target] -= 1.0
+                for j in range(n_labels):
+                    self.bias[j] -= lr * grads[j]
+                for idx, value in feats.items():
+                    row = self.weights.setdefault(idx, [0.0] * n_labels)
+                    for j in range(n_labels):
+                        row[j] -= lr * (grads[j] * value + l2 * row[j])
+        return len(data)
+
+
+class _LocalNotificationClassifier:
+    """
+    رده‌بندی محلی اعلان‌ها:
+    1) قانون‌های regex برای موارد واضح (OTP، تراکنش بانکی، مرسوله، هشدار امنیتی، تبلیغ)
+    2) مدل خطی روی n-gramهای hash‌شده برای بقیه
+    فقط وقتی اطمینان از NOTIF_LOCAL_MIN_CONFIDENCE کمتر باشد سراغ LLM می‌رویم.
+    """
+
+    def __init__(self) -> None:
+        self.model = _HashedLinearClassifier(_LOCAL_NOTIFICATION_LABELS, NOTIF_LOCAL_HASH_BITS)
+        self.trained_examples = 0
+        self._train_lock = threading.Lock()
+        self._trained = False
+        self.decisions: Dict[str, Dict[str, int]] = {}
+        # kind -> band -> {"agree": n, "disagree": n}
+        self.audits: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+    def ensure_trained(self) -> None:
+        if self._trained:
+            return
+        with self._train_lock:
+            if self._trained:
+                return
+            examples = [(_normalize_notification_text(text), label) for text, label in _LOCAL_NOTIFICATION_SEED]
+            examples.extend(self._load_extra_examples())
+            started = time.perf_counter()
+            self.trained_examples = self.model.fit(examples, NOTIF_LOCAL_TRAIN_EPOCHS)
+            self._trained = True
+            log.info(
+                "Local notification classifier trained on %d examples in %.2fs",
+                self.trained_examples,
+                time.perf_counter() - started,
+            )
+
+    @staticmethod
+    def _load_extra_examples() -> List[Tuple[str, str]]:
+        if not NOTIF_LOCAL_TRAIN_PATH:
+            return []
+        examples: List[Tuple[str, str]] = []
+        try:
+            with open(NOTIF_LOCAL_TRAIN_PATH, encoding="utf-8") as handle:
+                for line in handle:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(row, dict) and row.get("label") in _LOCAL_NOTIFICATION_LABELS:
+                        text = f"{row.get('title') or ''} {row.get('body') or ''}"
+                        examples.append((_normalize_notification_text(text), row["label"]))
+        except OSError as exc:
+            log.warning("Could not read NOTIF_LOCAL_TRAIN_PATH=%s: %s", NOTIF_LOCAL_TRAIN_PATH, exc)
+        return examples
+
+    def predict(self, title: str, body: str) -> Tuple[str, float, str]:
+        """(kind, confidence, source) که source یکی از rule/model است."""
+        text = _normalize_notification_text(f"{title or ''} {body or ''}")
+        for kind, pattern, required in _LOCAL_NOTIFICATION_RULES:
+            if pattern.search(text) and (required is None or required.search(text)):
+                return kind, NOTIF_LOCAL_RULE_CONFIDENCE, "rule"
+        self.ensure_trained()
+        probs = self.model.predict_proba(self.model.features(text))
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.model.labels[best], probs[best], "model"
+
+    def route(self, title: str, body: str, endpoint: str) -> Tuple[Tuple[str, float, str], bool]:
+        """Return the local verdict and whether it can be served without the LLM."""
+        if not NOTIF_LOCAL_CLASSIFIER_ENABLED:
+            return ("other", 0.0, "disabled"), False
+        verdict = self.predict(title, body)
+        kind, confidence, _ = verdict
+        confident = kind in _LOCAL_NOTIFICATION_PROFILES and confidence >= NOTIF_LOCAL_MIN_CONFIDENCE
+        if confident and random.random() < NOTIF_LOCAL_AUDIT_RATE:
+            decision = "audit"
+            confident = False
+        else:
+            decision = "local" if confident else "escalated"
+        counts = self.decisions.setdefault(endpoint, {"local": 0, "escalated": 0, "audit": 0})
+        counts[decision] += 1
+        M_NOTIF_LOCAL_DECISIONS.inc(endpoint, decision)
+        return verdict, confident
+
+    def audit(self, verdict: Tuple[str, float, str], field: str, actual: Optional[str]) -> None:
+        """Compare an escalated item's local prediction with what the LLM returned."""
+        kind, confidence, source = verdict
+        profile = _LOCAL_NOTIFICATION_PROFILES.get(kind)
+        if profile is None or source == "disabled" or not actual:
+            return
+        band = "confident" if confidence >= NOTIF_LOCAL_MIN_CONFIDENCE else "low"
+        outcome = "agree" if str(actual).strip().lower() == profile[field] else "disagree"
+        bucket = self.audits.setdefault(kind, {}).setdefault(band, {"agree": 0, "disagree": 0})
+        bucket[outcome] += 1
+        M_NOTIF_LOCAL_AUDIT.inc(kind, band, outcome)
+
+    def snapshot(self) -> Dict[str, Any]:
+        accuracy: Dict[str, Optional[float]] = {}
+        for kind, bands in self.audits.items():
+            confident = bands.get("confident") or {}
+            checked = confident.get("agree", 0) + confident.get("disagree", 0)
+            accuracy[kind] = round(confident.get("agree", 0) / checked, 3) if checked else None
+        return {
+            "enabled": NOTIF_LOCAL_CLASSIFIER_ENABLED,
+            "min_confidence": NOTIF_LOCAL_MIN_CONFIDENCE,
+            "audit_rate": NOTIF_LOCAL_AUDIT_RATE,
+            "trained_examples": self.trained_examples,
+            "decisions": self.decisions,
+            "audits": self.audits,
+            "confident_accuracy": accuracy,
+        }
+
+
+_LOCAL_NOTIFICATION_CLASSIFIER = _LocalNotificationClassifier()
+
+
+def _local_notification_category(verdict: Tuple[str, float, str]) -> NotificationCategory:
+    profile = _LOCAL_NOTIFICATION_PROFILES[verdict[0]]
+    return NotificationCategory(
+        category=profile["category"],
+        urgency=profile["urgency"],
+        confidence=round(verdict[1], 3),
+        suggested_action=profile["action"],
+    )
+
+
+def _notification_dict_text(item: Dict[str, Any]) -> Tuple[str, str]:
+    """title/body از اعلان‌های آزادِ کلاینت (کلیدها بین نسخه‌های اپ فرق دارند)."""
+    title = str(item.get("title") or item.get("app") or item.get("sender") or "")
+    body = str(item.get("body") or item.get("text") or item.get("message") or item.get("content") or "")
+    return title, body
+
+
+def _local_triage_summary(kinds: List[str]) -> str:
+    if not kinds:
+        return ""
+    counts: "OrderedDict[str, int]" = OrderedDict()
+    for kind in kinds:
+        counts[kind] = counts.get(kind, 0) + 1
+    parts = "، ".join(f"{count} {_LOCAL_NOTIFICATION_PROFILES[kind]['label']}" for kind, count in counts.items())
+    return f"{len(kinds)} اعلان بدون نیاز به بررسی دسته‌بندی شد: {parts}."
+
+
+def _route_triage_notifications(
+    notifications: List[Dict[str, Any]],
+    endpoint: str,
+) -> Tuple[List[Tuple[str, float, str]], List[int]]:
+    """Run the local tier over a triage batch; returns per-item verdicts and the indices that need the LLM."""
+    verdicts: List[Tuple[str, float, str]] = []
+    ambiguous: List[int] = []
+    for idx, item in enumerate(notifications):
+        title, body = _notification_dict_text(item if isinstance(item, dict) else {"body": item})
+        verdict, local = _LOCAL_NOTIFICATION_CLASSIFIER.route(title, body, endpoint)
+        verdicts.append(verdict)
+        if not local:
+            ambiguous.append(idx)
+    return verdicts, ambiguous
+
+
+def _merge_triage_results(
+    notifications: List[Dict[str, Any]],
+    verdicts: List[Tuple[str, float, str]],
+    ambiguous: List[int],
+    llm_rows: Any,
+    local_item: Any,
+) -> List[Dict[str, Any]]:
+    """
+    خروجی محلی و خروجی LLM (که فقط اعلان‌های مبهم را دیده) را به ترتیب ورودی ادغام می‌کند.
+    ردیف‌های LLM به ترتیب با اندیس‌های مبهم جفت می‌شوند.
+    """
+    merged: List[Optional[Dict[str, Any]]] = [None] * len(notifications)
+    pending = set(ambiguous)
+    for idx, verdict in enumerate(verdicts):
+        if idx not in pending:
+            merged[idx] = local_item(notifications[idx], verdict)
+    rows = [row for row in llm_rows if isinstance(row, dict)] if isinstance(llm_rows, list) else []
+    for idx, row in zip(ambiguous, rows):
+        _LOCAL_NOTIFICATION_CLASSIFIER.audit(verdicts[idx], "triage", row.get("category"))
+        merged[idx] = row
+    extra = rows[len(ambiguous):]
+    return [item for item in merged if item is not None] + extra
+
+
 # =========================
 # 6) POST /user/notifications/categorize
 # =========================
@@ -4599,8 +7220,12 @@ async def get_message_insights() -> InsightsResponse:
 )
 async def categorize_notification(req: CategorizeRequest) -> NotificationCategory:
     """
-    این اندپوینت مستقیم با LLM و _run_structured_completion کار می‌کنه.
+    موارد واضح (OTP، تراکنش، مرسوله و ...) با رده‌بند محلی جواب می‌گیرند؛
+    بقیه با LLM و _run_structured_completion.
     """
+    verdict, local = _LOCAL_NOTIFICATION_CLASSIFIER.route(req.title, req.body, "categorize")
+    if local:
+        return _local_notification_category(verdict)
 
     system_prompt = """
     You classify a single notification based on title and body.
@@ -4631,9 +7256,217 @@ async def categorize_notification(req: CategorizeRequest) -> NotificationCategor
     except ValidationError as e:
         raise HTTPException(status_code=502, detail=f"پاسخ دسته‌بندی نامعتبر است: {e}")
 
+    _LOCAL_NOTIFICATION_CLASSIFIER.audit(verdict, "category", cat.category)
     return cat
 
 
+# =========================
+# 6b) POST /notifications/categorize/batch
+# =========================
+
+NOTIF_BATCH_MAX_ITEMS = int(os.getenv("NOTIF_BATCH_MAX_ITEMS", "500"))
+NOTIF_BATCH_CHUNK_ITEMS = int(os.getenv("NOTIF_BATCH_CHUNK_ITEMS", "25"))
+NOTIF_BATCH_CHUNK_CHARS = int(os.getenv("NOTIF_BATCH_CHUNK_CHARS", "6000"))
+NOTIF_BATCH_BODY_CHARS = int(os.getenv("NOTIF_BATCH_BODY_CHARS", "400"))
+NOTIF_BATCH_CONCURRENCY = int(os.getenv("NOTIF_BATCH_CONCURRENCY", "4"))
+NOTIF_SENDER_CACHE_SIZE = int(os.getenv("NOTIF_SENDER_CACHE_SIZE", "5000"))
+NOTIF_SENDER_CACHE_TTL = float(os.getenv("NOTIF_SENDER_CACHE_TTL", str(6 * 3600)))
+NOTIF_SENDER_CACHE_MIN_CONFIDENCE = float(os.getenv("NOTIF_SENDER_CACHE_MIN_CONFIDENCE", "0.8"))
+
+NOTIFICATION_BATCH_SYSTEM_PROMPT = """
+You classify a batch of notifications. Each input item has an integer "i", a title, a body and maybe a sender.
+Return STRICT JSON with this exact schema and one result per input item:
+
+{
+  "results": [
+    {
+      "i": int,
+      "category": "work|personal|social|system|other",
+      "urgency": "critical|high|medium|low",
+      "confidence": float,
+      "suggested_action": "string or null"
+    }
+  ]
+}
+
+Do NOT include anything other than this JSON.
+"""
+
+# (user_id, sender) -> (stored_at, category); فقط نتایج با اطمینان بالا نگه داشته می‌شوند
+_SENDER_CATEGORY_CACHE: "OrderedDict[Tuple[int, str], Tuple[float, NotificationCategory]]" = OrderedDict()
+
+
+def _sender_cache_get(user_id: int, sender: Optional[str]) -> Optional[NotificationCategory]:
+    if not sender:
+        return None
+    key = (user_id, sender.strip().lower())
+    hit = _SENDER_CATEGORY_CACHE.get(key)
+    if hit is None:
+        return None
+    stored_at, category = hit
+    if time.time() - stored_at > NOTIF_SENDER_CACHE_TTL:
+        _SENDER_CATEGORY_CACHE.pop(key, None)
+        return None
+    _SENDER_CATEGORY_CACHE.move_to_end(key)
+    return category
+
+
+def _sender_cache_put(user_id: int, sender: Optional[str], category: NotificationCategory) -> None:
+    if not sender or category.confidence < NOTIF_SENDER_CACHE_MIN_CONFIDENCE:
+        return
+    key = (user_id, sender.strip().lower())
+    _SENDER_CATEGORY_CACHE[key] = (time.time(), category)
+    _SENDER_CATEGORY_CACHE.move_to_end(key)
+    while len(_SENDER_CATEGORY_CACHE) > NOTIF_SENDER_CACHE_SIZE:
+        _SENDER_CATEGORY_CACHE.popitem(last=False)
+
+
+def _pack_categorize_chunks(items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Greedy packing into prompts bounded by item count and serialized size."""
+    chunks: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    size = 0
+    for item in items:
+        item_size = len(json.dumps(item, ensure_ascii=False))
+        if current and (len(current) >= NOTIF_BATCH_CHUNK_ITEMS or size + item_size > NOTIF_BATCH_CHUNK_CHARS):
+            chunks.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += item_size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def _categorize_chunk(chunk: List[Dict[str, Any]]) -> Dict[int, NotificationCategory]:
+    parsed, _ = await _run_structured_completion(
+        system_prompt=NOTIFICATION_BATCH_SYSTEM_PROMPT,
+        user_prompt=json.dumps({"items": chunk}, ensure_ascii=False),
+        temperature=0.2,
+    )
+    rows = parsed.get("results") if isinstance(parsed, dict) else parsed
+    results: Dict[int, NotificationCategory] = {}
+    expected = {item["i"] for item in chunk}
+    for row in rows if isinstance(rows, list) else []:
+        if not isinstance(row, dict):
+            continue
+        try:
+            idx = int(row.get("i"))
+            results[idx] = NotificationCategory(**{k: v for k, v in row.items() if k != "i"})
+        except (TypeError, ValueError, ValidationError):
+            continue
+    return {idx: cat for idx, cat in results.items() if idx in expected}
+
+
+@app.post(
+    "/notifications/categorize/batch",
+    response_model=BatchCategorizeResponse,
+    summary="Categorize many notifications with a few LLM calls",
+)
+async def categorize_notifications_batch(
+    req: BatchCategorizeRequest,
+    current_user: User = Depends(get_current_user),
+) -> BatchCategorizeResponse:
+    """
+    جایگزین حلقهٔ /notifications/categorize در کلاینت:
+    - اعلان‌های واضح با رده‌بند محلی و بدون LLM جواب می‌گیرند
+    - جفت‌های تکراری title/body فقط یک بار دسته‌بندی می‌شوند
+    - فرستنده‌هایی که اخیراً با اطمینان بالا دسته‌بندی شده‌اند از cache جواب می‌گیرند
+    - بقیه در چند prompt با اندازهٔ محدود به صورت هم‌زمان به LLM داده می‌شوند
+    """
+    items = req.notifications
+    if not items:
+        return BatchCategorizeResponse(results=[])
+    if len(items) > NOTIF_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"حداکثر {NOTIF_BATCH_MAX_ITEMS} اعلان در هر درخواست مجاز است.")
+
+    results: List[Optional[BatchCategorizeResult]] = [None] * len(items)
+    # content key -> index of the representative item
+    representatives: Dict[str, int] = {}
+    duplicates: Dict[int, List[int]] = {}
+    pending: List[Dict[str, Any]] = []
+    verdicts: Dict[int, Tuple[str, float, str]] = {}
+    for idx, item in enumerate(items):
+        verdict, local = _LOCAL_NOTIFICATION_CLASSIFIER.route(item.title, item.body, "batch")
+        if local:
+            results[idx] = BatchCategorizeResult(
+                index=idx, id=item.id, result=_local_notification_category(verdict), source="local"
+            )
+            continue
+        cached = _sender_cache_get(current_user.id, item.sender)
+        if cached is not None:
+            results[idx] = BatchCategorizeResult(index=idx, id=item.id, result=cached, source="sender_cache")
+            continue
+        key = hashlib.sha1(f"{item.title.strip()}\n{item.body.strip()}".encode("utf-8")).hexdigest()
+        if key in representatives:
+            duplicates.setdefault(representatives[key], []).append(idx)
+            continue
+        representatives[key] = idx
+        verdicts[idx] = verdict
+        entry: Dict[str, Any] = {"i": idx, "title": item.title[:200], "body": item.body[:NOTIF_BATCH_BODY_CHARS]}
+        if item.sender:
+            entry["sender"] = item.sender
+        pending.append(entry)
+
+    chunks = _pack_categorize_chunks(pending)
+    semaphore = asyncio.Semaphore(max(1, NOTIF_BATCH_CONCURRENCY))
+
+    async def _run(chunk: List[Dict[str, Any]]) -> Optional[Dict[int, NotificationCategory]]:
+        """None when the chunk was refused for LLM capacity."""
+        async with semaphore:
+            try:
+                return await _categorize_chunk(chunk)
+            except LLMSaturatedError as exc:
+                log.info("Batch categorize chunk saturated (%d items): %s", len(chunk), exc)
+                return None
+            except Exception as exc:  # noqa: BLE001
+                log.warning("Batch categorize chunk failed (%d items): %s", len(chunk), exc)
+                return {}
+
+    categorized: Dict[int, NotificationCategory] = {}
+    chunk_results = await asyncio.gather(*(_run(chunk) for chunk in chunks))
+    if chunk_results and all(chunk_result is None for chunk_result in chunk_results) and not any(results):
+        # هیچ چیزی برای برگرداندن نیست؛ کلاینت بعد از Retry-After دوباره تلاش کند
+        raise LLMSaturatedError("LLM capacity saturated", _LLM_GOVERNOR.retry_after())
+    for chunk_result in chunk_results:
+        # chunkهای رد شده fallback می‌گیرند و نتیجهٔ chunkهای موفق حفظ می‌شود
+        categorized.update(chunk_result or {})
+
+    for entry in pending:
+        idx = entry["i"]
+        item = items[idx]
+        category = categorized.get(idx)
+        source = "llm"
+        if category is None:
+            category, source = NotificationCategory(), "fallback"
+        else:
+            _sender_cache_put(current_user.id, item.sender, category)
+            _LOCAL_NOTIFICATION_CLASSIFIER.audit(verdicts[idx], "category", category.category)
+        results[idx] = BatchCategorizeResult(index=idx, id=item.id, result=category, source=source)
+        for dup_idx in duplicates.get(idx, []):
+            results[dup_idx] = BatchCategorizeResult(
+                index=dup_idx,
+                id=items[dup_idx].id,
+                result=category,
+                source="duplicate" if source == "llm" else source,
+            )
+
+    return BatchCategorizeResponse(
+        results=[r for r in results if r is not None],
+        unique_items=len(pending),
+        llm_calls=len(chunks),
+    )
+
+
+@app.get("/notifications/classifier/stats", summary="Local notification classifier usage and audited accuracy")
+async def notification_classifier_stats(current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """
+    تعداد اعلان‌هایی که محلی جواب گرفتند / به LLM رفتند و دقت پیش‌بینی‌های محلی
+    در مقایسه با برچسب LLM (برای تنظیم NOTIF_LOCAL_MIN_CONFIDENCE).
+    """
+    return _LOCAL_NOTIFICATION_CLASSIFIER.snapshot()
+
+
 # =========================
 # 7) GET /user/messages/action-items
 # =========================
@@ -4643,28 +7476,43 @@ async def categorize_notification(req: CategorizeRequest) -> NotificationCategor
     response_model=ActionItemsResponse,
     summary="Extract action items from messages",
 )
-async def extract_action_items() -> ActionItemsResponse:
+async def extract_action_items(current_user: User = Depends(get_current_user)) -> ActionItemsResponse:
     """
     Flutter: GET /user/messages/action-items
     بعد response['action_items'] رو parse می‌کنه.
+    action itemهای باز از summaryهای ذخیره‌شدهٔ اخیر (بدون LLM).
     """
 
-    # TODO: پیام‌های خام رو از DB بگیر و بده به LLM برای استخراج action item.
-    # فعلاً fake:
-    items: List[ActionItem] = [
-        ActionItem(
-            item_id="act_1",
-            title="Prepare quarterly report",
-            description="Prepare and send the Q1 report to finance.",
-            due_date="2025-01-10",
-            assignee="me",
-            priority="high",
-            source="msg_1",
-            completed=False,
+    items = await _recent_action_items(current_user.id)
+    return ActionItemsResponse(action_items=items)
+
+
+async def _recent_action_items(user_id: int) -> List[ActionItem]:
+    since = datetime.utcnow().date() - timedelta(days=NOTIF_RECENT_DAYS)
+    async with async_session() as session:
+        result = await session.execute(
+            select(StoredNotificationSummary.payload).where(
+                StoredNotificationSummary.user_id == user_id,
+                StoredNotificationSummary.summary_date >= since,
+            ).order_by(StoredNotificationSummary.generated_at.desc()).limit(20)
         )
-    ]
+        payloads = result.scalars().all()
 
-    return ActionItemsResponse(action_items=items)
+    items: List[ActionItem] = []
+    seen: set = set()
+    for payload in payloads:
+        for raw in (payload or {}).get("action_items") or []:
+            try:
+                item = ActionItem(**raw)
+            except (TypeError, ValidationError):
+                continue
+            key = item.item_id or item.title.strip().lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            if not item.completed:
+                items.append(item)
+    return items
 
 
 # =========================
@@ -4675,10 +7523,23 @@ async def extract_action_items() -> ActionItemsResponse:
     "/notifications/{notification_id}/processed",
     summary="Mark notification as processed by AI",
 )
-async def mark_notification_processed(notification_id: str) -> Dict[str, bool]:
-    # TODO: توی DB فلگ notification رو به processed تغییر بده
-    # اگر notification پیدا نشد:
-    # raise HTTPException(status_code=404, detail="Notification not found")
+async def mark_notification_processed(
+    notification_id: str,
+    current_user: User = Depends(get_current_user),
+) -> Dict[str, bool]:
+    # notification_id همان id کلاینت است؛ id عددی DB هم پذیرفته می‌شود
+    match = StoredNotification.external_id == notification_id
+    if notification_id.isdigit():
+        match = or_(match, StoredNotification.id == int(notification_id))
+    async with async_session() as session:
+        result = await session.execute(
+            update(StoredNotification)
+            .where(StoredNotification.user_id == current_user.id, match)
+            .values(processed=True)
+        )
+        await session.commit()
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail="Notification not found")
 
     return {"ok": True}
 
@@ -4692,24 +7553,152 @@ async def mark_notification_processed(notification_id: str) -> Dict[str, bool]:
     response_model=NotificationTrendsResponse,
     summary="Get notification trends",
 )
-async def get_notification_trends(days: int = Query(7, ge=1, le=90)) -> NotificationTrendsResponse:
+async def get_notification_trends(
+    days: int = Query(7, ge=1, le=90),
+    current_user: User = Depends(get_current_user),
+) -> NotificationTrendsResponse:
     """
     Flutter: GET /user/notifications/trends?days=7
+    حداکثر ۹۰ ردیف rollup روزانه خوانده می‌شود، نه خود اعلان‌ها.
     """
 
-    # TODO: از DB آمار روزانه رو حساب کن، اگر خواستی قسمتی ازش رو با LLM enrich کن.
-    trends = NotificationTrends(
-        total_notifications=120,
-        average_per_day=120 // days,
-        top_senders=["Telegram", "Gmail", "Slack"],
-        category_breakdown={"work": 40, "personal": 30, "social": 25, "system": 25},
-        average_sentiment=0.15,
-        emerging_topics=["travel", "billing"],
-    )
+    rollups = await _load_notification_rollups(current_user.id, days)
+    trends = _trends_from_rollups(rollups, days, datetime.utcnow().date())
 
     return NotificationTrendsResponse(**trends.dict())
 
 
+# =========================
+# 9b) Snooze scheduler
+# =========================
+
+SNOOZE_SCHEDULER_ENABLED = os.getenv("SNOOZE_SCHEDULER_ENABLED", "1") == "1"
+SNOOZE_MAX_MINUTES = int(os.getenv("SNOOZE_MAX_MINUTES", str(7 * 24 * 60)))
+# فقط snoozeهایی که تا این چند ثانیهٔ آینده تمام می‌شوند در حافظه نگه داشته می‌شوند
+SNOOZE_SCHEDULER_HORIZON = float(os.getenv("SNOOZE_SCHEDULER_HORIZON", "900"))
+SNOOZE_SCHEDULER_BATCH = int(os.getenv("SNOOZE_SCHEDULER_BATCH", "5000"))
+
+
+class _SnoozeScheduler:
+    """
+    Min-heap of snoozes expiring within SNOOZE_SCHEDULER_HORIZON.
+
+    The heap is refilled from the DB with an indexed range query (released_at IS NULL,
+    expires_at <= horizon), so memory stays bounded no matter how many snoozes exist and
+    overdue rows are picked up after a restart. A due snooze is claimed with a conditional
+    UPDATE, so with several workers only one of them sends the push.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[datetime, int, int, Optional[str]]] = []
+        self._scheduled: set = set()  # (snooze_id, expires_at)
+        self._loaded_until = datetime.min
+        self._next_refill = datetime.min
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run())
+            log.info("Snooze scheduler started.")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def schedule(self, snooze_id: int, user_id: int, category: Optional[str], expires_at: datetime) -> None:
+        """O(log n) insert; snoozes beyond the loaded window are left to the next refill."""
+        if expires_at > self._loaded_until or (snooze_id, expires_at) in self._scheduled:
+            return
+        self._scheduled.add((snooze_id, expires_at))
+        heapq.heappush(self._heap, (expires_at, snooze_id, user_id, category))
+        if self._heap[0][1] == snooze_id:
+            self._wake.set()
+
+    async def _refill(self, now: datetime) -> None:
+        horizon = now + timedelta(seconds=SNOOZE_SCHEDULER_HORIZON)
+        async with async_session() as session:
+            result = await session.execute(
+                select(
+                    NotificationSnooze.id,
+                    NotificationSnooze.user_id,
+                    NotificationSnooze.category,
+                    NotificationSnooze.expires_at,
+                ).where(
+                    NotificationSnooze.released_at.is_(None),
+                    NotificationSnooze.expires_at <= horizon,
+                ).order_by(NotificationSnooze.expires_at).limit(SNOOZE_SCHEDULER_BATCH)
+            )
+            rows = result.all()
+        # اگر batch پر شد فقط تا آخرین ردیفِ خوانده‌شده پوشش داریم
+        self._loaded_until = rows[-1][3] if len(rows) >= SNOOZE_SCHEDULER_BATCH else horizon
+        self._next_refill = min(self._loaded_until, now + timedelta(seconds=SNOOZE_SCHEDULER_HORIZON / 2))
+        for snooze_id, user_id, category, expires_at in rows:
+            self.schedule(snooze_id, user_id, category, expires_at)
+
+    async def _claim(self, snooze_id: int, now: datetime) -> bool:
+        async with async_session() as session:
+            result = await session.execute(
+                update(NotificationSnooze)
+                .where(
+                    NotificationSnooze.id == snooze_id,
+                    NotificationSnooze.released_at.is_(None),
+                    NotificationSnooze.expires_at <= now,
+                )
+                .values(released_at=now)
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    async def _release_due(self, now: datetime) -> None:
+        due: List[Tuple[datetime, int, int, Optional[str]]] = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            self._scheduled.discard((entry[1], entry[0]))
+            due.append(entry)
+        for _, snooze_id, user_id, category in due:
+            # اگر snooze تمدید یا لغو شده باشد claim شکست می‌خورد
+            if not await self._claim(snooze_id, now):
+                continue
+            body = (
+                f"اعلان‌های دستهٔ «{category}» دوباره فعال شدند."
+                if category
+                else "همهٔ اعلان‌ها دوباره فعال شدند."
+            )
+            try:
+                await _send_push_notification(user_id, "پایان توقف اعلان‌ها", body)
+            except Exception as exc:  # noqa: BLE001
+                log.warning("Snooze %s push failed: %s", snooze_id, exc)
+
+    async def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                now = datetime.utcnow()
+                try:
+                    if now >= self._next_refill:
+                        await self._refill(now)
+                    await self._release_due(datetime.utcnow())
+                except Exception as exc:  # noqa: BLE001
+                    log.exception("Snooze scheduler iteration failed: %s", exc)
+                    self._next_refill = datetime.utcnow() + timedelta(seconds=30)
+                wake_at = self._next_refill
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                timeout = max(0.0, (wake_at - datetime.utcnow()).total_seconds())
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            log.info("Snooze scheduler stopped.")
+
+
+_SNOOZE_SCHEDULER = _SnoozeScheduler()
+
+
 # =========================
 # 10) POST /user/notifications/snooze
 # =========================
@@ -4718,19 +7707,100 @@ async def get_notification_trends(days: int = Query(7, ge=1, le=90)) -> Notifica
     "/notifications/snooze",
     summary="Snooze notifications for a period",
 )
-async def snooze_notifications(req: SnoozeRequest) -> Dict[str, bool]:
+async def snooze_notifications(
+    req: SnoozeRequest,
+    current_user: User = Depends(get_current_user),
+) -> Dict[str, Any]:
     """
     Flutter:
     apiClient.postJson('/user/notifications/snooze', body: {
         'snooze_minutes': snoozeDuration.inMinutes,
         'category': category,
     });
+    snooze دوباره روی همان دسته فقط زمان پایان را جابه‌جا می‌کند.
     """
 
-    # TODO: تنظیمات snooze را در DB/سیستم نوتیف کاربر ذخیره کن
-    return {"ok": True}
+    if req.snooze_minutes < 1 or req.snooze_minutes > SNOOZE_MAX_MINUTES:
+        raise HTTPException(status_code=400, detail=f"مدت snooze باید بین ۱ و {SNOOZE_MAX_MINUTES} دقیقه باشد.")
+    now = datetime.utcnow()
+    expires_at = now + timedelta(minutes=req.snooze_minutes)
+    category = (req.category or "").strip().lower() or None
+    async with async_session() as session:
+        result = await session.execute(
+            select(NotificationSnooze).where(
+                NotificationSnooze.user_id == current_user.id,
+                NotificationSnooze.category.is_(None) if category is None else NotificationSnooze.category == category,
+                NotificationSnooze.released_at.is_(None),
+            )
+        )
+        snooze = result.scalars().first()
+        if snooze is None:
+            snooze = NotificationSnooze(user_id=current_user.id, category=category, snoozed_at=now)
+            session.add(snooze)
+        snooze.expires_at = expires_at
+        await session.commit()
+        snooze_id = snooze.id
+
+    _SNOOZE_SCHEDULER.schedule(snooze_id, current_user.id, category, expires_at)
+    return {"ok": True, "snooze_id": snooze_id, "category": category, "expires_at": expires_at.isoformat()}
+
+
+@app.get("/notifications/snooze", summary="List active snoozes")
+async def list_snoozes(current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    async with async_session() as session:
+        result = await session.execute(
+            select(NotificationSnooze).where(
+                NotificationSnooze.user_id == current_user.id,
+                NotificationSnooze.released_at.is_(None),
+                NotificationSnooze.expires_at > datetime.utcnow(),
+            ).order_by(NotificationSnooze.expires_at)
+        )
+        snoozes = [
+            {"snooze_id": row.id, "category": row.category, "expires_at": row.expires_at.isoformat()}
+            for row in result.scalars().all()
+        ]
+    return {"snoozes": snoozes}
+
+
+@app.delete("/notifications/snooze", summary="Cancel snoozes early")
+async def cancel_snoozes(
+    category: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+) -> Dict[str, Any]:
+    """بدون category همهٔ snoozeهای فعال لغو می‌شوند (بدون push)."""
+    conditions = [NotificationSnooze.user_id == current_user.id, NotificationSnooze.released_at.is_(None)]
+    if category:
+        conditions.append(NotificationSnooze.category == category.strip().lower())
+    async with async_session() as session:
+        result = await session.execute(
+            update(NotificationSnooze).where(*conditions).values(released_at=datetime.utcnow())
+        )
+        await session.commit()
+    return {"ok": True, "cancelled": result.rowcount or 0}
+
+
 @app.post("/assistant/notifications/classify", response_model=GenericAIResponse)
 async def notification_intel(body: NotificationIntelRequest, current_user: User = Depends(get_current_user)):
+    verdicts, ambiguous = _route_triage_notifications(body.notifications, "assistant_classify")
+
+    def _local_item(item: Dict[str, Any], verdict: Tuple[str, float, str]) -> Dict[str, Any]:
+        profile = _LOCAL_NOTIFICATION_PROFILES[verdict[0]]
+        return {
+            "title": _notification_dict_text(item)[0] or profile["label"],
+            "category": profile["triage"],
+            "suggested_action": profile["action"] or "",
+            "source": "local",
+        }
+
+    escalated = set(ambiguous)
+    local_kinds = [verdict[0] for idx, verdict in enumerate(verdicts) if idx not in escalated]
+    if not ambiguous:
+        payload = {
+            "classified": _merge_triage_results(body.notifications, verdicts, [], [], _local_item),
+            "summary": _local_triage_summary(local_kinds),
+        }
+        return GenericAIResponse(payload=payload, raw_text="")
+
     system_prompt = (
         "تو یک Notification Intelligence هستی. JSON بده با کلیدهای "
         '{"classified": [{"title": str, "category": "critical|important|normal|spam", "suggested_action": str}]} '
@@ -4738,12 +7808,19 @@ async def notification_intel(body: NotificationIntelRequest, current_user: User
     )
     user_prompt = (
         f"مود: {body.mode or 'نامشخص'} | تایم‌زون: {body.timezone or 'Asia/Tehran'}\n"
-        f"نوتیف‌ها: {_to_json(body.notifications)}\n"
+        f"نوتیف‌ها: {_to_json([body.notifications[i] for i in ambiguous])}\n"
         f"کانتکست: {_to_json(body.context) if body.context else '{}'}"
     )
     parsed, raw_text = await _run_structured_completion(system_prompt, user_prompt, temperature=0.2)
     if not isinstance(parsed, dict):
         raise HTTPException(status_code=502, detail="JSON نامعتبر.")
+    parsed["classified"] = _merge_triage_results(
+        body.notifications, verdicts, ambiguous, parsed.get("classified"), _local_item
+    )
+    if local_kinds:
+        parsed["summary"] = " ".join(
+            part for part in (_local_triage_summary(local_kinds), str(parsed.get("summary") or "")) if part
+        )
     return GenericAIResponse(payload=parsed, raw_text=raw_text)
 @app.post("/assistant/inbox/intel", response_model=GenericAIResponse)
 async def inbox_intel(body: InboxIntelRequest, current_user: User = Depends(get_current_user)):
@@ -4769,6 +7846,7 @@ async def smart_scheduler(body: WeeklySchedulerRequest, current_user: User = Dep
         "از hard_events برای جلوگیری از تداخل استفاده کن. زمان‌ها را ISO بده."
     )
     user_prompt = (
+        f"{_user_context_line(await _user_context(current_user.id))}"
         f"اهداف هفته: {_to_json(body.goals)}\n"
         f"رویدادهای غیرقابل‌تغییر: {_to_json(body.hard_events) if body.hard_events else '[]'}\n"
         f"زمان: {body.now or 'نامشخص'} ({body.timezone or 'Asia/Tehran'})\n"
@@ -4802,6 +7880,20 @@ async def _startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     await _reset_stale_agent_tasks()
+    await _ensure_habit_log_day_index()
+    if await _claim_mood_backfill():
+        asyncio.create_task(_run_mood_backfill())
+    asyncio.create_task(_backfill_habit_stats())
+    if NOTIF_LOCAL_CLASSIFIER_ENABLED:
+        await asyncio.to_thread(_LOCAL_NOTIFICATION_CLASSIFIER.ensure_trained)
+    if SNOOZE_SCHEDULER_ENABLED:
+        _SNOOZE_SCHEDULER.start()
+    if REMINDER_ENGINE_ENABLED:
+        asyncio.create_task(_backfill_task_reminders())
+        _REMINDER_ENGINE.start()
+    asyncio.create_task(_recurrence_materializer_worker())
+    if PREGEN_ENABLED:
+        asyncio.create_task(_pregeneration_worker())
     AGENT_SCHEDULER_STOP.clear()
     global AGENT_SCHEDULER_TASK
     if AGENT_SCHEDULER_TASK is None or AGENT_SCHEDULER_TASK.done():
@@ -5158,6 +8250,7 @@ async def record_mood(
             created_at=datetime.utcnow(),
         )
         session.add(snapshot)
+        await _add_mood_aggregates(session, current_user.id, [snapshot])
         
         # Update profile average
         stmt = select(UserProfile).where(UserProfile.user_id == current_user.id)
@@ -5183,7 +8276,7 @@ async def record_mood(
         )
 @app.get("/user/mood/history")
 async def get_mood_history(
-    last: int = 30,
+    last: int = Query(30, ge=1, le=500),
     current_user: User = Depends(get_current_user),
 ):
     """Get mood history"""
@@ -5208,13 +8301,16 @@ async def get_mood_history(
         avg_energy = sum(s.energy for s in snapshots) / len(snapshots)
         avg_mood = sum(s.mood for s in snapshots) / len(snapshots)
         
-        # Determine trend (simplified)
-        if len(snapshots) >= 2:
-            recent_avg = sum(s.energy for s in snapshots[:5]) / min(5, len(snapshots))
-            older_avg = sum(s.energy for s in snapshots[-5:]) / min(5, len(snapshots))
-            trend = "improving" if recent_avg > older_avg else ("declining" if recent_avg < older_avg else "stable")
-        else:
-            trend = "stable"
+        # Trend: regression slope of daily energy over the listed snapshots' span
+        now = datetime.utcnow()
+        since = min(_naive_utc(s.timestamp) for s in snapshots).date()
+        rows = [row for row in await _mood_daily_series(current_user.id, since) if row.count]
+        slope = _mood_slope(
+            [(datetime.combine(row.day, datetime.min.time()) - now).total_seconds() / 86400.0 for row in rows],
+            [row.energy_sum / row.count for row in rows],
+            [row.count for row in rows],
+        )
+        trend = _mood_trend_label(slope)
         
         return MoodHistoryResponse(
             snapshots=[
@@ -5233,6 +8329,335 @@ async def get_mood_history(
             avg_mood=avg_mood,
             trend=trend,
         )
+# ═══════════════════════════════════════════════════════════════════
+# MOOD ANALYTICS - hourly/daily aggregates maintained on insert
+# ═══════════════════════════════════════════════════════════════════
+MOOD_TREND_MAX_DAYS = int(os.getenv("MOOD_TREND_MAX_DAYS", "730"))
+MOOD_HOURLY_MAX_DAYS = int(os.getenv("MOOD_HOURLY_MAX_DAYS", "120"))
+MOOD_TREND_STABLE_SLOPE = float(os.getenv("MOOD_TREND_STABLE_SLOPE", "0.02"))  # points per day
+_MOOD_SUM_COLUMNS = ("count", "energy_sum", "energy_sq", "mood_sum", "mood_sq")
+
+
+def _user_zone(name: Optional[str]):
+    """ZoneInfo of a profile timezone; UTC when it is unknown or tzdata is missing."""
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name or "Asia/Tehran")
+    except Exception:  # noqa: BLE001
+        return timezone.utc
+
+
+def _mood_bucket_sums(snapshots: List[MoodSnapshot]) -> Tuple[Dict[datetime, List[int]], Dict[date, List[int]]]:
+    hourly: Dict[datetime, List[int]] = {}
+    daily: Dict[date, List[int]] = {}
+    for snapshot in snapshots:
+        moment = _naive_utc(snapshot.timestamp)
+        values = (1, snapshot.energy, snapshot.energy ** 2, snapshot.mood, snapshot.mood ** 2)
+        for bucket, key in ((hourly, moment.replace(minute=0, second=0, microsecond=0)), (daily, moment.date())):
+            sums = bucket.setdefault(key, [0] * len(_MOOD_SUM_COLUMNS))
+            for position, value in enumerate(values):
+                sums[position] += value
+    return hourly, daily
+
+
+async def _upsert_mood_sums(session: AsyncSession, model: Any, key_name: str, rows: List[Dict[str, Any]]) -> None:
+    """Add bucket sums to existing rows; concurrent first writes of a bucket both land on MySQL."""
+    if not rows:
+        return
+    if engine.sync_engine.dialect.name == "mysql":
+        stmt = mysql_insert(model).values(rows)
+        await session.execute(stmt.on_duplicate_key_update(
+            **{name: getattr(model, name) + stmt.inserted[name] for name in _MOOD_SUM_COLUMNS}
+        ))
+        return
+    key_column = getattr(model, key_name)
+    for row in rows:
+        increments = {name: getattr(model, name) + row[name] for name in _MOOD_SUM_COLUMNS}
+        result = await session.execute(
+            update(model).where(model.user_id == row["user_id"], key_column == row[key_name]).values(**increments)
+        )
+        if result.rowcount == 0:
+            session.add(model(**row))
+    await session.flush()
+
+
+async def _add_mood_aggregates(session: AsyncSession, user_id: int, snapshots: List[MoodSnapshot]) -> None:
+    """Add new snapshots to their hourly and daily buckets in the caller's transaction."""
+    hourly, daily = _mood_bucket_sums(snapshots)
+    for model, key_name, buckets in (
+        (MoodHourlyAggregate, "hour", hourly),
+        (MoodDailyAggregate, "day", daily),
+    ):
+        await _upsert_mood_sums(session, model, key_name, [
+            {"user_id": user_id, key_name: key, **dict(zip(_MOOD_SUM_COLUMNS, sums))}
+            for key, sums in buckets.items()
+        ])
+
+
+MOOD_BACKFILL_JOB = "mood_aggregates"
+MOOD_BACKFILL_LEASE_SECONDS = int(os.getenv("MOOD_BACKFILL_LEASE_SECONDS", "300"))
+_MAINTENANCE_OWNER = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+
+async def _claim_mood_backfill() -> bool:
+    """
+    Take the lease of the aggregate backfill. The first claim pins the snapshot id range
+    (up to the current max id); everything inserted later is counted by _add_mood_aggregates.
+    """
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=MOOD_BACKFILL_LEASE_SECONDS)
+    async with async_session() as session:
+        result = await session.execute(
+            update(MaintenanceJob)
+            .where(
+                MaintenanceJob.name == MOOD_BACKFILL_JOB,
+                MaintenanceJob.completed.is_(False),
+                or_(MaintenanceJob.lease_until < now, MaintenanceJob.owner == _MAINTENANCE_OWNER),
+            )
+            .values(owner=_MAINTENANCE_OWNER, lease_until=lease_until)
+        )
+        if result.rowcount == 1:
+            await session.commit()
+            return True
+        existing = await session.execute(select(MaintenanceJob.id).where(MaintenanceJob.name == MOOD_BACKFILL_JOB))
+        if existing.first() is not None:
+            return False
+        # جدول‌هایی که قبل از این marker پر شده‌اند دوباره شمرده نمی‌شوند
+        built = (await session.execute(select(MoodDailyAggregate.id).limit(1))).first() is not None
+        target = (await session.execute(select(func.max(MoodSnapshot.id)))).scalar() or 0
+        session.add(MaintenanceJob(
+            name=MOOD_BACKFILL_JOB,
+            owner=_MAINTENANCE_OWNER,
+            lease_until=lease_until,
+            cursor=0,
+            target=target,
+            completed=built or target == 0,
+        ))
+        try:
+            await session.commit()
+        except IntegrityError:
+            # worker دیگری هم‌زمان marker را ساخت
+            return False
+    return not (built or target == 0)
+
+
+async def _backfill_mood_aggregates(batch_size: int = 2000) -> int:
+    """
+    Build aggregates from pre-existing snapshots in keyset batches. The job cursor is
+    committed with each batch, so a worker taking over an expired lease resumes without
+    counting a snapshot twice.
+    """
+    added = 0
+    while True:
+        async with async_session() as session:
+            job = (
+                await session.execute(
+                    select(MaintenanceJob)
+                    .where(MaintenanceJob.name == MOOD_BACKFILL_JOB, MaintenanceJob.owner == _MAINTENANCE_OWNER)
+                    .with_for_update()
+                )
+            ).scalar_one_or_none()
+            if job is None or job.completed:
+                return added
+            result = await session.execute(
+                select(MoodSnapshot)
+                .where(MoodSnapshot.id > job.cursor, MoodSnapshot.id <= job.target)
+                .order_by(MoodSnapshot.id)
+                .limit(batch_size)
+            )
+            snapshots = result.scalars().all()
+            if not snapshots:
+                job.completed = True
+                await session.commit()
+                log.info("Mood aggregates backfilled from %s snapshots", added)
+                return added
+            by_user: Dict[int, List[MoodSnapshot]] = {}
+            for snapshot in snapshots:
+                by_user.setdefault(snapshot.user_id, []).append(snapshot)
+            hourly_rows: List[Dict[str, Any]] = []
+            daily_rows: List[Dict[str, Any]] = []
+            for user_id, items in by_user.items():
+                user_hourly, user_daily = _mood_bucket_sums(items)
+                hourly_rows += [{"user_id": user_id, "hour": key, **dict(zip(_MOOD_SUM_COLUMNS, sums))} for key, sums in user_hourly.items()]
+                daily_rows += [{"user_id": user_id, "day": key, **dict(zip(_MOOD_SUM_COLUMNS, sums))} for key, sums in user_daily.items()]
+            await _upsert_mood_sums(session, MoodHourlyAggregate, "hour", hourly_rows)
+            await _upsert_mood_sums(session, MoodDailyAggregate, "day", daily_rows)
+            job.cursor = snapshots[-1].id
+            job.lease_until = datetime.utcnow() + timedelta(seconds=MOOD_BACKFILL_LEASE_SECONDS)
+            await session.commit()
+            added += len(snapshots)
+
+
+async def _run_mood_backfill() -> None:
+    try:
+        await _backfill_mood_aggregates()
+    except Exception as exc:  # noqa: BLE001
+        log.warning("Mood aggregate backfill stopped: %s", exc)
+
+
+def _mood_stats(count: int, total: float, squares: float) -> Tuple[float, float]:
+    mean = total / count
+    return mean, math.sqrt(max(0.0, squares / count - mean * mean))
+
+
+def _mood_slope(xs: List[float], ys: List[float], weights: List[float]) -> float:
+    """Least-squares slope of y over x with each bucket mean weighted by its snapshot count."""
+    if len(xs) < 2:
+        return 0.0
+    if np is not None:
+        x, y, w = np.array(xs), np.array(ys), np.array(weights, dtype=float)
+        x_mean = np.average(x, weights=w)
+        y_mean = np.average(y, weights=w)
+        denominator = float(np.sum(w * (x - x_mean) ** 2))
+        return float(np.sum(w * (x - x_mean) * (y - y_mean)) / denominator) if denominator else 0.0
+    total = sum(weights)
+    x_mean = sum(w * x for x, w in zip(xs, weights)) / total
+    y_mean = sum(w * y for y, w in zip(ys, weights)) / total
+    denominator = sum(w * (x - x_mean) ** 2 for x, w in zip(xs, weights))
+    if not denominator:
+        return 0.0
+    return sum(w * (x - x_mean) * (y - y_mean) for x, y, w in zip(xs, ys, weights)) / denominator
+
+
+def _mood_trend_label(slope: float) -> str:
+    if slope > MOOD_TREND_STABLE_SLOPE:
+        return "improving"
+    if slope < -MOOD_TREND_STABLE_SLOPE:
+        return "declining"
+    return "stable"
+
+
+async def _mood_daily_series(user_id: int, since: date) -> List[MoodDailyAggregate]:
+    async with async_session() as session:
+        result = await session.execute(
+            select(MoodDailyAggregate)
+            .where(MoodDailyAggregate.user_id == user_id, MoodDailyAggregate.day >= since)
+            .order_by(MoodDailyAggregate.day)
+        )
+        return list(result.scalars().all())
+
+
+@app.get("/user/mood/trends", response_model=MoodTrendResponse)
+async def get_mood_trends(
+    days: int = Query(30, ge=1, le=MOOD_TREND_MAX_DAYS),
+    granularity: Literal["day", "hour"] = "day",
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Mood/energy series for the last `days` from the aggregates (never raw snapshots), with
+    count-weighted regression slopes in points per day.
+    """
+    now = datetime.utcnow()
+    if granularity == "hour":
+        if days > MOOD_HOURLY_MAX_DAYS:
+            raise HTTPException(status_code=400, detail=f"سری ساعتی حداکثر {MOOD_HOURLY_MAX_DAYS} روز است.")
+        async with async_session() as session:
+            result = await session.execute(
+                select(MoodHourlyAggregate)
+                .where(MoodHourlyAggregate.user_id == current_user.id, MoodHourlyAggregate.hour >= now - timedelta(days=days))
+                .order_by(MoodHourlyAggregate.hour)
+            )
+            rows = list(result.scalars().all())
+        starts = [row.hour for row in rows]
+    else:
+        rows = await _mood_daily_series(current_user.id, (now - timedelta(days=days - 1)).date())
+        starts = [datetime.combine(row.day, datetime.min.time()) for row in rows]
+
+    points: List[MoodTrendPoint] = []
+    xs: List[float] = []
+    energy_means: List[float] = []
+    mood_means: List[float] = []
+    weights: List[float] = []
+    for start, row in zip(starts, rows):
+        if not row.count:
+            continue
+        energy, energy_std = _mood_stats(row.count, row.energy_sum, row.energy_sq)
+        mood, mood_std = _mood_stats(row.count, row.mood_sum, row.mood_sq)
+        points.append(MoodTrendPoint(
+            start=start, count=row.count,
+            avg_energy=round(energy, 2), avg_mood=round(mood, 2),
+            std_energy=round(energy_std, 2), std_mood=round(mood_std, 2),
+        ))
+        xs.append((start - now).total_seconds() / 86400.0)
+        energy_means.append(energy)
+        mood_means.append(mood)
+        weights.append(row.count)
+    total = sum(weights)
+    energy_slope = _mood_slope(xs, energy_means, weights)
+    mood_slope = _mood_slope(xs, mood_means, weights)
+    return MoodTrendResponse(
+        days=days,
+        granularity=granularity,
+        points=points,
+        count=int(total),
+        avg_energy=round(sum(m * w for m, w in zip(energy_means, weights)) / total, 2) if total else None,
+        avg_mood=round(sum(m * w for m, w in zip(mood_means, weights)) / total, 2) if total else None,
+        energy_slope=round(energy_slope, 4),
+        mood_slope=round(mood_slope, 4),
+        trend=_mood_trend_label(mood_slope),
+    )
+
+
+@app.get("/user/mood/heatmap", response_model=MoodHeatmapResponse)
+async def get_mood_heatmap(
+    days: int = Query(90, ge=7, le=MOOD_HOURLY_MAX_DAYS),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Average mood/energy by local day-of-week (Saturday first) x hour-of-day, folded from the
+    hourly aggregates. With half-hour offsets (Asia/Tehran) a UTC hour lands on the local
+    hour its start falls in.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(MoodHourlyAggregate.hour, *[getattr(MoodHourlyAggregate, name) for name in _MOOD_SUM_COLUMNS])
+            .where(
+                MoodHourlyAggregate.user_id == current_user.id,
+                MoodHourlyAggregate.hour >= datetime.utcnow() - timedelta(days=days),
+            )
+        )
+        rows = result.all()
+        profile_zone = (
+            await session.execute(select(UserProfile.timezone).where(UserProfile.user_id == current_user.id))
+        ).scalar_one_or_none()
+    zone = _user_zone(profile_zone)
+
+    cells = [((local.weekday() - 5) % 7, local.hour) for local in (
+        hour.replace(tzinfo=timezone.utc).astimezone(zone) for hour, *_ in rows
+    )]
+    if np is not None:
+        sums = np.zeros((3, 7, 24))
+        if rows:
+            day_index = np.array([cell[0] for cell in cells])
+            hour_index = np.array([cell[1] for cell in cells])
+            values = np.array([(count, energy, mood) for _, count, energy, _, mood, _ in rows], dtype=float)
+            for layer in range(3):
+                np.add.at(sums[layer], (day_index, hour_index), values[:, layer])
+        counts, energy_sums, mood_sums = sums.tolist()
+    else:
+        counts = [[0.0] * 24 for _ in range(7)]
+        energy_sums = [[0.0] * 24 for _ in range(7)]
+        mood_sums = [[0.0] * 24 for _ in range(7)]
+        for (day_index, hour_index), (_, count, energy, _, mood, _) in zip(cells, rows):
+            counts[day_index][hour_index] += count
+            energy_sums[day_index][hour_index] += energy
+            mood_sums[day_index][hour_index] += mood
+
+    def _averages(sums: List[List[float]]) -> List[List[Optional[float]]]:
+        return [
+            [round(total / count, 2) if count else None for total, count in zip(sum_row, count_row)]
+            for sum_row, count_row in zip(sums, counts)
+        ]
+
+    return MoodHeatmapResponse(
+        days=days,
+        timezone=str(zone),
+        counts=[[int(count) for count in row] for row in counts],
+        avg_energy=_averages(energy_sums),
+        avg_mood=_averages(mood_sums),
+    )
+
+
 @app.post("/user/goals/{goal_id}/complete")
 async def complete_goal(
     goal_id: str,
@@ -5529,73 +8954,268 @@ async def get_goal_progress_history(
             ]
         }
 
+# ═══════════════════════════════════════════════════════════════════
+# HABIT ANALYTICS - incremental streaks from the per-day habit log
+# ═══════════════════════════════════════════════════════════════════
+HABIT_BACKFILL_BATCH = int(os.getenv("HABIT_BACKFILL_BATCH", "200"))
+
+
+def _habit_period_index(frequency: Optional[str], day: date) -> int:
+    """Daily habits count days; Weekly habits count Saturday-based weeks."""
+    if (frequency or "").lower() == "weekly":
+        return (day.toordinal() - (day.weekday() - 5) % 7) // 7
+    return day.toordinal()
+
+
+def _habit_target(habit: Habit) -> int:
+    return max(1, int(habit.target_count or 1))
+
+
+def _compute_habit_stats(logs: List[Tuple[date, int]], frequency: Optional[str], target: int) -> Dict[str, Any]:
+    """
+    Full pass over a habit's (day, count) history: per-period totals, met periods and
+    their runs. Vectorized with NumPy when available; used for backfills and for writes
+    that land before the latest logged period.
+    """
+    stats: Dict[str, Any] = {
+        "current_streak": 0, "longest_streak": 0, "periods_met": 0, "total_completions": 0,
+        "first_logged": None, "last_logged": None,
+        "last_period_idx": None, "last_period_count": 0, "last_met_idx": None,
+    }
+    if not logs:
+        return stats
+    days = [day for day, _ in logs]
+    stats["first_logged"], stats["last_logged"] = min(days), max(days)
+    indexes = [_habit_period_index(frequency, day) for day in days]
+    if np is not None:
+        periods, inverse = np.unique(np.array(indexes, dtype=np.int64), return_inverse=True)
+        sums = np.bincount(inverse, weights=np.array([count for _, count in logs], dtype=np.float64))
+        met = periods[sums >= target]
+        runs = np.split(met, np.flatnonzero(np.diff(met) != 1) + 1) if met.size else []
+        period_list, sum_list, met_list = periods.tolist(), [int(value) for value in sums], met.tolist()
+        run_lengths = [len(run) for run in runs]
+    else:
+        totals: Dict[int, int] = {}
+        for index, (_, count) in zip(indexes, logs):
+            totals[index] = totals.get(index, 0) + count
+        period_list = sorted(totals)
+        sum_list = [totals[index] for index in period_list]
+        met_list = [index for index in period_list if totals[index] >= target]
+        run_lengths = []
+        for position, index in enumerate(met_list):
+            if position and index == met_list[position - 1] + 1:
+                run_lengths[-1] += 1
+            else:
+                run_lengths.append(1)
+    stats["total_completions"] = int(sum(count for _, count in logs))
+    stats["last_period_idx"], stats["last_period_count"] = period_list[-1], sum_list[-1]
+    if met_list:
+        stats["periods_met"] = len(met_list)
+        stats["last_met_idx"] = met_list[-1]
+        stats["current_streak"] = run_lengths[-1]
+        stats["longest_streak"] = max(run_lengths)
+    return stats
+
+
+def _advance_habit_stats(stats: HabitStats, frequency: Optional[str], target: int, day: date, count: int) -> bool:
+    """
+    O(1) update for a log appended at or after the latest logged period.
+    Returns False when the day is older, meaning the caller must recompute from history.
+    """
+    index = _habit_period_index(frequency, day)
+    if stats.last_period_idx is not None and index < stats.last_period_idx:
+        return False
+    if stats.last_period_idx is None or index > stats.last_period_idx:
+        stats.last_period_idx, stats.last_period_count = index, 0
+    stats.last_period_count += count
+    stats.total_completions = (stats.total_completions or 0) + count
+    stats.first_logged = min(stats.first_logged or day, day)
+    stats.last_logged = max(stats.last_logged or day, day)
+    if stats.last_period_count >= target and stats.last_met_idx != index:
+        stats.current_streak = (stats.current_streak or 0) + 1 if stats.last_met_idx == index - 1 else 1
+        stats.longest_streak = max(stats.longest_streak or 0, stats.current_streak)
+        stats.periods_met = (stats.periods_met or 0) + 1
+        stats.last_met_idx = index
+    return True
+
+
+async def _recompute_habit_stats(session: AsyncSession, habit: Habit, stats: HabitStats) -> None:
+    result = await session.execute(
+        select(HabitLog.logged_date, HabitLog.count).where(HabitLog.habit_id == habit.id).order_by(HabitLog.logged_date)
+    )
+    computed = _compute_habit_stats([(day, int(count or 0)) for day, count in result.all()], habit.frequency, _habit_target(habit))
+    for key, value in computed.items():
+        setattr(stats, key, value)
+    stats.updated_at = datetime.utcnow()
+
+
+async def _habit_stats_for_update(session: AsyncSession, habit: Habit) -> Tuple[HabitStats, bool]:
+    """
+    Locked stats row of a habit; (row, created) — a new row still needs a recompute.
+    The user's sync counter row is locked first (by its context seq bump), the same order
+    as a flush of synced entities followed by a habit log in one transaction.
+    """
+    await session.run_sync(lambda sync_session: _bump_context_seq(sync_session, habit.user_id))
+    locked = select(HabitStats).where(HabitStats.habit_id == habit.id).with_for_update()
+    stats = (await session.execute(locked)).scalar_one_or_none()
+    if stats is not None:
+        return stats, False
+    if engine.sync_engine.dialect.name != "mysql":
+        stats = HabitStats(habit_id=habit.id, user_id=habit.user_id)
+        session.add(stats)
+        return stats, True
+    # دو لاگِ اولِ هم‌زمان هر دو INSERT نمی‌کنند؛ بعد از upsert ردیف قفل و خوانده می‌شود
+    stmt = mysql_insert(HabitStats).values(habit_id=habit.id, user_id=habit.user_id, updated_at=datetime.utcnow())
+    await session.execute(stmt.on_duplicate_key_update(habit_id=stmt.inserted.habit_id))
+    stats = (await session.execute(locked)).scalar_one()
+    # اگر تراکنش دیگری زودتر ساخته باشد، recompute فقط کار اضافه است نه خطا
+    return stats, True
+
+
+async def _log_habit_day(session: AsyncSession, habit: Habit, day: date, count: int, notes: Optional[str]) -> HabitLog:
+    """
+    Add `count` completions on `day`: one HabitLog row per (habit, day), then the stats row
+    is advanced in O(1), or recomputed when the day is older than the latest period.
+    """
+    stats, created = await _habit_stats_for_update(session, habit)
+    result = await session.execute(
+        select(HabitLog).where(HabitLog.habit_id == habit.id, HabitLog.logged_date == day)
+    )
+    entry = result.scalar_one_or_none()
+    if entry is None:
+        entry = HabitLog(habit_id=habit.id, user_id=habit.user_id, logged_date=day, count=count, notes=notes)
+        session.add(entry)
+    else:
+        entry.count = (entry.count or 0) + count
+        if notes:
+            entry.notes = f"{entry.notes}\n{notes}" if entry.notes else notes
+    await session.flush()
+    if created or not _advance_habit_stats(stats, habit.frequency, _habit_target(habit), day, count):
+        await _recompute_habit_stats(session, habit, stats)
+    stats.updated_at = datetime.utcnow()
+    return entry
+
+
+def _habit_response(habit: Habit, stats: Optional[HabitStats], today: Optional[date] = None) -> HabitResponse:
+    """Streak/rate reads are O(1): a streak is alive while its last met period is current or previous."""
+    today = today or datetime.utcnow().date()
+    current = _habit_period_index(habit.frequency, today)
+    target = _habit_target(habit)
+    fields: Dict[str, Any] = {}
+    if stats is not None and stats.last_period_idx is not None:
+        alive = stats.last_met_idx is not None and stats.last_met_idx >= current - 1
+        start = _habit_period_index(habit.frequency, min(habit.created_at.date(), stats.first_logged or today))
+        period_count = stats.last_period_count if stats.last_period_idx == current else 0
+        fields = {
+            "current_streak": stats.current_streak if alive else 0,
+            "longest_streak": stats.longest_streak or 0,
+            "total_completed": stats.total_completions or 0,
+            "completed_today": stats.last_logged == today,
+            "completion_rate": round((stats.periods_met or 0) / max(1, current - start + 1), 3),
+            "period_progress": round(min(1.0, period_count / target), 3),
+        }
+    return HabitResponse(
+        habit_id=habit.habit_id,
+        name=habit.name,
+        category=habit.category,
+        frequency=habit.frequency,
+        target_count=habit.target_count,
+        unit=habit.unit,
+        archived=habit.archived_at is not None,
+        **fields,
+    )
+
+
+async def _habit_stats_map(session: AsyncSession, habits: List[Habit]) -> Dict[int, HabitStats]:
+    if not habits:
+        return {}
+    result = await session.execute(select(HabitStats).where(HabitStats.habit_id.in_([habit.id for habit in habits])))
+    return {stats.habit_id: stats for stats in result.scalars().all()}
+
+
+async def _backfill_habit_stats() -> int:
+    """Compute stats for habits that have logs but no stats row yet (keyset batches)."""
+    last_id = 0
+    filled = 0
+    while True:
+        async with async_session() as session:
+            has_stats = select(HabitStats.habit_id).where(HabitStats.habit_id == Habit.id).exists()
+            result = await session.execute(
+                select(Habit).where(Habit.id > last_id, ~has_stats).order_by(Habit.id).limit(HABIT_BACKFILL_BATCH)
+            )
+            habits = result.scalars().all()
+            if not habits:
+                return filled
+            last_id = habits[-1].id
+            result = await session.execute(
+                select(HabitLog.habit_id, HabitLog.logged_date, HabitLog.count)
+                .where(HabitLog.habit_id.in_([habit.id for habit in habits]))
+                .order_by(HabitLog.habit_id, HabitLog.logged_date)
+            )
+            logs: Dict[int, List[Tuple[date, int]]] = {}
+            for habit_id, day, count in result.all():
+                logs.setdefault(habit_id, []).append((day, int(count or 0)))
+            for habit in habits:
+                stats = HabitStats(habit_id=habit.id, user_id=habit.user_id, updated_at=datetime.utcnow())
+                for key, value in _compute_habit_stats(logs.get(habit.id, []), habit.frequency, _habit_target(habit)).items():
+                    setattr(stats, key, value)
+                session.add(stats)
+            try:
+                await session.commit()
+                filled += len(habits)
+            except IntegrityError:
+                # لاگ هم‌زمان ردیف stats را زودتر ساخته است
+                await session.rollback()
+
+
+async def _ensure_habit_log_day_index() -> None:
+    """create_all does not add indexes to an existing habit_logs table."""
+    index = next(index for index in HabitLog.__table__.indexes if index.name == "ux_habit_log_day")
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+    except Exception as exc:  # noqa: BLE001
+        log.warning("Could not create ux_habit_log_day (duplicate day rows?): %s", exc)
+
+
+@app.post("/habits", response_model=HabitResponse)
 async def create_habit(
     body: HabitCreateRequest,
     current_user: User = Depends(get_current_user),
 ):
     """Create a new habit"""
-    habit_id = str(uuid.uuid4())
-    
     async with async_session() as session:
         habit = Habit(
             user_id=current_user.id,
-            habit_id=habit_id,
+            habit_id=str(uuid.uuid4()),
             name=body.name,
             category=body.category,
-            description=body.description,
             frequency=body.frequency,
-            target_count=body.target_count,
-            current_streak=0,
-            longest_streak=0,
-            total_completions=0,
-            is_active=True,
+            target_count=max(1, body.target_count),
+            unit=body.unit,
+            linked_goal_id=body.linked_goal_id,
             created_at=datetime.utcnow(),
-            updated_at=datetime.utcnow(),
         )
         session.add(habit)
         await session.commit()
         
-        return HabitResponse(
-            habit_id=habit_id,
-            user_id=current_user.id,
-            name=habit.name,
-            category=habit.category,
-            description=habit.description,
-            frequency=habit.frequency,
-            target_count=habit.target_count,
-            current_streak=habit.current_streak,
-            longest_streak=habit.longest_streak,
-            total_completions=habit.total_completions,
-            is_active=habit.is_active,
-            created_at=habit.created_at.isoformat(),
-        )
+        return _habit_response(habit, None)
 @app.get("/habits")
-async def get_habits(current_user: User = Depends(get_current_user)):
+async def get_habits(
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user),
+):
     """Get all habits for user"""
     async with async_session() as session:
-        stmt = select(Habit).where(Habit.user_id == current_user.id).order_by(Habit.updated_at.desc())
-        result = await session.execute(stmt)
+        stmt = select(Habit).where(Habit.user_id == current_user.id)
+        if not include_archived:
+            stmt = stmt.where(Habit.archived_at.is_(None))
+        result = await session.execute(stmt.order_by(Habit.created_at.desc()))
         habits = result.scalars().all()
-        
-        return {
-            "habits": [
-                HabitResponse(
-                    habit_id=h.habit_id,
-                    user_id=h.user_id,
-                    name=h.name,
-                    category=h.category,
-                    description=h.description,
-                    frequency=h.frequency,
-                    target_count=h.target_count,
-                    current_streak=h.current_streak,
-                    longest_streak=h.longest_streak,
-                    total_completions=h.total_completions,
-                    is_active=h.is_active,
-                    created_at=h.created_at.isoformat(),
-                )
-                for h in habits
-            ]
-        }
+        stats = await _habit_stats_map(session, habits)
+    
+    today = datetime.utcnow().date()
+    return {"habits": [_habit_response(h, stats.get(h.id), today) for h in habits]}
 @app.get("/habits/{habit_id}", response_model=HabitResponse)
 async def get_habit(
     habit_id: str,
@@ -5611,29 +9231,22 @@ async def get_habit(
         
         if not habit:
             raise HTTPException(status_code=404, detail="عادت یافت نشد")
+        stats = await _habit_stats_map(session, [habit])
         
-        return HabitResponse(
-            habit_id=habit.habit_id,
-            user_id=habit.user_id,
-            name=habit.name,
-            category=habit.category,
-            description=habit.description,
-            frequency=habit.frequency,
-            target_count=habit.target_count,
-            current_streak=habit.current_streak,
-            longest_streak=habit.longest_streak,
-            total_completions=habit.total_completions,
-            is_active=habit.is_active,
-            created_at=habit.created_at.isoformat(),
-        )
+        return _habit_response(habit, stats.get(habit.id))
 @app.post("/habits/{habit_id}/log")
 async def log_habit_completion(
     habit_id: str,
     body: HabitLogRequest,
     current_user: User = Depends(get_current_user),
 ):
-    """Log habit completion"""
-    log_id = str(uuid.uuid4())
+    """Log habit completion (repeated logs on the same day add to that day's count)"""
+    if body.count < 1:
+        raise HTTPException(status_code=400, detail="تعداد باید حداقل ۱ باشد.")
+    try:
+        day = date.fromisoformat(body.logged_date[:10]) if body.logged_date else datetime.utcnow().date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="logged_date باید تاریخ ISO باشد.")
     
     async with async_session() as session:
         # Verify habit exists
@@ -5646,31 +9259,16 @@ async def log_habit_completion(
         if not habit:
             raise HTTPException(status_code=404, detail="عادت یافت نشد")
         
-        # Create log entry
-        log_entry = HabitLog(
-            user_id=current_user.id,
-            log_id=log_id,
-            habit_id=habit_id,
-            date=datetime.fromisoformat(body.date.replace('Z', '+00:00')),
-            completed=body.completed,
-            notes=body.notes,
-            created_at=datetime.utcnow(),
-        )
-        session.add(log_entry)
-        
-        # Update habit stats
-        if body.completed:
-            habit.total_completions += 1
-            habit.current_streak += 1
-            if habit.current_streak > habit.longest_streak:
-                habit.longest_streak = habit.current_streak
-        else:
-            habit.current_streak = 0
-        
-        habit.updated_at = datetime.utcnow()
+        entry = await _log_habit_day(session, habit, day, body.count, body.notes)
         await session.commit()
+        stats = await _habit_stats_map(session, [habit])
         
-        return {"log_id": log_id, "habit_id": habit_id, "completed": body.completed}
+        return {
+            "habit_id": habit_id,
+            "logged_date": entry.logged_date.isoformat(),
+            "day_count": entry.count,
+            "habit": _habit_response(habit, stats.get(habit.id)),
+        }
 @app.put("/habits/{habit_id}")
 async def update_habit(
     habit_id: str,
@@ -5689,30 +9287,26 @@ async def update_habit(
             raise HTTPException(status_code=404, detail="عادت یافت نشد")
         
         # Update fields if provided
-        if "name" in body:
-            habit.name = body["name"]
-        if "description" in body:
-            habit.description = body["description"]
-        if "is_active" in body:
-            habit.is_active = body["is_active"]
-        
-        habit.updated_at = datetime.utcnow()
+        for field in ("name", "category", "unit", "linked_goal_id"):
+            if field in body:
+                setattr(habit, field, body[field])
+        rules_changed = False
+        if "frequency" in body and body["frequency"] != habit.frequency:
+            habit.frequency = body["frequency"]
+            rules_changed = True
+        if "target_count" in body and int(body["target_count"]) != habit.target_count:
+            habit.target_count = max(1, int(body["target_count"]))
+            rules_changed = True
+        if "archived" in body:
+            habit.archived_at = datetime.utcnow() if body["archived"] else None
+        if rules_changed:
+            # دوره و هدف عوض شده؛ streakها از روی تاریخچه دوباره حساب می‌شوند
+            stats, _ = await _habit_stats_for_update(session, habit)
+            await _recompute_habit_stats(session, habit, stats)
         await session.commit()
+        stats = await _habit_stats_map(session, [habit])
         
-        return HabitResponse(
-            habit_id=habit.habit_id,
-            user_id=habit.user_id,
-            name=habit.name,
-            category=habit.category,
-            description=habit.description,
-            frequency=habit.frequency,
-            target_count=habit.target_count,
-            current_streak=habit.current_streak,
-            longest_streak=habit.longest_streak,
-            total_completions=habit.total_completions,
-            is_active=habit.is_active,
-            created_at=habit.created_at.isoformat(),
-        )
+        return _habit_response(habit, stats.get(habit.id))
 @app.delete("/habits/{habit_id}")
 async def delete_habit(
     habit_id: str,
@@ -5729,8 +9323,7 @@ async def delete_habit(
         if not habit:
             raise HTTPException(status_code=404, detail="عادت یافت نشد")
         
-        habit.is_active = False
-        habit.updated_at = datetime.utcnow()
+        habit.archived_at = datetime.utcnow()
         await session.commit()
         
         return {"status": "archived", "habit_id": habit_id}
@@ -5856,18 +9449,936 @@ async def list_agent_tasks(current_user: User = Depends(get_current_user)):
 @app.get("/agents/tasks/{task_id}", response_model=AgentTaskResponse)
 async def get_agent_task(task_id: int, current_user: User = Depends(get_current_user)):
     async with async_session() as session:
-        task = await session.get(AgentTask, task_id)
-        if task is None or task.user_id != current_user.id:
-            raise HTTPException(status_code=404, detail="تسک یافت نشد.")
-    return _serialize_agent_task(task)
-@app.get("/auth/me", response_model=MeResponse)
-async def get_me(current_user: User = Depends(get_current_user)) -> MeResponse:
-    return MeResponse(
-        user_id=current_user.id,
-        phone=current_user.phone,
-        created_at=current_user.created_at,
-        last_login=current_user.last_login,
+        task = await session.get(AgentTask, task_id)
+        if task is None or task.user_id != current_user.id:
+            raise HTTPException(status_code=404, detail="تسک یافت نشد.")
+    return _serialize_agent_task(task)
+@app.get("/auth/me", response_model=MeResponse)
+async def get_me(current_user: User = Depends(get_current_user)) -> MeResponse:
+    return MeResponse(
+        user_id=current_user.id,
+        phone=current_user.phone,
+        created_at=current_user.created_at,
+        last_login=current_user.last_login,
+    )
+# ═══════════════════════════════════════════════════════════════════
+# USER CONTEXT SNAPSHOT - profile, goals, habits, mood and open tasks in one place
+# ═══════════════════════════════════════════════════════════════════
+# نسخهٔ snapshot همان sync_counters.seq است: هر نوشتن روی تسک/عادت/هدف/مود/پروفایل آن را در همان
+# تراکنش بالا می‌برد، پس اعتبار cache با یک lookup روی کلید اصلی سنجیده می‌شود و بین workerها هم درست است.
+USER_CONTEXT_CACHE_SIZE = int(os.getenv("USER_CONTEXT_CACHE_SIZE", "2000"))
+USER_CONTEXT_TTL = float(os.getenv("USER_CONTEXT_TTL", "600"))
+USER_CONTEXT_TASK_LIMIT = int(os.getenv("USER_CONTEXT_TASK_LIMIT", "20"))
+USER_CONTEXT_MOOD_DAYS = int(os.getenv("USER_CONTEXT_MOOD_DAYS", "7"))
+
+
+class _UserContext:
+    """One user's snapshot. ORM objects inside are detached and must be treated as read-only."""
+    __slots__ = (
+        "user_id", "version", "day", "built_at", "profile", "goals", "habits", "habit_stats",
+        "tasks", "open_tasks", "overdue_tasks", "latest_mood", "mood_week", "_prompt",
+    )
+
+    def __init__(self, user_id: int, version: int) -> None:
+        self.user_id = user_id
+        self.version = version
+        self.day: date = datetime.utcnow().date()
+        self.built_at = time.monotonic()
+        self.profile: Optional[UserProfile] = None
+        self.goals: List[UserGoal] = []
+        self.habits: List[Habit] = []
+        self.habit_stats: Dict[int, HabitStats] = {}
+        self.tasks: List[UserTask] = []
+        self.open_tasks = 0
+        self.overdue_tasks = 0
+        self.latest_mood: Optional[MoodSnapshot] = None
+        self.mood_week: Dict[str, Any] = {"count": 0, "avg_energy": None, "avg_mood": None}
+        self._prompt: Optional[str] = None
+
+    @property
+    def zone(self):
+        return _user_zone(self.profile.timezone if self.profile else None)
+
+    def as_dict(self) -> Dict[str, Any]:
+        profile = self.profile
+        return {
+            "version": self.version,
+            "date": self.day.isoformat(),
+            "profile": None if profile is None else {
+                "name": profile.name,
+                "role": profile.role,
+                "timezone": profile.timezone,
+                "interests": _json_list(profile.interests),
+                "wake_up_time": profile.wake_up_time,
+                "sleep_time": profile.sleep_time,
+                "focus_hours": profile.focus_hours,
+                "communication_style": profile.communication_style,
+            },
+            "goals": [
+                {
+                    "goal_id": goal.goal_id,
+                    "title": goal.title,
+                    "category": goal.category,
+                    "priority": goal.priority,
+                    "progress_percentage": goal.progress_percentage,
+                    "deadline": goal.deadline.isoformat() if goal.deadline else None,
+                }
+                for goal in self.goals
+            ],
+            "habits": [
+                _habit_response(habit, self.habit_stats.get(habit.id), self.day).dict()
+                for habit in self.habits
+            ],
+            "mood": {
+                "latest": None if self.latest_mood is None else {
+                    "timestamp": self.latest_mood.timestamp.isoformat(),
+                    "energy": self.latest_mood.energy,
+                    "mood": self.latest_mood.mood,
+                    "context": self.latest_mood.context,
+                },
+                "days": USER_CONTEXT_MOOD_DAYS,
+                **self.mood_week,
+            },
+            "tasks": {
+                "open": self.open_tasks,
+                "overdue": self.overdue_tasks,
+                "items": [
+                    {
+                        "task_id": task.task_id,
+                        "title": task.title,
+                        "priority": task.priority,
+                        "status": task.status,
+                        "due_date": task.due_date.isoformat() if task.due_date else None,
+                        "scheduled_time": task.scheduled_time.isoformat() if task.scheduled_time else None,
+                    }
+                    for task in self.tasks
+                ],
+            },
+        }
+
+    def prompt(self) -> str:
+        """Compact JSON for LLM prompts (short keys, no ids); built once per snapshot."""
+        if self._prompt is None:
+            profile = self.profile
+            compact: Dict[str, Any] = {"today": self.day.isoformat()}
+            if profile is not None:
+                compact["profile"] = {
+                    "name": profile.name,
+                    "role": profile.role,
+                    "tz": profile.timezone,
+                    "awake": f"{profile.wake_up_time}-{profile.sleep_time}",
+                    "style": profile.communication_style,
+                }
+            if self.goals:
+                compact["goals"] = [
+                    f"{goal.title} ({goal.progress_percentage or 0}%"
+                    + (f", تا {goal.deadline.date().isoformat()})" if goal.deadline else ")")
+                    for goal in self.goals
+                ]
+            if self.habits:
+                compact["habits"] = [
+                    f"{view.name} streak={view.current_streak}" + (" ✓" if view.completed_today else "")
+                    for view in (_habit_response(habit, self.habit_stats.get(habit.id), self.day) for habit in self.habits)
+                ]
+            if self.mood_week["count"]:
+                compact["mood_week"] = {"energy": self.mood_week["avg_energy"], "mood": self.mood_week["avg_mood"]}
+            if self.latest_mood is not None:
+                compact["mood_now"] = {"energy": self.latest_mood.energy, "mood": self.latest_mood.mood}
+            compact["tasks"] = {
+                "open": self.open_tasks,
+                "overdue": self.overdue_tasks,
+                "next": [
+                    f"{task.title} [p{task.priority}"
+                    + (f", {task.due_date.replace(tzinfo=timezone.utc).astimezone(self.zone).strftime('%m-%d %H:%M')}]" if task.due_date else "]")
+                    for task in self.tasks
+                ],
+            }
+            self._prompt = json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+        return self._prompt
+
+
+async def _build_user_context(user_id: int, version: int) -> _UserContext:
+    context = _UserContext(user_id, version)
+    now = datetime.utcnow()
+    async with async_session() as session:
+        context.profile = (
+            await session.execute(select(UserProfile).where(UserProfile.user_id == user_id))
+        ).scalar_one_or_none()
+        context.day = datetime.now(context.zone).date()
+        result = await session.execute(
+            select(UserGoal)
+            .where(UserGoal.user_id == user_id, UserGoal.status == "active")
+            .order_by(UserGoal.priority.desc(), UserGoal.deadline.asc())
+        )
+        context.goals = list(result.scalars().all())
+        result = await session.execute(
+            select(Habit, HabitStats)
+            .outerjoin(HabitStats, HabitStats.habit_id == Habit.id)
+            .where(Habit.user_id == user_id, Habit.archived_at.is_(None))
+            .order_by(Habit.id)
+        )
+        for habit, stats in result.all():
+            context.habits.append(habit)
+            if stats is not None:
+                context.habit_stats[habit.id] = stats
+        result = await session.execute(
+            select(
+                func.coalesce(func.sum(MoodDailyAggregate.count), 0),
+                func.coalesce(func.sum(MoodDailyAggregate.energy_sum), 0),
+                func.coalesce(func.sum(MoodDailyAggregate.mood_sum), 0),
+            ).where(
+                MoodDailyAggregate.user_id == user_id,
+                MoodDailyAggregate.day >= now.date() - timedelta(days=USER_CONTEXT_MOOD_DAYS - 1),
+            )
+        )
+        count, energy_sum, mood_sum = result.one()
+        if count:
+            context.mood_week = {
+                "count": int(count),
+                "avg_energy": round(float(energy_sum) / count, 2),
+                "avg_mood": round(float(mood_sum) / count, 2),
+            }
+            context.latest_mood = (
+                await session.execute(
+                    select(MoodSnapshot)
+                    .where(MoodSnapshot.user_id == user_id)
+                    .order_by(MoodSnapshot.timestamp.desc())
+                    .limit(1)
+                )
+            ).scalar_one_or_none()
+        is_master = select(TaskRecurrence.id).where(TaskRecurrence.task_id == UserTask.id).exists()
+        open_filter = and_(UserTask.user_id == user_id, UserTask.status.in_(_ACTIVE_TASK_STATUSES), ~is_master)
+        result = await session.execute(
+            select(
+                func.count(UserTask.id),
+                func.coalesce(func.sum(case((UserTask.due_date < now, 1), else_=0)), 0),
+            ).where(open_filter)
+        )
+        open_tasks, overdue_tasks = result.one()
+        context.open_tasks, context.overdue_tasks = int(open_tasks), int(overdue_tasks)
+        if open_tasks:
+            result = await session.execute(
+                select(UserTask)
+                .where(open_filter)
+                .order_by(UserTask.due_date.is_(None), UserTask.due_date.asc(), UserTask.priority.desc())
+                .limit(USER_CONTEXT_TASK_LIMIT)
+            )
+            context.tasks = list(result.scalars().all())
+    return context
+
+
+_USER_CONTEXT_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _user_context_lock(user_id: int) -> asyncio.Lock:
+    lock = _USER_CONTEXT_LOCKS.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _USER_CONTEXT_LOCKS[user_id] = lock
+    return lock
+
+
+class _UserContextCache:
+    """LRU of snapshots validated against the user's current version on every read."""
+
+    def __init__(self) -> None:
+        self._entries: "OrderedDict[int, _UserContext]" = OrderedDict()
+
+    def _fresh(self, context: Optional[_UserContext], version: int) -> bool:
+        return (
+            context is not None
+            and context.version == version
+            and time.monotonic() - context.built_at < USER_CONTEXT_TTL
+            and datetime.now(context.zone).date() == context.day
+        )
+
+    async def get(self, user_id: int) -> _UserContext:
+        async with async_session() as session:
+            version = (
+                await session.execute(select(SyncCounter.seq).where(SyncCounter.user_id == user_id))
+            ).scalar_one_or_none() or 0
+        context = self._entries.get(user_id)
+        if self._fresh(context, version):
+            self._entries.move_to_end(user_id)
+            M_USER_CONTEXT.inc("hit")
+            return context
+        async with _user_context_lock(user_id):
+            # درخواست هم‌زمانِ دیگری ممکن است همین نسخه را ساخته باشد
+            context = self._entries.get(user_id)
+            if self._fresh(context, version):
+                M_USER_CONTEXT.inc("hit")
+                return context
+            # نسخه قبل از خواندن داده گرفته شده؛ نوشتنِ هم‌زمان فقط باعث ساخت دوباره در خواندن بعدی می‌شود
+            context = await _build_user_context(user_id, version)
+            self._entries[user_id] = context
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > USER_CONTEXT_CACHE_SIZE:
+                self._entries.popitem(last=False)
+            M_USER_CONTEXT.inc("miss")
+            return context
+
+
+_USER_CONTEXT_CACHE = _UserContextCache()
+
+
+async def _user_context(user_id: int) -> _UserContext:
+    return await _USER_CONTEXT_CACHE.get(user_id)
+
+
+@app.get("/user/context")
+async def get_user_context(request: Request, current_user: User = Depends(get_current_user)):
+    """Profile, active goals, habits with streaks, recent mood and open tasks in one response."""
+    context = await _user_context(current_user.id)
+    etag = f'W/"ctx-{context.version}-{context.day.isoformat()}"'
+    if etag in {tag.strip() for tag in request.headers.get("if-none-match", "").split(",")}:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=context.as_dict(), headers={"ETag": etag})
+# ═══════════════════════════════════════════════════════════════════
+# DAILY PROGRAM SOLVER - local constraint-based time blocking
+# ═══════════════════════════════════════════════════════════════════
+SCHEDULER_SLOT_MINUTES = int(os.getenv("SCHEDULER_SLOT_MINUTES", "15"))
+SCHEDULER_DEFAULT_TASK_MINUTES = int(os.getenv("SCHEDULER_DEFAULT_TASK_MINUTES", "30"))
+SCHEDULER_HABIT_MINUTES = int(os.getenv("SCHEDULER_HABIT_MINUTES", "15"))
+SCHEDULER_MAX_BLOCK_MINUTES = int(os.getenv("SCHEDULER_MAX_BLOCK_MINUTES", "90"))
+SCHEDULER_WORK_STRETCH_MINUTES = int(os.getenv("SCHEDULER_WORK_STRETCH_MINUTES", "90"))
+SCHEDULER_LOOKAHEAD_DAYS = int(os.getenv("SCHEDULER_LOOKAHEAD_DAYS", "7"))
+SCHEDULER_MAX_TASKS = int(os.getenv("SCHEDULER_MAX_TASKS", "60"))
+SCHEDULER_SEARCH_PASSES = int(os.getenv("SCHEDULER_SEARCH_PASSES", "3"))
+SCHEDULER_MOOD_DAYS = int(os.getenv("SCHEDULER_MOOD_DAYS", "30"))
+# انرژی پیش‌فرض هر ساعت (۰ تا ۱۰) وقتی دادهٔ حال/انرژی کاربر کافی نیست
+_DEFAULT_ENERGY_CURVE = [
+    3.0, 2.5, 2.5, 2.5, 3.0, 3.5, 4.5, 5.5, 6.5, 7.5, 8.0, 7.5,
+    6.5, 5.5, 5.5, 6.0, 6.5, 6.5, 6.0, 5.5, 5.0, 4.5, 4.0, 3.5,
+]
+
+
+class _PlanItem:
+    __slots__ = (
+        "key", "title", "kind", "category", "minutes", "value", "demand", "early",
+        "deadline", "priority", "task_id", "habit_id", "work",
+    )
+
+    def __init__(self, key: str, title: str, kind: str, category: str, minutes: int, value: float,
+                 demand: float, early: float = 0.0, deadline: Optional[int] = None, priority: int = 3,
+                 task_id: Optional[str] = None, habit_id: Optional[str] = None, work: bool = True):
+        self.key, self.title, self.kind, self.category = key, title, kind, category
+        self.minutes, self.value, self.demand, self.early = minutes, value, demand, early
+        self.deadline, self.priority = deadline, priority
+        self.task_id, self.habit_id, self.work = task_id, habit_id, work
+
+
+class _DayScheduler:
+    """
+    Packs items into one day's window (minutes from local midnight).
+
+    Greedy by value: each item takes its best feasible start on the slot grid, scored by
+    energy fit (energy-demanding work goes to high-energy hours), deadline lateness and an
+    urgency pull towards the morning. Relocate passes then move single items while the
+    total score improves. Constraints: no overlaps, total work <= the focus budget, and no
+    uninterrupted work stretch (gaps shorter than a break) longer than the stretch limit.
+    """
+
+    def __init__(self, window_start: int, window_end: int, energy: List[float], break_minutes: int, focus_minutes: int):
+        self.window_start, self.window_end = window_start, window_end
+        self.span = max(1, window_end - window_start)
+        self.energy = energy
+        self.break_minutes = max(5, break_minutes)
+        self.focus_minutes = focus_minutes
+        self.work_minutes = 0
+        self.starts: List[int] = []
+        self.blocks: List[Tuple[int, int, _PlanItem, bool]] = []  # (start, end, item, fixed)
+        self.unscheduled: List[_PlanItem] = []
+
+    def energy_at(self, start: int, end: int) -> float:
+        return self.energy[((start + end) // 2 // 60) % 24]
+
+    def is_free(self, start: int, end: int) -> bool:
+        if start < self.window_start or end > self.window_end:
+            return False
+        position = bisect.bisect_right(self.starts, start)
+        if position and self.blocks[position - 1][1] > start:
+            return False
+        return position == len(self.blocks) or self.blocks[position][0] >= end
+
+    def _stretch(self, start: int, end: int) -> int:
+        """Work minutes of the uninterrupted chain [start, end) would join."""
+        total = end - start
+        position = bisect.bisect_right(self.starts, start)
+        edge = start
+        for index in range(position - 1, -1, -1):
+            block_start, block_end, item, _ = self.blocks[index]
+            if not item.work or edge - block_end >= self.break_minutes:
+                break
+            total += block_end - block_start
+            edge = block_start
+        edge = end
+        for index in range(position, len(self.blocks)):
+            block_start, block_end, item, _ = self.blocks[index]
+            if not item.work or block_start - edge >= self.break_minutes:
+                break
+            total += block_end - block_start
+            edge = block_end
+        return total
+
+    def score(self, item: _PlanItem, start: int) -> float:
+        end = start + item.minutes
+        value = item.value * (1.0 + item.demand * (self.energy_at(start, end) / 10.0 - 0.5))
+        if item.deadline is not None and end > item.deadline:
+            value -= item.value * 0.6
+        return value + item.value * item.early * (1.0 - (start - self.window_start) / self.span)
+
+    def _feasible(self, item: _PlanItem, start: int) -> bool:
+        end = start + item.minutes
+        if not self.is_free(start, end):
+            return False
+        if item.work and self._stretch(start, end) > SCHEDULER_WORK_STRETCH_MINUTES:
+            return False
+        return True
+
+    def _candidates(self, item: _PlanItem) -> List[int]:
+        first = self.window_start + (-self.window_start) % SCHEDULER_SLOT_MINUTES
+        candidates = set(range(first, self.window_end - item.minutes + 1, SCHEDULER_SLOT_MINUTES))
+        candidates.add(self.window_start)
+        for _, block_end, _, _ in self.blocks:
+            candidates.add(block_end)
+            candidates.add(block_end + self.break_minutes)
+        return [start for start in candidates if start + item.minutes <= self.window_end]
+
+    def best_start(self, item: _PlanItem) -> Optional[Tuple[float, int]]:
+        if item.work and self.work_minutes + item.minutes > self.focus_minutes:
+            return None
+        best: Optional[Tuple[float, int]] = None
+        for start in self._candidates(item):
+            if self._feasible(item, start):
+                candidate = (self.score(item, start), -start)
+                if best is None or candidate > best:
+                    best = candidate
+        return (best[0], -best[1]) if best else None
+
+    def place(self, item: _PlanItem, start: int, fixed: bool = False) -> None:
+        position = bisect.bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.blocks.insert(position, (start, start + item.minutes, item, fixed))
+        if item.work:
+            self.work_minutes += item.minutes
+
+    def _remove(self, position: int) -> Tuple[int, int, _PlanItem, bool]:
+        self.starts.pop(position)
+        block = self.blocks.pop(position)
+        if block[2].work:
+            self.work_minutes -= block[2].minutes
+        return block
+
+    def solve(self, items: List[_PlanItem]) -> None:
+        for item in sorted(items, key=lambda candidate: -candidate.value):
+            best = self.best_start(item)
+            if best is None:
+                self.unscheduled.append(item)
+            else:
+                self.place(item, best[1])
+        for _ in range(SCHEDULER_SEARCH_PASSES):
+            improved = False
+            for item in sorted((block[2] for block in self.blocks if not block[3]), key=lambda candidate: -candidate.value):
+                position = next(index for index, block in enumerate(self.blocks) if block[2] is item)
+                start = self._remove(position)[0]
+                current = self.score(item, start)
+                best = self.best_start(item)
+                if best is not None and best[0] > current + 1e-6:
+                    self.place(item, best[1])
+                    improved = True
+                else:
+                    self.place(item, start)
+            waiting, self.unscheduled = self.unscheduled, []
+            for item in waiting:
+                best = self.best_start(item)
+                if best is None:
+                    self.unscheduled.append(item)
+                else:
+                    self.place(item, best[1])
+                    improved = True
+            if not improved:
+                break
+
+    def breaks(self) -> List[Tuple[int, int]]:
+        """A break in each gap between two work blocks that is long enough for one."""
+        result = []
+        for (_, end, item, _), (next_start, _, next_item, _) in zip(self.blocks, self.blocks[1:]):
+            if item.work and next_item.work and next_start - end >= self.break_minutes:
+                result.append((end, end + self.break_minutes))
+        return result
+
+
+def _task_plan_items(task: UserTask, day_start_utc: datetime, day_end_utc: datetime, to_minute) -> List[_PlanItem]:
+    priority = max(1, min(5, int(task.priority or 3)))
+    value, early, deadline = 10.0 * priority, 0.02, None
+    if task.due_date is not None:
+        due = _naive_utc(task.due_date)
+        if due < day_start_utc:
+            value, early = value + 30.0, 0.3
+        elif due < day_end_utc:
+            value, early, deadline = value + 20.0, 0.15, to_minute(due)
+        elif due < day_end_utc + timedelta(days=2):
+            value += 10.0
+        else:
+            value += 5.0
+    minutes = max(SCHEDULER_SLOT_MINUTES, int(task.estimated_duration_minutes or SCHEDULER_DEFAULT_TASK_MINUTES))
+    parts = max(1, math.ceil(minutes / SCHEDULER_MAX_BLOCK_MINUTES))
+    items = []
+    for part in range(parts):
+        chunk = min(SCHEDULER_MAX_BLOCK_MINUTES, minutes - part * SCHEDULER_MAX_BLOCK_MINUTES)
+        title = task.title if parts == 1 else f"{task.title} (بخش {part + 1}/{parts})"
+        items.append(_PlanItem(
+            key=f"task:{task.task_id}:{part}", title=title, kind="focus", category=task.category or "Work",
+            minutes=chunk, value=value - part * 0.5, demand=0.3 + 0.14 * priority, early=early,
+            deadline=deadline, priority=priority, task_id=task.task_id,
+        ))
+    return items
+
+
+async def _build_daily_plan(
+    user_id: int,
+    profile: UserProfile,
+    target_date: date,
+    current_mood: Optional[float] = None,
+    current_energy: Optional[float] = None,
+    context: Optional[_UserContext] = None,
+) -> Dict[str, Any]:
+    """Load the day's inputs (tasks, habits, hourly mood) and run the solver; habits come from `context` when given."""
+    zone = _user_zone(profile.timezone)
+    now = datetime.utcnow()
+    local_midnight = datetime.combine(target_date, datetime.min.time()).replace(tzinfo=zone)
+    midnight_utc = _naive_utc(local_midnight)
+
+    def to_minute(moment: datetime) -> int:
+        return int((moment - midnight_utc).total_seconds() // 60)
+
+    def to_local(minute: int) -> datetime:
+        return (midnight_utc + timedelta(minutes=minute)).replace(tzinfo=timezone.utc).astimezone(zone)
+
+    wake, sleep = int(profile.wake_up_time or 6), int(profile.sleep_time or 23)
+    window_start, window_end = wake * 60, (sleep if sleep > wake else sleep + 24) * 60
+    now_minute = to_minute(now)
+    if window_start < now_minute:
+        window_start = now_minute + (-now_minute) % SCHEDULER_SLOT_MINUTES
+    day_start_utc, day_end_utc = midnight_utc, midnight_utc + timedelta(days=1)
+
+    async with async_session() as session:
+        is_master = select(TaskRecurrence.id).where(TaskRecurrence.task_id == UserTask.id).exists()
+        result = await session.execute(
+            select(UserTask)
+            .where(
+                UserTask.user_id == user_id,
+                UserTask.status.in_(_ACTIVE_TASK_STATUSES),
+                or_(UserTask.due_date.is_(None), UserTask.due_date < day_end_utc + timedelta(days=SCHEDULER_LOOKAHEAD_DAYS)),
+                ~is_master,
+            )
+            .order_by(UserTask.priority.desc(), UserTask.due_date.asc())
+            .limit(SCHEDULER_MAX_TASKS)
+        )
+        tasks = result.scalars().all()
+        if context is not None:
+            habits, habit_stats = context.habits, context.habit_stats
+        else:
+            result = await session.execute(
+                select(Habit).where(Habit.user_id == user_id, Habit.archived_at.is_(None))
+            )
+            habits = result.scalars().all()
+            habit_stats = await _habit_stats_map(session, habits)
+        result = await session.execute(
+            select(MoodHourlyAggregate.hour, MoodHourlyAggregate.count, MoodHourlyAggregate.energy_sum, MoodHourlyAggregate.mood_sum)
+            .where(MoodHourlyAggregate.user_id == user_id, MoodHourlyAggregate.hour >= now - timedelta(days=SCHEDULER_MOOD_DAYS))
+        )
+        mood_rows = result.all()
+
+    # منحنی انرژی ساعتی از دادهٔ واقعی کاربر، با پیش‌فرض برای ساعت‌های کم‌داده
+    hour_counts, hour_energy, hour_mood = [0] * 24, [0.0] * 24, [0.0] * 24
+    for hour, count, energy_sum, mood_sum in mood_rows:
+        local_hour = hour.replace(tzinfo=timezone.utc).astimezone(zone).hour
+        hour_counts[local_hour] += count
+        hour_energy[local_hour] += energy_sum
+        hour_mood[local_hour] += mood_sum
+    energy = [
+        hour_energy[hour] / hour_counts[hour] if hour_counts[hour] >= 2 else _DEFAULT_ENERGY_CURVE[hour]
+        for hour in range(24)
+    ]
+    if current_energy is not None and 0 <= now_minute < 1440:
+        shift = current_energy - energy[now_minute // 60]
+        for offset in range(4):
+            hour = (now_minute // 60 + offset) % 24
+            energy[hour] = max(0.0, min(10.0, energy[hour] + shift * (1 - offset / 4)))
+
+    scheduler = _DayScheduler(
+        window_start, window_end, energy,
+        int(profile.preferred_break_duration or 15), int(profile.focus_hours or 6) * 60,
+    )
+    items: List[_PlanItem] = []
+    for task in tasks:
+        scheduled = _naive_utc(task.scheduled_time) if task.scheduled_time else None
+        if scheduled is not None and day_start_utc <= scheduled < day_end_utc:
+            fixed = _task_plan_items(task, day_start_utc, day_end_utc, to_minute)[0]
+            fixed.title = task.title
+            fixed.minutes = max(SCHEDULER_SLOT_MINUTES, int(task.estimated_duration_minutes or SCHEDULER_DEFAULT_TASK_MINUTES))
+            start = to_minute(scheduled)
+            if scheduler.is_free(start, start + fixed.minutes):
+                scheduler.place(fixed, start, fixed=True)
+                continue
+            # خارج از ساعات بیداری یا هم‌پوشان با تسک ثابت دیگر: مثل تسک منعطف زمان‌بندی می‌شود
+        items.extend(_task_plan_items(task, day_start_utc, day_end_utc, to_minute))
+    current_period = lambda habit: _habit_period_index(habit.frequency, target_date)  # noqa: E731
+    for habit in habits:
+        stats = habit_stats.get(habit.id)
+        if stats is not None and stats.last_period_idx == current_period(habit) and stats.last_period_count >= _habit_target(habit):
+            continue
+        if stats is not None and (habit.frequency or "").lower() != "weekly" and stats.last_logged == target_date:
+            continue
+        items.append(_PlanItem(
+            key=f"habit:{habit.habit_id}", title=habit.name, kind="habit", category=habit.category,
+            minutes=SCHEDULER_HABIT_MINUTES, value=25.0, demand=0.2, early=0.02,
+            habit_id=habit.habit_id, work=False,
+        ))
+
+    started = time.perf_counter()
+    if window_start < window_end:
+        scheduler.solve(items)
+    else:
+        scheduler.unscheduled = items
+    solver_ms = (time.perf_counter() - started) * 1000
+
+    activities: List[Dict[str, Any]] = []
+    fit_value = 0.0
+    category_minutes: Dict[str, int] = {}
+    mood_weighted = mood_minutes = 0.0
+    for start, end, item, fixed in scheduler.blocks:
+        fit = scheduler.energy_at(start, end)
+        activities.append({
+            "id": item.key,
+            "title": item.title,
+            "start_time": to_local(start).isoformat(),
+            "end_time": to_local(end).isoformat(),
+            "category": item.kind,
+            "priority": "high" if item.priority >= 4 else "low" if item.priority <= 2 else "medium",
+            "related_task_id": item.task_id,
+            "related_habit_id": item.habit_id,
+            "is_flexible": not fixed,
+            "expected_energy": round(fit, 1),
+        })
+        if item.work:
+            fit_value += item.value * fit / 10.0
+            category_minutes[item.category] = category_minutes.get(item.category, 0) + item.minutes
+        hour = ((start + end) // 2 // 60) % 24
+        if hour_counts[hour] >= 2:
+            mood_weighted += hour_mood[hour] / hour_counts[hour] * (end - start)
+            mood_minutes += end - start
+    for start, end in scheduler.breaks():
+        activities.append({
+            "id": f"break:{start}",
+            "title": "استراحت",
+            "start_time": to_local(start).isoformat(),
+            "end_time": to_local(end).isoformat(),
+            "category": "break",
+            "priority": "low",
+            "related_task_id": None,
+            "related_habit_id": None,
+            "is_flexible": True,
+        })
+    activities.sort(key=lambda activity: activity["start_time"])
+    work_value = sum(item.value for item in items if item.work) + sum(
+        block[2].value for block in scheduler.blocks if block[3]
+    )
+    total_work = sum(category_minutes.values())
+    dominant = max(category_minutes, key=category_minutes.get) if category_minutes else None
+    return {
+        "activities": activities,
+        "unscheduled": [
+            {"id": item.key, "title": item.title, "category": item.kind, "related_task_id": item.task_id, "related_habit_id": item.habit_id}
+            for item in scheduler.unscheduled
+        ],
+        "expected_productivity": round(min(100.0, 100.0 * fit_value / work_value), 1) if work_value else 0.0,
+        "expected_mood": round(mood_weighted / mood_minutes, 1) if mood_minutes else current_mood,
+        "focus_theme": dominant if dominant and category_minutes[dominant] * 2 > total_work else "balanced",
+        "scheduled_work_minutes": scheduler.work_minutes,
+        "requested_work_minutes": sum(item.minutes for item in items if item.work) + sum(
+            block[2].minutes for block in scheduler.blocks if block[3] and block[2].work
+        ),
+        "available_minutes": max(0, window_end - window_start),
+        "focus_minutes": scheduler.focus_minutes,
+        "overdue_tasks": len({item.task_id for item in items + [block[2] for block in scheduler.blocks] if item.task_id and item.early >= 0.3}),
+        "solver_ms": round(solver_ms, 2),
+    }
+
+
+async def _store_daily_program(user_id: int, target_date: date, plan: Dict[str, Any]) -> DailyProgram:
+    """Upsert the (user, date) DailyProgram with a solver plan."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(DailyProgram)
+            .where(DailyProgram.user_id == user_id, DailyProgram.date == target_date)
+            .limit(1)
+        )
+        program = result.scalar_one_or_none()
+        if program is None:
+            program = DailyProgram(
+                user_id=user_id,
+                program_id=str(uuid.uuid4()),
+                date=target_date,
+                created_at=datetime.utcnow(),
+            )
+            session.add(program)
+        program.activities = json.dumps(plan["activities"], ensure_ascii=False)
+        program.expected_productivity = plan["expected_productivity"]
+        program.expected_mood = plan["expected_mood"]
+        program.focus_theme = plan["focus_theme"]
+        program.is_completed = False
+        program.generated_at = datetime.utcnow()
+        await session.commit()
+        return program
+
+
+# ═══════════════════════════════════════════════════════════════════
+# NIGHTLY PRE-GENERATION
+# ═══════════════════════════════════════════════════════════════════
+# برنامه و briefing روزی که کاربر در آن بیدار می‌شود، در ساعات کم‌بار محلیِ خودش ساخته می‌شود.
+# تازگی با digest ورودی‌های تسکِ همان روز سنجیده می‌شود: فقط تغییری که برنامهٔ آن روز را عوض می‌کند
+# خروجی را باطل می‌کند، نه نوشتن‌های سیستمی مثل reminder_sent یا occurrenceهای روزهای دور.
+PREGEN_ENABLED = os.getenv("PREGEN_ENABLED", "1") == "1"
+PREGEN_BRIEFINGS = os.getenv("PREGEN_BRIEFINGS", "1") == "1"
+PREGEN_WINDOW_START = int(os.getenv("PREGEN_WINDOW_START", "1"))  # local hour, inclusive
+PREGEN_WINDOW_END = int(os.getenv("PREGEN_WINDOW_END", "5"))  # local hour, exclusive
+PREGEN_INTERVAL = float(os.getenv("PREGEN_INTERVAL", "600"))
+PREGEN_CONCURRENCY = int(os.getenv("PREGEN_CONCURRENCY", "3"))
+PREGEN_BATCH_SIZE = int(os.getenv("PREGEN_BATCH_SIZE", "200"))
+PREGEN_JITTER = float(os.getenv("PREGEN_JITTER", "3"))
+
+
+def _in_pregen_window(hour: int) -> bool:
+    if PREGEN_WINDOW_START <= PREGEN_WINDOW_END:
+        return PREGEN_WINDOW_START <= hour < PREGEN_WINDOW_END
+    return hour >= PREGEN_WINDOW_START or hour < PREGEN_WINDOW_END
+
+
+def _pregen_target_date(local_now: datetime) -> date:
+    """The day the user wakes up into: today after midnight, tomorrow before it."""
+    return local_now.date() if local_now.hour < 12 else local_now.date() + timedelta(days=1)
+
+
+def _pregen_horizon(tz_name: Optional[str], target_date: date) -> datetime:
+    """UTC end of the task range _build_daily_plan reads for `target_date`."""
+    local_midnight = datetime.combine(target_date, datetime.min.time()).replace(tzinfo=_user_zone(tz_name))
+    return _naive_utc(local_midnight) + timedelta(days=1 + SCHEDULER_LOOKAHEAD_DAYS)
+
+
+async def _day_task_digests(session: AsyncSession, horizons: Dict[int, datetime]) -> Dict[int, str]:
+    """
+    Per user, a digest of the task fields the day's plan reads (active, non-template tasks
+    undated or due before the horizon). reminder_sent and updated_at are left out, so the
+    reminder engine and far-out recurrence materialization do not invalidate the day.
+    """
+    if not horizons:
+        return {}
+    is_master = select(TaskRecurrence.id).where(TaskRecurrence.task_id == UserTask.id).exists()
+    result = await session.execute(
+        select(
+            UserTask.user_id,
+            UserTask.task_id,
+            UserTask.title,
+            UserTask.category,
+            UserTask.priority,
+            UserTask.status,
+            UserTask.due_date,
+            UserTask.scheduled_time,
+            UserTask.estimated_duration_minutes,
+        )
+        .where(
+            UserTask.user_id.in_(list(horizons)),
+            UserTask.status.in_(_ACTIVE_TASK_STATUSES),
+            or_(UserTask.due_date.is_(None), UserTask.due_date < max(horizons.values())),
+            ~is_master,
+        )
+        .order_by(UserTask.user_id, UserTask.task_id)
+    )
+    digests = {user_id: hashlib.sha256() for user_id in horizons}
+    for user_id, *fields in result.all():
+        due_date = fields[5]
+        if due_date is not None and due_date >= horizons[user_id]:
+            continue
+        digests[user_id].update(json.dumps(fields, ensure_ascii=False, default=str).encode("utf-8"))
+    return {user_id: digest.hexdigest() for user_id, digest in digests.items()}
+
+
+def _pregen_is_fresh(row: Optional[PrecomputedDay], digest: Optional[str]) -> bool:
+    if row is None or row.source_digest != digest:
+        return False
+    return row.briefing is not None or not PREGEN_BRIEFINGS
+
+
+async def _precomputed_briefing(user_id: int, tz_name: Optional[str]) -> Optional[Tuple[Dict[str, Any], str]]:
+    """Today's pre-generated briefing, unless the day's tasks changed after it was generated."""
+    async with async_session() as session:
+        if tz_name is None:
+            tz_name = (
+                await session.execute(select(UserProfile.timezone).where(UserProfile.user_id == user_id))
+            ).scalar_one_or_none()
+        today = datetime.now(_user_zone(tz_name)).date()
+        row = (
+            await session.execute(
+                select(PrecomputedDay).where(PrecomputedDay.user_id == user_id, PrecomputedDay.date == today)
+            )
+        ).scalar_one_or_none()
+        if row is None or row.briefing is None:
+            return None
+        digest = (await _day_task_digests(session, {user_id: _pregen_horizon(tz_name, today)}))[user_id]
+    if row.source_digest != digest:
+        return None
+    return row.briefing, row.briefing_raw or ""
+
+
+async def _pregenerate_day(profile: UserProfile, target_date: date, previous: Optional[PrecomputedDay]) -> None:
+    user_id = profile.user_id
+    # سهمیهٔ LLM به حساب خود کاربر نوشته می‌شود، نه anonymous
+    _CURRENT_USER_KEY.set(str(user_id))
+    async with async_session() as session:
+        # digest قبل از ساخت خوانده می‌شود تا تغییرِ هم‌زمان خروجی را stale کند نه گم
+        horizon = _pregen_horizon(profile.timezone, target_date)
+        source_digest = (await _day_task_digests(session, {user_id: horizon}))[user_id]
+        current = (
+            await session.execute(
+                select(DailyProgram.program_id, DailyProgram.updated_at)
+                .where(DailyProgram.user_id == user_id, DailyProgram.date == target_date)
+                .limit(1)
+            )
+        ).first()
+    # همان snapshot زمینهٔ کاربر که endpointهای آنلاین استفاده می‌کنند، تا briefing کش‌شده با همان prompt ساخته شود
+    context = await _user_context(user_id)
+    plan = await _build_daily_plan(user_id, profile, target_date, context=context)
+    # فقط برنامه‌ای که همین pre-generator نوشته و کاربر بعد از آن تغییرش نداده بازنویسی می‌شود؛
+    # در غیر این صورت program_id خالی می‌ماند تا دورهای بعدی هم به برنامهٔ کاربر دست نزنند
+    owned = (
+        current is not None
+        and previous is not None
+        and previous.program_id == current.program_id
+        and (current.updated_at is None or current.updated_at <= previous.generated_at)
     )
+    program_id: Optional[str] = None
+    if current is None or owned:
+        program_id = (await _store_daily_program(user_id, target_date, plan)).program_id
+    briefing: Optional[Dict[str, Any]] = None
+    briefing_raw: Optional[str] = None
+    if PREGEN_BRIEFINGS:
+        zone = _user_zone(profile.timezone)
+        wake_at = datetime.combine(target_date, datetime.min.time()).replace(
+            hour=min(23, max(0, int(profile.wake_up_time or 6))), tzinfo=zone
+        )
+        request = DailyBriefingRequest(
+            timezone=profile.timezone,
+            now=wake_at.isoformat(),
+            tasks=[
+                {"title": activity["title"], "datetime": activity["start_time"], "priority": activity["priority"]}
+                for activity in plan["activities"]
+                if activity["category"] != "break"
+            ] + [{"title": item["title"], "datetime": None} for item in plan["unscheduled"]],
+        )
+        try:
+            briefing, briefing_raw = await _generate_daily_briefing(request, context)
+        except (LLMSaturatedError, HTTPException) as exc:
+            # برنامه ذخیره می‌شود؛ briefing در دور بعدی پنجره دوباره امتحان می‌شود
+            log.info("Briefing pre-generation for user %s deferred: %s", user_id, exc)
+    async with async_session() as session:
+        row = (
+            await session.execute(
+                select(PrecomputedDay).where(PrecomputedDay.user_id == user_id, PrecomputedDay.date == target_date)
+            )
+        ).scalar_one_or_none()
+        if row is None:
+            row = PrecomputedDay(user_id=user_id, date=target_date)
+            session.add(row)
+        row.program_id = program_id
+        row.briefing = briefing
+        row.briefing_raw = briefing_raw
+        row.source_digest = source_digest
+        row.generated_at = datetime.utcnow()
+        try:
+            await session.commit()
+        except IntegrityError:
+            # instance دیگری هم‌زمان همین روز را ساخته است
+            await session.rollback()
+    M_PREGEN_JOBS.inc("ok" if briefing is not None or not PREGEN_BRIEFINGS else "program_only")
+
+
+async def _pregenerate_pass() -> int:
+    """One sweep over profiles; users inside their local window get missing or stale days built."""
+    semaphore = asyncio.Semaphore(PREGEN_CONCURRENCY)
+    now = datetime.now(timezone.utc)
+    last_id = 0
+    generated = 0
+
+    async def run(profile: UserProfile, target_date: date, previous: Optional[PrecomputedDay]) -> int:
+        async with semaphore:
+            # پخش کردن درخواست‌ها تا همهٔ کاربرانِ یک منطقهٔ زمانی با هم به provider نرسند
+            await asyncio.sleep(random.uniform(0, PREGEN_JITTER))
+            try:
+                await _pregenerate_day(profile, target_date, previous)
+                return 1
+            except Exception as exc:  # noqa: BLE001
+                M_PREGEN_JOBS.inc("error")
+                log.warning("Pre-generation for user %s failed: %s", profile.user_id, exc)
+                return 0
+
+    while not AGENT_SCHEDULER_STOP.is_set():
+        async with async_session() as session:
+            result = await session.execute(
+                select(UserProfile).where(UserProfile.id > last_id).order_by(UserProfile.id).limit(PREGEN_BATCH_SIZE)
+            )
+            profiles = result.scalars().all()
+            if not profiles:
+                break
+            last_id = profiles[-1].id
+            due: Dict[int, Tuple[UserProfile, date]] = {}
+            for profile in profiles:
+                local_now = now.astimezone(_user_zone(profile.timezone))
+                if _in_pregen_window(local_now.hour):
+                    due[profile.user_id] = (profile, _pregen_target_date(local_now))
+            if not due:
+                continue
+            result = await session.execute(
+                select(PrecomputedDay).where(
+                    PrecomputedDay.user_id.in_(list(due)),
+                    PrecomputedDay.date.in_({target for _, target in due.values()}),
+                )
+            )
+            existing = {(row.user_id, row.date): row for row in result.scalars().all()}
+            digests = await _day_task_digests(session, {
+                user_id: _pregen_horizon(profile.timezone, target_date) for user_id, (profile, target_date) in due.items()
+            })
+        jobs = []
+        for user_id, (profile, target_date) in due.items():
+            row = existing.get((user_id, target_date))
+            if _pregen_is_fresh(row, digests.get(user_id)):
+                continue
+            jobs.append(run(profile, target_date, row))
+        if jobs:
+            generated += sum(await asyncio.gather(*jobs))
+    return generated
+
+
+async def _pregeneration_worker() -> None:
+    log.info("Nightly pre-generation worker started.")
+    try:
+        while not AGENT_SCHEDULER_STOP.is_set():
+            try:
+                generated = await _pregenerate_pass()
+                if generated:
+                    log.info("Pre-generated %d daily programs/briefings.", generated)
+            except Exception as exc:  # noqa: BLE001
+                log.exception("Pre-generation pass failed: %s", exc)
+            try:
+                await asyncio.wait_for(AGENT_SCHEDULER_STOP.wait(), timeout=PREGEN_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                continue
+    finally:
+        log.info("Nightly pre-generation worker stopped.")
+
+
 # ═══════════════════════════════════════════════════════════════════
 # PHASE 2: DAILY PROGRAM & SMART SCHEDULING ENDPOINTS
 # ═══════════════════════════════════════════════════════════════════
@@ -5876,52 +10387,59 @@ async def generate_daily_program(
     body: DailyProgramGenerateRequest,
     current_user: User = Depends(get_current_user),
 ):
-    """Generate daily program based on profile and current state"""
+    """Generate daily program based on profile and current state (local solver, no LLM call)"""
+    context = await _user_context(current_user.id)
+    if context.profile is None:
+        raise HTTPException(status_code=404, detail="پروفایل یافت نشد")
+    
+    target_date = (
+        datetime.fromisoformat(body.date.replace('Z', '+00:00')).date()
+        if body.date
+        else context.day
+    )
+    plan = await _build_daily_plan(
+        current_user.id, context.profile, target_date, body.current_mood, body.current_energy, context
+    )
+    program = await _store_daily_program(current_user.id, target_date, plan)
+    return DailyProgramResponse(
+        program_id=program.program_id,
+        user_id=current_user.id,
+        date=program.date.isoformat(),
+        activities=plan["activities"],
+        expected_productivity=program.expected_productivity,
+        expected_mood=program.expected_mood,
+        focus_theme=program.focus_theme,
+        created_at=program.created_at.isoformat(),
+        unscheduled=plan["unscheduled"],
+        solver_ms=plan["solver_ms"],
+    )
+@app.get("/user/program/today")
+async def get_today_program(current_user: User = Depends(get_current_user)):
+    """Get today's program (today in the user's timezone; usually pre-generated overnight)"""
     async with async_session() as session:
-        # Get user profile
-        stmt = select(UserProfile).where(UserProfile.user_id == current_user.id)
-        profile = await session.execute(stmt)
-        profile_obj = profile.scalar_one_or_none()
-        
-        if not profile_obj:
-            raise HTTPException(status_code=404, detail="پروفایل یافت نشد")
-        
-        # Get goals, habits, mood
-        goals_stmt = select(UserGoal).where(UserGoal.user_id == current_user.id)
-        goals_result = await session.execute(goals_stmt)
-        goals = goals_result.scalars().all()
-        
-        habits_stmt = select(Habit).where(Habit.user_id == current_user.id)
-        habits_result = await session.execute(habits_stmt)
-        habits = habits_result.scalars().all()
-        
-        # Create program
-        from uuid import uuid4
-        program_id = str(uuid4())
-        
-        program = DailyProgram(
-            user_id=current_user.id,
-            program_id=program_id,
-            date=datetime.fromisoformat(body.date.replace('Z', '+00:00')).date() if body.date else datetime.utcnow().date(),
-            activities=json.dumps([]),  # Activities will be calculated
-            expected_productivity=65.0,
-            expected_mood=body.current_mood,
-            focus_theme="balanced",
-            created_at=datetime.utcnow(),
-            generated_at=datetime.utcnow(),
-        )
+        tz_name = (
+            await session.execute(select(UserProfile.timezone).where(UserProfile.user_id == current_user.id))
+        ).scalar_one_or_none()
+        today = datetime.now(_user_zone(tz_name)).date()
+        stmt = select(DailyProgram).where(
+            (DailyProgram.user_id == current_user.id) & 
+            (DailyProgram.date == today)
+        ).order_by(DailyProgram.generated_at.desc()).limit(1)
+        result = await session.execute(stmt)
+        program = result.scalar_one_or_none()
         
-        session.add(program)
-        await session.commit()
+        if not program:
+            raise HTTPException(status_code=404, detail="برنامه برای امروز یافت نشد")
         
         return DailyProgramResponse(
             program_id=program.program_id,
-            user_id=current_user.id,
+            user_id=program.user_id,
             date=program.date.isoformat(),
-            activities=[],
+            activities=json.loads(program.activities) if program.activities else [],
             expected_productivity=program.expected_productivity,
             expected_mood=program.expected_mood,
             focus_theme=program.focus_theme,
+            is_completed=program.is_completed,
             created_at=program.created_at.isoformat(),
         )
 @app.get("/user/program/{date}")
@@ -5946,32 +10464,6 @@ async def get_program_for_date(
         if not program:
             raise HTTPException(status_code=404, detail="برنامه برای این تاریخ یافت نشد")
         
-        return DailyProgramResponse(
-            program_id=program.program_id,
-            user_id=program.user_id,
-            date=program.date.isoformat(),
-            activities=json.loads(program.activities) if program.activities else [],
-            expected_productivity=program.expected_productivity,
-            expected_mood=program.expected_mood,
-            focus_theme=program.focus_theme,
-            is_completed=program.is_completed,
-            created_at=program.created_at.isoformat(),
-        )
-@app.get("/user/program/today")
-async def get_today_program(current_user: User = Depends(get_current_user)):
-    """Get today's program"""
-    async with async_session() as session:
-        today = datetime.utcnow().date()
-        stmt = select(DailyProgram).where(
-            (DailyProgram.user_id == current_user.id) & 
-            (DailyProgram.date == today)
-        )
-        result = await session.execute(stmt)
-        program = result.scalar_one_or_none()
-        
-        if not program:
-            raise HTTPException(status_code=404, detail="برنامه برای امروز یافت نشد")
-        
         return DailyProgramResponse(
             program_id=program.program_id,
             user_id=program.user_id,
@@ -6084,32 +10576,71 @@ async def delete_activity(
         await session.commit()
         
         return {"status": "deleted", "activity_id": activity_id}
+def _schedule_health(plan: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """Load vs capacity label plus rule-based improvements for a solved day."""
+    capacity = min(plan["available_minutes"], plan["focus_minutes"]) or 1
+    load = plan["requested_work_minutes"] / capacity
+    status = "عالی" if load <= 0.8 else "خوب" if load <= 1.0 else "متوسط" if load <= 1.3 else "ضعیف"
+    improvements: List[str] = []
+    if plan["unscheduled"]:
+        improvements.append(f"⚠️ {len(plan['unscheduled'])} کار در برنامهٔ امروز جا نشد؛ بعضی را به روزهای بعد منتقل کنید")
+    if plan["requested_work_minutes"] > plan["focus_minutes"]:
+        improvements.append(f"⚠️ حجم کار از سقف تمرکز روزانه ({plan['focus_minutes'] // 60} ساعت) بیشتر است")
+    if plan["overdue_tasks"]:
+        improvements.append(f"⏰ {plan['overdue_tasks']} کار عقب‌افتاده دارید؛ در ساعات اول روز قرار گرفتند")
+    if plan["scheduled_work_minutes"] >= 120 and not any(a["category"] == "break" for a in plan["activities"]):
+        improvements.append("✏️ بین بلوک‌های کاری استراحت بگذارید")
+    if not improvements:
+        improvements.append("✅ برنامهٔ امروز متعادل است")
+    return status, improvements
+
+
 @app.post("/user/scheduling/analyze", response_model=SchedulingAnalysisResponse)
 async def analyze_scheduling(
     body: SchedulingRecommendationRequest,
     current_user: User = Depends(get_current_user),
 ):
     """Analyze schedule and get recommendations"""
+    context = await _user_context(current_user.id)
+    if context.profile is None:
+        raise HTTPException(status_code=404, detail="پروفایل یافت نشد")
+    
+    plan = await _build_daily_plan(current_user.id, context.profile, context.day, context=context)
+    recommendations: List[SchedulingRecommendationResponse] = []
+    seen: set = set()
+    for activity in plan["activities"]:
+        task_id = activity.get("related_task_id")
+        if not task_id or task_id in seen:
+            continue
+        seen.add(task_id)
+        energy = activity.get("expected_energy", 5.0)
+        factors = [f"energy:{energy}", f"priority:{activity['priority']}"]
+        if not activity["is_flexible"]:
+            factors.append("fixed_time")
+        reason = (
+            "زمان ثابت تعیین‌شده" if not activity["is_flexible"]
+            else "ساعت پرانرژی شما برای این کار" if energy >= 7
+            else "بهترین زمان آزاد با توجه به مهلت و اولویت"
+        )
+        recommendations.append(SchedulingRecommendationResponse(
+            task_id=task_id,
+            task_title=activity["title"],
+            recommended_time=activity["start_time"],
+            reason=reason,
+            score=round(energy * 10, 1),
+            factors=factors,
+            is_optimal=energy >= 7,
+        ))
+    status_label, improvements = _schedule_health(plan)
+    
     async with async_session() as session:
-        # Get user data
-        profile_stmt = select(UserProfile).where(UserProfile.user_id == current_user.id)
-        profile = await session.execute(profile_stmt)
-        profile_obj = profile.scalar_one_or_none()
-        
-        if not profile_obj:
-            raise HTTPException(status_code=404, detail="پروفایل یافت نشد")
-        
-        # Create analysis
-        from uuid import uuid4
-        analysis_id = str(uuid4())
-        
         analysis = SchedulingAnalysis(
             user_id=current_user.id,
-            analysis_id=analysis_id,
-            recommendations=json.dumps([]),
-            overall_productivity_score=75.0,
-            schedule_health_status="خوب",
-            improvements=json.dumps([]),
+            analysis_id=str(uuid.uuid4()),
+            recommendations=json.dumps([r.dict() for r in recommendations], ensure_ascii=False),
+            overall_productivity_score=plan["expected_productivity"],
+            schedule_health_status=status_label,
+            improvements=json.dumps(improvements, ensure_ascii=False),
             created_at=datetime.utcnow(),
         )
         
@@ -6117,13 +10648,10 @@ async def analyze_scheduling(
         await session.commit()
         
         return SchedulingAnalysisResponse(
-            recommendations=[],
-            overall_productivity_score=75.0,
-            schedule_health_status="خوب",
-            improvements=[
-                "⚠️ وقت تمرکز کافی نیست",
-                "✏️ بیشتر استراحت کنید",
-            ],
+            recommendations=recommendations,
+            overall_productivity_score=analysis.overall_productivity_score,
+            schedule_health_status=analysis.schedule_health_status,
+            improvements=improvements,
             generated_at=analysis.created_at.isoformat(),
         )
 @app.get("/user/scheduling/recommendations")
@@ -6141,13 +10669,592 @@ async def get_scheduling_recommendations(current_user: User = Depends(get_curren
             raise HTTPException(status_code=404, detail="توصیه‌ای یافت نشد")
         
         return SchedulingAnalysisResponse(
-            recommendations=[],
+            recommendations=json.loads(analysis.recommendations) if analysis.recommendations else [],
             overall_productivity_score=analysis.overall_productivity_score,
             schedule_health_status=analysis.schedule_health_status,
             improvements=json.loads(analysis.improvements) if analysis.improvements else [],
             generated_at=analysis.created_at.isoformat(),
         )
 
+# ═══════════════════════════════════════════════════════════════════
+# TASK REMINDER ENGINE
+# ═══════════════════════════════════════════════════════════════════
+REMINDER_ENGINE_ENABLED = os.getenv("REMINDER_ENGINE_ENABLED", "1") == "1"
+REMINDER_BUCKET_SECONDS = int(os.getenv("REMINDER_BUCKET_SECONDS", "60"))
+REMINDER_LEASE_SECONDS = int(os.getenv("REMINDER_LEASE_SECONDS", "120"))
+REMINDER_TICK_SECONDS = float(os.getenv("REMINDER_TICK_SECONDS", "5"))
+# یادآورهایی که بیش از این دیرتر از موعد مانده‌اند (مثلاً بعد از downtime طولانی) دیگر ارسال نمی‌شوند
+REMINDER_MAX_LATENESS_MINUTES = int(os.getenv("REMINDER_MAX_LATENESS_MINUTES", "360"))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "5"))
+REMINDER_RETRY_BASE_SECONDS = int(os.getenv("REMINDER_RETRY_BASE_SECONDS", "30"))
+REMINDER_LEASE_PRUNE_MINUTES = int(os.getenv("REMINDER_LEASE_PRUNE_MINUTES", "30"))
+_ACTIVE_TASK_STATUSES = ("pending", "in_progress")
+_REMINDER_EPOCH = datetime(2000, 1, 1)
+
+
+def _reminder_bucket(moment: datetime) -> datetime:
+    seconds = int((moment - _REMINDER_EPOCH).total_seconds())
+    return _REMINDER_EPOCH + timedelta(seconds=seconds - seconds % REMINDER_BUCKET_SECONDS)
+
+
+async def _sync_task_reminder(session: AsyncSession, task: UserTask) -> None:
+    """
+    یادآور زمان‌بندی‌شدهٔ تسک را با وضعیت فعلی‌اش هماهنگ می‌کند (بعد از ساخت/ویرایش/تکمیل).
+    به‌جای اسکن دوره‌ای user_tasks، هر تغییر تسک ردیف TaskReminder خودش را می‌سازد.
+    """
+    await session.execute(
+        update(TaskReminder)
+        .where(TaskReminder.task_id == task.id, TaskReminder.status == "scheduled")
+        .values(status="cancelled")
+    )
+    reminder = _task_reminder_row(task, datetime.utcnow())
+    if reminder is not None:
+        session.add(reminder)
+        _REMINDER_ENGINE.notify(reminder.scheduled_at)
+
+
+def _task_reminder_row(task: UserTask, now: datetime) -> Optional[TaskReminder]:
+    """The scheduled reminder a (flushed) task should have right now, or None."""
+    if task.status not in _ACTIVE_TASK_STATUSES or task.due_date is None or task.reminder_before_minutes is None:
+        return None
+    if task.reminder_sent:
+        return None
+    remind_at = _naive_utc(task.due_date) - timedelta(minutes=task.reminder_before_minutes)
+    if remind_at < now - timedelta(minutes=REMINDER_MAX_LATENESS_MINUTES):
+        return None
+    # یادآورِ گذشته در bucket جاری قرار می‌گیرد تا bucketهای بسته‌شده دوباره باز نشوند
+    return TaskReminder(
+        task_id=task.id,
+        user_id=task.user_id,
+        scheduled_at=max(remind_at, now),
+        channel="push",
+        status="scheduled",
+        message=f"یادآوری: {task.title}",
+    )
+
+
+async def _backfill_task_reminders(batch_size: int = 500) -> int:
+    """Materialize reminders for upcoming tasks created before the engine existed (due_date index range)."""
+    since = datetime.utcnow() - timedelta(minutes=REMINDER_MAX_LATENESS_MINUTES)
+    last_id = 0
+    created = 0
+    while True:
+        async with async_session() as session:
+            has_reminder = select(TaskReminder.id).where(TaskReminder.task_id == UserTask.id).exists()
+            result = await session.execute(
+                select(UserTask).where(
+                    UserTask.due_date >= since,
+                    UserTask.id > last_id,
+                    UserTask.status.in_(_ACTIVE_TASK_STATUSES),
+                    UserTask.reminder_sent.is_(False),
+                    ~has_reminder,
+                ).order_by(UserTask.id).limit(batch_size)
+            )
+            tasks = result.scalars().all()
+            if not tasks:
+                return created
+            for task in tasks:
+                await _sync_task_reminder(session, task)
+            await session.commit()
+            created += len(tasks)
+            last_id = tasks[-1].id
+
+
+class _ReminderEngine:
+    """
+    Dispatches TaskReminder rows with at-least-once semantics.
+
+    Reminders are grouped into REMINDER_BUCKET_SECONDS time buckets. A worker must hold
+    the lease row of a bucket (reminder_bucket_leases) to dispatch it, so several worker
+    processes split the load and a crashed worker's buckets are taken over once its lease
+    expires. Held buckets are loaded into a min-heap and fired on time; a reminder is
+    marked sent only after the push succeeded, so a crash in between means a duplicate,
+    never a lost reminder.
+    """
+
+    def __init__(self) -> None:
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._heap: List[Tuple[datetime, int, datetime]] = []
+        self._queued: set = set()
+        # bucket_start -> reminder ids still queued from that bucket
+        self._held: Dict[datetime, set] = {}
+        self._attempts: Dict[int, int] = {}
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at: Optional[datetime] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run())
+            log.info("Reminder engine started (owner=%s).", self.owner)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self, remind_at: datetime) -> None:
+        """Wake the loop early when a reminder lands in a bucket this worker already holds."""
+        if _reminder_bucket(remind_at) in self._held:
+            self._wake.set()
+
+    async def _claim_bucket(self, bucket: datetime, now: datetime, reopen: bool) -> bool:
+        lease_until = now + timedelta(seconds=REMINDER_LEASE_SECONDS)
+        conditions = [
+            ReminderBucketLease.bucket_start == bucket,
+            or_(ReminderBucketLease.lease_until < now, ReminderBucketLease.owner == self.owner),
+        ]
+        if not reopen:
+            conditions.append(ReminderBucketLease.completed.is_(False))
+        async with async_session() as session:
+            result = await session.execute(
+                update(ReminderBucketLease)
+                .where(*conditions)
+                .values(owner=self.owner, lease_until=lease_until, completed=False)
+            )
+            if result.rowcount == 1:
+                await session.commit()
+                return True
+            existing = await session.execute(
+                select(ReminderBucketLease.id).where(ReminderBucketLease.bucket_start == bucket)
+            )
+            if existing.first() is not None:
+                return False
+            session.add(ReminderBucketLease(
+                bucket_start=bucket, owner=self.owner, lease_until=lease_until, completed=False
+            ))
+            try:
+                await session.commit()
+            except IntegrityError:
+                return False
+        return True
+
+    async def _claim_buckets(self, now: datetime) -> None:
+        current = _reminder_bucket(now)
+        candidates: Dict[datetime, bool] = {
+            current: False,
+            current + timedelta(seconds=REMINDER_BUCKET_SECONDS): False,
+        }
+        # bucketهای گذشته که هنوز یادآور ارسال‌نشده دارند (downtime یا worker از کار افتاده)
+        async with async_session() as session:
+            result = await session.execute(
+                select(TaskReminder.scheduled_at).where(
+                    TaskReminder.scheduled_at >= now - timedelta(minutes=REMINDER_MAX_LATENESS_MINUTES),
+                    TaskReminder.scheduled_at < current,
+                    TaskReminder.status == "scheduled",
+                ).order_by(TaskReminder.scheduled_at).limit(1000)
+            )
+            for (scheduled_at,) in result.all():
+                candidates[_reminder_bucket(scheduled_at)] = True
+        for bucket, reopen in candidates.items():
+            if bucket in self._held:
+                continue
+            if await self._claim_bucket(bucket, now, reopen):
+                self._held[bucket] = set()
+        await self._prune_leases(now)
+
+    async def _prune_leases(self, now: datetime) -> None:
+        """Drop expired leases of buckets older than the lateness lookback; they are never reopened."""
+        if self._pruned_at is not None and now - self._pruned_at < timedelta(minutes=REMINDER_LEASE_PRUNE_MINUTES):
+            return
+        self._pruned_at = now
+        async with async_session() as session:
+            result = await session.execute(
+                delete(ReminderBucketLease).where(
+                    ReminderBucketLease.bucket_start < now - timedelta(minutes=REMINDER_MAX_LATENESS_MINUTES),
+                    ReminderBucketLease.lease_until < now,
+                )
+            )
+            await session.commit()
+        if result.rowcount:
+            log.info("Pruned %s expired reminder bucket leases.", result.rowcount)
+
+    async def _renew_leases(self, now: datetime) -> None:
+        if not self._held:
+            return
+        async with async_session() as session:
+            await session.execute(
+                update(ReminderBucketLease)
+                .where(
+                    ReminderBucketLease.bucket_start.in_(list(self._held)),
+                    ReminderBucketLease.owner == self.owner,
+                )
+                .values(lease_until=now + timedelta(seconds=REMINDER_LEASE_SECONDS))
+            )
+            await session.commit()
+
+    async def _load_held(self) -> None:
+        if not self._held:
+            return
+        start = min(self._held)
+        end = max(self._held) + timedelta(seconds=REMINDER_BUCKET_SECONDS)
+        async with async_session() as session:
+            result = await session.execute(
+                select(TaskReminder.id, TaskReminder.scheduled_at).where(
+                    TaskReminder.scheduled_at >= start,
+                    TaskReminder.scheduled_at < end,
+                    TaskReminder.status == "scheduled",
+                )
+            )
+            rows = result.all()
+        for reminder_id, scheduled_at in rows:
+            bucket = _reminder_bucket(scheduled_at)
+            if bucket not in self._held or reminder_id in self._queued:
+                continue
+            self._queued.add(reminder_id)
+            self._held[bucket].add(reminder_id)
+            heapq.heappush(self._heap, (scheduled_at, reminder_id, bucket))
+
+    async def _deliver(self, reminder_id: int, now: datetime) -> None:
+        async with async_session() as session:
+            result = await session.execute(
+                select(TaskReminder, UserTask)
+                .join(UserTask, UserTask.id == TaskReminder.task_id)
+                .where(TaskReminder.id == reminder_id, TaskReminder.status == "scheduled")
+            )
+            row = result.first()
+        if row is None:
+            return
+        reminder, task = row
+        if task.status not in _ACTIVE_TASK_STATUSES:
+            outcome, values = "skipped", {"status": "cancelled"}
+        else:
+            try:
+                sent = await _send_push_notification(
+                    reminder.user_id, "یادآوری تسک", reminder.message or f"یادآوری: {task.title}"
+                )
+            except HTTPException:
+                # FCM پیکربندی نشده است
+                sent = False
+            except Exception as exc:  # noqa: BLE001
+                log.warning("Reminder %s push failed: %s", reminder_id, exc)
+                sent = False
+            attempts = self._attempts.get(reminder_id, 0) + 1
+            if sent:
+                outcome, values = "sent", {"status": "sent", "sent_at": now}
+                M_TASK_REMINDER_DELAY.observe(max(0.0, (now - reminder.scheduled_at).total_seconds()))
+            elif attempts >= REMINDER_MAX_ATTEMPTS:
+                outcome, values = "failed", {"status": "failed"}
+            else:
+                self._attempts[reminder_id] = attempts
+                retry_at = now + timedelta(seconds=REMINDER_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+                outcome, values = "retry", {"scheduled_at": retry_at}
+        if outcome != "retry":
+            self._attempts.pop(reminder_id, None)
+        M_TASK_REMINDERS.inc(outcome)
+        async with async_session() as session:
+            await session.execute(
+                update(TaskReminder)
+                .where(TaskReminder.id == reminder_id, TaskReminder.status == "scheduled")
+                .values(**values)
+            )
+            if outcome == "sent":
+                await session.execute(
+                    update(UserTask).where(UserTask.id == task.id).values(reminder_sent=True)
+                )
+                await _record_sync_changes(session, task.user_id, [("task", task.task_id, "upsert")])
+            await session.commit()
+
+    async def _fire_due(self, now: datetime) -> None:
+        fired = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, reminder_id, bucket = heapq.heappop(self._heap)
+            self._queued.discard(reminder_id)
+            self._held.get(bucket, set()).discard(reminder_id)
+            await self._deliver(reminder_id, datetime.utcnow())
+            fired += 1
+            if fired % 20 == 0:
+                await self._renew_leases(datetime.utcnow())
+
+    async def _finish_buckets(self, now: datetime) -> None:
+        for bucket in [b for b, queued in self._held.items() if not queued]:
+            if bucket + timedelta(seconds=REMINDER_BUCKET_SECONDS) > now:
+                continue
+            async with async_session() as session:
+                pending = await session.execute(
+                    select(TaskReminder.id).where(
+                        TaskReminder.scheduled_at >= bucket,
+                        TaskReminder.scheduled_at < bucket + timedelta(seconds=REMINDER_BUCKET_SECONDS),
+                        TaskReminder.status == "scheduled",
+                    ).limit(1)
+                )
+                if pending.first() is not None:
+                    continue
+                await session.execute(
+                    update(ReminderBucketLease)
+                    .where(ReminderBucketLease.bucket_start == bucket, ReminderBucketLease.owner == self.owner)
+                    .values(completed=True)
+                )
+                await session.commit()
+            self._held.pop(bucket, None)
+
+    async def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    now = datetime.utcnow()
+                    await self._claim_buckets(now)
+                    await self._renew_leases(now)
+                    await self._load_held()
+                    await self._fire_due(datetime.utcnow())
+                    await self._finish_buckets(datetime.utcnow())
+                except Exception as exc:  # noqa: BLE001
+                    log.exception("Reminder engine iteration failed: %s", exc)
+                timeout = REMINDER_TICK_SECONDS
+                if self._heap:
+                    timeout = min(timeout, max(0.0, (self._heap[0][0] - datetime.utcnow()).total_seconds()))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            log.info("Reminder engine stopped.")
+
+
+_REMINDER_ENGINE = _ReminderEngine()
+
+
+# ═══════════════════════════════════════════════════════════════════
+# TASK RECURRENCE EXPANSION
+# ═══════════════════════════════════════════════════════════════════
+RECURRENCE_HORIZON_DAYS = int(os.getenv("RECURRENCE_HORIZON_DAYS", "14"))
+RECURRENCE_MATERIALIZE_INTERVAL = float(os.getenv("RECURRENCE_MATERIALIZE_INTERVAL", "3600"))
+RECURRENCE_MAX_OCCURRENCES = int(os.getenv("RECURRENCE_MAX_OCCURRENCES", "1000"))
+RECURRENCE_CACHE_SIZE = int(os.getenv("RECURRENCE_CACHE_SIZE", "5000"))
+CALENDAR_MAX_DAYS = int(os.getenv("CALENDAR_MAX_DAYS", "62"))
+
+
+def _recurrence_days(raw: Any) -> List[int]:
+    """days_of_week هم به‌صورت list و هم رشتهٔ JSON (رکوردهای قدیمی) ذخیره شده است."""
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError:
+            return []
+    if not isinstance(raw, list):
+        return []
+    return sorted({int(day) for day in raw if isinstance(day, (int, float, str)) and str(day).strip().isdigit() and 0 <= int(day) <= 6})
+
+
+def _add_months(year: int, month: int, months: int) -> Tuple[int, int]:
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def _expand_recurrence(
+    dtstart: datetime,
+    pattern: str,
+    frequency: int,
+    days_of_week: List[int],
+    until: Optional[datetime],
+    range_start: datetime,
+    range_end: datetime,
+) -> List[datetime]:
+    """
+    Occurrences of an RRULE-like rule inside [range_start, range_end).
+
+    The first candidate period is computed arithmetically from range_start, so a month of a
+    years-old series costs the same as a month of a new one. monthly follows RRULE: months
+    without dtstart's day (e.g. the 31st) are skipped. custom is weekly when days_of_week is
+    set, otherwise every `frequency` days.
+    """
+    frequency = max(1, int(frequency or 1))
+    end = range_end if until is None else min(range_end, until + timedelta(microseconds=1))
+    start = max(range_start, dtstart)
+    if start >= end:
+        return []
+    pattern = (pattern or "daily").lower()
+    if pattern == "custom":
+        pattern = "weekly" if days_of_week else "daily"
+    occurrences: List[datetime] = []
+
+    if pattern == "daily":
+        step = timedelta(days=frequency)
+        skip = max(0, -(-(start - dtstart) // step))  # ceil
+        current = dtstart + step * skip
+        while current < end and len(occurrences) < RECURRENCE_MAX_OCCURRENCES:
+            occurrences.append(current)
+            current += step
+    elif pattern == "weekly":
+        days = days_of_week or [dtstart.weekday()]
+        anchor_week = dtstart - timedelta(days=dtstart.weekday())
+        weeks = max(0, (start - anchor_week).days // 7)
+        week = anchor_week + timedelta(weeks=weeks - weeks % frequency)
+        while week < end and len(occurrences) < RECURRENCE_MAX_OCCURRENCES:
+            for day in days:
+                current = week + timedelta(days=day)
+                if start <= current < end:
+                    occurrences.append(current)
+            week += timedelta(weeks=frequency)
+    elif pattern == "monthly":
+        months = max(0, (start.year - dtstart.year) * 12 + start.month - dtstart.month)
+        offset = months - months % frequency
+        while len(occurrences) < RECURRENCE_MAX_OCCURRENCES:
+            year, month = _add_months(dtstart.year, dtstart.month, offset)
+            offset += frequency
+            try:
+                current = dtstart.replace(year=year, month=month)
+            except ValueError:
+                continue
+            if current >= end:
+                break
+            if current >= start:
+                occurrences.append(current)
+    return occurrences[:RECURRENCE_MAX_OCCURRENCES]
+
+
+_RECURRENCE_CACHE: "OrderedDict[Tuple[Any, ...], List[datetime]]" = OrderedDict()
+
+
+def _recurrence_anchor(master: UserTask) -> datetime:
+    return master.scheduled_time or master.created_at
+
+
+def _recurrence_occurrences(
+    recurrence: TaskRecurrence,
+    master: UserTask,
+    range_start: datetime,
+    range_end: datetime,
+) -> List[datetime]:
+    """Cached expansion; the key holds every rule field, so editing a rule never serves stale results."""
+    dtstart = _recurrence_anchor(master)
+    days = _recurrence_days(recurrence.days_of_week)
+    key = (
+        master.user_id, recurrence.id, recurrence.pattern, recurrence.frequency, tuple(days),
+        recurrence.end_date, dtstart, range_start, range_end,
+    )
+    hit = _RECURRENCE_CACHE.get(key)
+    if hit is not None:
+        _RECURRENCE_CACHE.move_to_end(key)
+        return hit
+    occurrences = _expand_recurrence(
+        dtstart, recurrence.pattern, recurrence.frequency, days, recurrence.end_date, range_start, range_end
+    )
+    _RECURRENCE_CACHE[key] = occurrences
+    while len(_RECURRENCE_CACHE) > RECURRENCE_CACHE_SIZE:
+        _RECURRENCE_CACHE.popitem(last=False)
+    return occurrences
+
+
+async def _materialize_recurrence(
+    session: AsyncSession,
+    recurrence: TaskRecurrence,
+    master: UserTask,
+    now: datetime,
+) -> int:
+    """
+    occurrenceهای افق RECURRENCE_HORIZON_DAYS را به تسک واقعی تبدیل می‌کند (با یادآور).
+    occurrenceهایی که قبلاً ساخته یا حذف شده‌اند (ردیف TaskOccurrence دارند) دوباره ساخته نمی‌شوند.
+    """
+    horizon_end = now + timedelta(days=RECURRENCE_HORIZON_DAYS)
+    occurrences = _expand_recurrence(
+        _recurrence_anchor(master),
+        recurrence.pattern,
+        recurrence.frequency,
+        _recurrence_days(recurrence.days_of_week),
+        recurrence.end_date,
+        now,
+        horizon_end,
+    )
+    if not occurrences:
+        return 0
+    result = await session.execute(
+        select(TaskOccurrence.occurrence_at).where(
+            TaskOccurrence.recurrence_id == recurrence.id,
+            TaskOccurrence.occurrence_at >= now,
+            TaskOccurrence.occurrence_at < horizon_end,
+        )
+    )
+    known = set(result.scalars().all())
+    created = 0
+    for occurrence in occurrences:
+        if occurrence in known:
+            continue
+        task = UserTask(
+            user_id=master.user_id,
+            task_id=str(uuid.uuid4()),
+            title=master.title,
+            description=master.description,
+            category=master.category,
+            priority=master.priority,
+            due_date=occurrence,
+            estimated_duration_minutes=master.estimated_duration_minutes,
+            linked_goal_id=master.linked_goal_id,
+            location=master.location,
+            subtasks=json.dumps([]),
+            tags=master.tags,
+            reminder_before_minutes=master.reminder_before_minutes,
+            created_at=now,
+            status="pending",
+        )
+        session.add(task)
+        await session.flush()
+        session.add(TaskOccurrence(
+            recurrence_id=recurrence.id,
+            user_id=master.user_id,
+            task_id=task.id,
+            occurrence_at=occurrence,
+            status="materialized",
+        ))
+        await _sync_task_reminder(session, task)
+        created += 1
+    return created
+
+
+async def _materialize_all_recurrences(batch_size: int = 200) -> int:
+    now = datetime.utcnow()
+    last_id = 0
+    created = 0
+    while True:
+        async with async_session() as session:
+            result = await session.execute(
+                select(TaskRecurrence, UserTask)
+                .join(UserTask, UserTask.id == TaskRecurrence.task_id)
+                .where(
+                    TaskRecurrence.id > last_id,
+                    or_(TaskRecurrence.end_date.is_(None), TaskRecurrence.end_date >= now),
+                )
+                .order_by(TaskRecurrence.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                return created
+            last_id = rows[-1][0].id
+            for recurrence, master in rows:
+                try:
+                    # savepoint برای هر الگو: تداخل یک الگو بقیهٔ batch را برنمی‌گرداند
+                    async with session.begin_nested():
+                        made = await _materialize_recurrence(session, recurrence, master, now)
+                        await session.flush()
+                except IntegrityError:
+                    # worker دیگری هم‌زمان occurrenceهای همین الگو را ساخته است
+                    continue
+                created += made
+            await session.commit()
+
+
+async def _recurrence_materializer_worker() -> None:
+    log.info("Recurrence materializer started.")
+    try:
+        while not AGENT_SCHEDULER_STOP.is_set():
+            try:
+                created = await _materialize_all_recurrences()
+                if created:
+                    log.info("Materialized %d recurring task occurrences.", created)
+            except Exception as exc:  # noqa: BLE001
+                log.exception("Recurrence materialization failed: %s", exc)
+            try:
+                await asyncio.wait_for(AGENT_SCHEDULER_STOP.wait(), timeout=RECURRENCE_MATERIALIZE_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                continue
+    finally:
+        log.info("Recurrence materializer stopped.")
+
+
 # ═══════════════════════════════════════════════════════════════════
 # TASK MANAGEMENT ENDPOINTS
 # ═══════════════════════════════════════════════════════════════════
@@ -6174,7 +11281,11 @@ async def create_task(body: TaskCreateRequest, current_user: User = Depends(get_
             created_at=now,
             status="pending"
         )
+        if body.reminder_before_minutes is not None:
+            task.reminder_before_minutes = body.reminder_before_minutes
         session.add(task)
+        await session.flush()
+        await _sync_task_reminder(session, task)
         await session.commit()
         await session.refresh(task)
     
@@ -6197,55 +11308,241 @@ async def create_task(body: TaskCreateRequest, current_user: User = Depends(get_
         reminder_sent=task.reminder_sent
     )
 
+TASKS_PAGE_DEFAULT = int(os.getenv("TASKS_PAGE_DEFAULT", "100"))
+TASKS_PAGE_MAX = int(os.getenv("TASKS_PAGE_MAX", "500"))
+_TASK_LIST_FIELDS: Dict[str, Any] = {
+    "task_id": UserTask.task_id,
+    "title": UserTask.title,
+    "description": UserTask.description,
+    "category": UserTask.category,
+    "status": UserTask.status,
+    "priority": UserTask.priority,
+    "due_date": UserTask.due_date,
+    "scheduled_time": UserTask.scheduled_time,
+    "estimated_duration_minutes": UserTask.estimated_duration_minutes,
+    "linked_goal_id": UserTask.linked_goal_id,
+    "subtasks": UserTask.subtasks,
+    "location": UserTask.location,
+    "tags": UserTask.tags,
+    "created_at": UserTask.created_at,
+    "completed_at": UserTask.completed_at,
+    "reminder_sent": UserTask.reminder_sent,
+}
+
+
+def _json_list(value: Any) -> List[Any]:
+    """subtasks/tags در ستون JSON گاهی به‌صورت رشتهٔ json.dumps ذخیره شده‌اند."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return []
+    return value if isinstance(value, list) else []
+
+
+def _encode_task_cursor(due_date: Optional[datetime], row_id: int) -> str:
+    raw = json.dumps([due_date.isoformat() if due_date else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_task_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        due_raw, row_id = json.loads(raw)
+        return (datetime.fromisoformat(due_raw) if due_raw else None), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است.")
+
+
+def _task_list_value(field: str, value: Any) -> Any:
+    if field in ("subtasks", "tags"):
+        return _json_list(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
 @app.get("/tasks", response_model=TaskListResponse)
 async def list_tasks(
+    request: Request,
     status: Optional[str] = None,
     category: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=TASKS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    """List tasks with filters"""
+    """
+    List tasks with filters, ordered by (due_date, id) so pages walk ix_user_task_due.
+
+    Without `limit` and `cursor` every matching task is returned (older clients read a
+    single response); paging starts when either is sent, with TASKS_PAGE_DEFAULT as the
+    default page size. `cursor` is the next_cursor of the previous page; `fields` is a comma
+    separated subset of TaskResponse fields (task_id is always returned). total/overdue_count/today_count
+    cover every matching task and come from one aggregate query, which also feeds the ETag:
+    an unchanged list answers If-None-Match with 304 without loading any rows.
+    """
+    if fields:
+        selected = ["task_id"] + [name for name in dict.fromkeys(f.strip() for f in fields.split(",")) if name and name != "task_id"]
+        unknown = [name for name in selected if name not in _TASK_LIST_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"فیلد نامعتبر: {', '.join(unknown)}")
+    else:
+        selected = list(_TASK_LIST_FIELDS)
+    after = _decode_task_cursor(cursor) if cursor else None
+    if limit is None and cursor:
+        limit = TASKS_PAGE_DEFAULT
+
+    filters = [UserTask.user_id == current_user.id]
+    if status:
+        filters.append(UserTask.status == status)
+    if category:
+        filters.append(UserTask.category == category)
+    now = datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    open_task = UserTask.status != "completed"
+
     async with async_session() as session:
-        stmt = select(UserTask).where(UserTask.user_id == current_user.id)
-        
-        if status:
-            stmt = stmt.where(UserTask.status == status)
-        if category:
-            stmt = stmt.where(UserTask.category == category)
-        
         result = await session.execute(
-            stmt.order_by(UserTask.due_date.asc(), UserTask.priority.desc())
+            select(
+                func.count(UserTask.id),
+                func.max(UserTask.id),
+                # updated_at دقت ثانیه دارد؛ seq همگام‌سازی هر ویرایش/حذف را جدا می‌کند
+                select(SyncCounter.seq).where(SyncCounter.user_id == current_user.id).scalar_subquery(),
+                func.max(UserTask.updated_at),
+                func.sum(case((and_(UserTask.due_date < now, open_task), 1), else_=0)),
+                func.sum(case((and_(
+                    UserTask.due_date >= today_start,
+                    UserTask.due_date < today_start + timedelta(days=1),
+                    open_task,
+                ), 1), else_=0)),
+            ).where(*filters)
         )
-        tasks = result.scalars().all()
-        
-        now = datetime.utcnow()
-        overdue = sum(1 for t in tasks if t.due_date and t.due_date < now and t.status != "completed")
-        today = sum(1 for t in tasks if t.due_date and t.due_date.date() == now.date() and t.status != "completed")
-        
-        return TaskListResponse(
-            total=len(tasks),
-            tasks=[
-                TaskResponse(
-                    task_id=t.task_id,
-                    title=t.title,
-                    description=t.description,
-                    category=t.category,
-                    status=t.status,
-                    priority=t.priority,
-                    due_date=t.due_date,
-                    scheduled_time=t.scheduled_time,
-                    estimated_duration_minutes=t.estimated_duration_minutes,
-                    linked_goal_id=t.linked_goal_id,
-                    subtasks=json.loads(t.subtasks) if t.subtasks else [],
-                    location=t.location,
-                    tags=json.loads(t.tags) if t.tags else [],
-                    created_at=t.created_at,
-                    completed_at=t.completed_at,
-                    reminder_sent=t.reminder_sent
-                ) for t in tasks
-            ],
-            overdue_count=overdue,
-            today_count=today
+        total, last_id, sync_seq, last_update, overdue, today = result.one()
+        etag_source = json.dumps(
+            [status, category, limit, cursor, selected, total, last_id, sync_seq, str(last_update), overdue, today],
+            default=str,
+        )
+        etag = f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()}"'
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in {tag.strip() for tag in if_none_match.split(",")}:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        stmt = select(UserTask.id, UserTask.due_date, *[_TASK_LIST_FIELDS[name] for name in selected]).where(*filters)
+        if after is not None:
+            after_due, after_id = after
+            # MySQL و SQLite در ترتیب صعودی NULLها را اول می‌گذارند
+            if after_due is None:
+                stmt = stmt.where(or_(
+                    and_(UserTask.due_date.is_(None), UserTask.id > after_id),
+                    UserTask.due_date.is_not(None),
+                ))
+            else:
+                stmt = stmt.where(or_(
+                    UserTask.due_date > after_due,
+                    and_(UserTask.due_date == after_due, UserTask.id > after_id),
+                ))
+        stmt = stmt.order_by(UserTask.due_date.asc(), UserTask.id.asc())
+        result = await session.execute(stmt.limit(limit + 1) if limit is not None else stmt)
+        rows = result.all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_task_cursor(rows[-1][1], rows[-1][0])
+    tasks = [
+        {name: _task_list_value(name, value) for name, value in zip(selected, row[2:])}
+        for row in rows
+    ]
+    return JSONResponse(
+        content={
+            "total": total,
+            "tasks": tasks,
+            "overdue_count": int(overdue or 0),
+            "today_count": int(today or 0),
+            "next_cursor": next_cursor,
+        },
+        headers={"ETag": etag},
+    )
+
+@app.get("/tasks/calendar", response_model=TaskCalendarResponse)
+async def task_calendar(
+    start: str,
+    end: str,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Tasks in [start, end) for calendar views: real tasks from the due_date index plus
+    recurring occurrences beyond the materialized horizon, expanded only for this range.
+    """
+    try:
+        range_start = _naive_utc(datetime.fromisoformat(start))
+        range_end = _naive_utc(datetime.fromisoformat(end))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end باید تاریخ ISO باشند.")
+    if range_end <= range_start or range_end - range_start > timedelta(days=CALENDAR_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"بازهٔ تقویم باید بین ۱ و {CALENDAR_MAX_DAYS} روز باشد.")
+
+    async with async_session() as session:
+        result = await session.execute(
+            select(UserTask, TaskOccurrence.recurrence_id)
+            .outerjoin(TaskOccurrence, TaskOccurrence.task_id == UserTask.id)
+            .where(
+                UserTask.user_id == current_user.id,
+                UserTask.due_date >= range_start,
+                UserTask.due_date < range_end,
+            )
+        )
+        concrete = result.all()
+        result = await session.execute(
+            select(TaskRecurrence, UserTask)
+            .join(UserTask, UserTask.id == TaskRecurrence.task_id)
+            .where(
+                TaskRecurrence.user_id == current_user.id,
+                or_(TaskRecurrence.end_date.is_(None), TaskRecurrence.end_date >= range_start),
+            )
+        )
+        series = result.all()
+        known: set = set()
+        if series:
+            result = await session.execute(
+                select(TaskOccurrence.recurrence_id, TaskOccurrence.occurrence_at).where(
+                    TaskOccurrence.recurrence_id.in_([recurrence.id for recurrence, _ in series]),
+                    TaskOccurrence.occurrence_at >= range_start,
+                    TaskOccurrence.occurrence_at < range_end,
+                )
+            )
+            known = set(result.all())
+
+    series_ids = {recurrence.id: master.task_id for recurrence, master in series}
+    items = [
+        TaskCalendarItem(
+            task_id=task.task_id,
+            title=task.title,
+            category=task.category,
+            status=task.status,
+            priority=task.priority,
+            due_date=task.due_date,
+            series_id=series_ids.get(recurrence_id),
         )
+        for task, recurrence_id in concrete
+    ]
+    for recurrence, master in series:
+        for occurrence in _recurrence_occurrences(recurrence, master, range_start, range_end):
+            if (recurrence.id, occurrence) in known:
+                continue
+            items.append(TaskCalendarItem(
+                task_id=None,
+                title=master.title,
+                category=master.category,
+                status="pending",
+                priority=master.priority,
+                due_date=occurrence,
+                series_id=master.task_id,
+                virtual=True,
+            ))
+    items.sort(key=lambda item: item.due_date)
+    return TaskCalendarResponse(start=range_start, end=range_end, items=items)
 
 @app.get("/tasks/{task_id}", response_model=TaskResponse)
 async def get_task(task_id: str, current_user: User = Depends(get_current_user)):
@@ -6310,14 +11607,22 @@ async def update_task(
             task.priority = body.priority
         if body.due_date is not None:
             task.due_date = datetime.fromisoformat(body.due_date)
+            task.reminder_sent = False
+        if body.reminder_before_minutes is not None:
+            task.reminder_before_minutes = body.reminder_before_minutes
+            task.reminder_sent = False
         if body.subtasks is not None:
             task.subtasks = json.dumps([s.dict() for s in body.subtasks])
         if body.notes is not None:
             task.notes = body.notes
         
         task.updated_at = datetime.utcnow()
+        if body.due_date is not None or body.reminder_before_minutes is not None or body.status is not None:
+            await _sync_task_reminder(session, task)
         await session.commit()
         await session.refresh(task)
+        if body.status is not None:
+            _GEOFENCE_SERVICE.invalidate(current_user.id)
         
         return TaskResponse(
             task_id=task.task_id,
@@ -6352,6 +11657,38 @@ async def delete_task(task_id: str, current_user: User = Depends(get_current_use
         if not task:
             raise HTTPException(status_code=404, detail="تسک یافت نشد")
         
+        await session.execute(delete(TaskReminder).where(TaskReminder.task_id == task.id))
+        # حذف یک occurrence به‌عنوان استثنا ثبت می‌شود تا دوباره ساخته نشود
+        await session.execute(
+            update(TaskOccurrence)
+            .where(TaskOccurrence.task_id == task.id)
+            .values(task_id=None, status="deleted")
+        )
+        recurrence_ids = (
+            await session.execute(select(TaskRecurrence.id).where(TaskRecurrence.task_id == task.id))
+        ).scalars().all()
+        if recurrence_ids:
+            # حذف سری: occurrenceهای آیندهٔ انجام‌نشده هم حذف می‌شوند، گذشته‌ها تسک مستقل می‌مانند
+            future = (
+                await session.execute(
+                    select(UserTask.id, UserTask.task_id)
+                    .join(TaskOccurrence, TaskOccurrence.task_id == UserTask.id)
+                    .where(
+                        TaskOccurrence.recurrence_id.in_(recurrence_ids),
+                        UserTask.status == "pending",
+                        UserTask.due_date >= datetime.utcnow(),
+                    )
+                )
+            ).all()
+            future_ids = [row_id for row_id, _ in future]
+            await session.execute(delete(TaskOccurrence).where(TaskOccurrence.recurrence_id.in_(recurrence_ids)))
+            if future_ids:
+                await session.execute(delete(TaskReminder).where(TaskReminder.task_id.in_(future_ids)))
+                await session.execute(delete(UserTask).where(UserTask.id.in_(future_ids)))
+                await _record_sync_changes(
+                    session, current_user.id, [("task", public_id, "delete") for _, public_id in future]
+                )
+            await session.execute(delete(TaskRecurrence).where(TaskRecurrence.id.in_(recurrence_ids)))
         await session.delete(task)
         await session.commit()
         
@@ -6374,7 +11711,9 @@ async def complete_task(task_id: str, current_user: User = Depends(get_current_u
         task.status = "completed"
         task.completed_at = datetime.utcnow()
         task.updated_at = datetime.utcnow()
+        await _sync_task_reminder(session, task)
         await session.commit()
+        _GEOFENCE_SERVICE.invalidate(current_user.id)
         
         return {"message": "تسک تکمیل شد", "completed_at": task.completed_at}
 
@@ -6401,6 +11740,12 @@ async def create_recurring_task(
             created_at=now,
             status="pending"
         )
+        # anchor (dtstart) سری؛ ساعتِ همین زمان برای همهٔ occurrenceها استفاده می‌شود
+        task.scheduled_time = (
+            _naive_utc(datetime.fromisoformat(body.start_date)) if body.start_date else now.replace(second=0, microsecond=0)
+        )
+        if body.reminder_before_minutes is not None:
+            task.reminder_before_minutes = body.reminder_before_minutes
         session.add(task)
         await session.flush()
         
@@ -6414,6 +11759,8 @@ async def create_recurring_task(
             end_date=datetime.fromisoformat(body.recurrence.end_date) if body.recurrence.end_date else None,
         )
         session.add(recurrence)
+        await session.flush()
+        await _materialize_recurrence(session, recurrence, task, now)
         await session.commit()
         await session.refresh(task)
         
@@ -6436,6 +11783,771 @@ async def create_recurring_task(
             reminder_sent=task.reminder_sent
         )
 
+# ═══════════════════════════════════════════════════════════════════
+# GEOFENCE EVALUATION
+# ═══════════════════════════════════════════════════════════════════
+GEOFENCE_CELL_DEG = float(os.getenv("GEOFENCE_CELL_DEG", "0.01"))  # ~1.1km grid buckets
+GEOFENCE_MAX_CELLS_PER_FENCE = int(os.getenv("GEOFENCE_MAX_CELLS_PER_FENCE", "64"))
+GEOFENCE_EXIT_MARGIN_M = float(os.getenv("GEOFENCE_EXIT_MARGIN_M", "25"))
+GEOFENCE_CONFIRM_PINGS = int(os.getenv("GEOFENCE_CONFIRM_PINGS", "2"))
+GEOFENCE_MAX_ACCURACY_M = float(os.getenv("GEOFENCE_MAX_ACCURACY_M", "200"))
+GEOFENCE_INDEX_TTL = float(os.getenv("GEOFENCE_INDEX_TTL", "300"))
+GEOFENCE_INDEX_CACHE_SIZE = int(os.getenv("GEOFENCE_INDEX_CACHE_SIZE", "10000"))
+GEOFENCE_VECTOR_MIN = int(os.getenv("GEOFENCE_VECTOR_MIN", "16"))
+GEOFENCE_BATCH_MAX = int(os.getenv("GEOFENCE_BATCH_MAX", "500"))
+_EARTH_RADIUS_M = 6371008.8
+_METERS_PER_DEG_LAT = 111320.0
+_GEOFENCE_NOTIFY_ACTIONS = {"remind", "notify"}
+
+
+def _geo_cell(latitude: float, longitude: float) -> Tuple[int, int]:
+    return math.floor(latitude / GEOFENCE_CELL_DEG), math.floor(longitude / GEOFENCE_CELL_DEG)
+
+
+class _GeoBucket:
+    """Fenceهای یک سلول شبکه؛ مختصات از قبل به رادیان و cos(lat) تبدیل شده‌اند."""
+
+    __slots__ = ("members", "lat", "lon", "cos_lat", "arrays")
+
+    def __init__(self, members: List[int], fences: List[Dict[str, Any]]):
+        self.members = members
+        self.lat = [fences[idx]["lat_rad"] for idx in members]
+        self.lon = [fences[idx]["lon_rad"] for idx in members]
+        self.cos_lat = [math.cos(value) for value in self.lat]
+        self.arrays = (
+            (np.array(self.lat), np.array(self.lon), np.array(self.cos_lat)) if np is not None else None
+        )
+
+    def distances(self, points: List[Tuple[float, float]]) -> List[List[float]]:
+        """Haversine distance (m) of every point to every fence: rows = points."""
+        if self.arrays is not None and len(points) * len(self.members) >= GEOFENCE_VECTOR_MIN:
+            lat, lon, cos_lat = self.arrays
+            plat = np.radians(np.array([point[0] for point in points]))[:, None]
+            plon = np.radians(np.array([point[1] for point in points]))[:, None]
+            a = np.sin((lat - plat) / 2) ** 2 + np.cos(plat) * cos_lat * np.sin((lon - plon) / 2) ** 2
+            return (2 * _EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))).tolist()
+        rows = []
+        for latitude, longitude in points:
+            plat, plon = math.radians(latitude), math.radians(longitude)
+            pcos = math.cos(plat)
+            row = []
+            for flat, flon, fcos in zip(self.lat, self.lon, self.cos_lat):
+                a = math.sin((flat - plat) / 2) ** 2 + pcos * fcos * math.sin((flon - plon) / 2) ** 2
+                row.append(2 * _EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0))))
+            rows.append(row)
+        return rows
+
+
+class _GeoFenceIndex:
+    """
+    Spatial index + entry/exit state for one user's active fences.
+
+    Each fence is registered in every grid cell its (radius + exit margin) box touches, so a
+    ping only measures the fences of its own cell; a fence missing from that cell is outside
+    by construction. Fences too large for GEOFENCE_MAX_CELLS_PER_FENCE cells are always checked.
+    """
+
+    def __init__(self, fences: List[Dict[str, Any]], inside: set, built_at: float):
+        self.fences = fences
+        self.built_at = built_at
+        self.inside = inside  # fence indexes
+        self.pending: Dict[int, int] = {}  # fence index -> consecutive pings disagreeing with state
+        self.last_seen: Optional[datetime] = None
+        buckets: Dict[Tuple[int, int], List[int]] = {}
+        wide: List[int] = []
+        for idx, fence in enumerate(fences):
+            fence["lat_rad"] = math.radians(fence["latitude"])
+            fence["lon_rad"] = math.radians(fence["longitude"])
+            reach = fence["radius"] + GEOFENCE_EXIT_MARGIN_M
+            dlat = reach / _METERS_PER_DEG_LAT
+            dlon = reach / (_METERS_PER_DEG_LAT * max(0.01, math.cos(fence["lat_rad"])))
+            lat0, lon0 = _geo_cell(fence["latitude"] - dlat, fence["longitude"] - dlon)
+            lat1, lon1 = _geo_cell(fence["latitude"] + dlat, fence["longitude"] + dlon)
+            if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > GEOFENCE_MAX_CELLS_PER_FENCE:
+                wide.append(idx)
+                continue
+            for cell_lat in range(lat0, lat1 + 1):
+                for cell_lon in range(lon0, lon1 + 1):
+                    buckets.setdefault((cell_lat, cell_lon), []).append(idx)
+        self.cells = {cell: _GeoBucket(members, fences) for cell, members in buckets.items()}
+        self.wide = _GeoBucket(wide, fences) if wide else None
+
+    def distances(self, points: List[Tuple[float, float]]) -> List[Dict[int, float]]:
+        """Candidate fence distances per point; points sharing a cell are measured in one pass."""
+        result: List[Dict[int, float]] = [{} for _ in points]
+        by_cell: Dict[Tuple[int, int], List[int]] = {}
+        for position, (latitude, longitude) in enumerate(points):
+            by_cell.setdefault(_geo_cell(latitude, longitude), []).append(position)
+        groups = [(self.cells.get(cell), positions) for cell, positions in by_cell.items()]
+        if self.wide is not None:
+            groups.append((self.wide, list(range(len(points)))))
+        for bucket, positions in groups:
+            if bucket is None:
+                continue
+            rows = bucket.distances([points[position] for position in positions])
+            for position, row in zip(positions, rows):
+                result[position].update(zip(bucket.members, row))
+        return result
+
+    def step(self, distances: Dict[int, float]) -> List[Tuple[int, str]]:
+        """
+        Advance the entry/exit state by one ping. A transition needs GEOFENCE_CONFIRM_PINGS
+        consecutive agreeing pings, and exit uses radius + margin (hysteresis) so GPS jitter
+        at the boundary does not flap.
+        """
+        transitions: List[Tuple[int, str]] = []
+        for idx in set(distances) | self.inside | set(self.pending):
+            distance = distances.get(idx, math.inf)
+            radius = self.fences[idx]["radius"]
+            was_inside = idx in self.inside
+            now_inside = distance <= radius + GEOFENCE_EXIT_MARGIN_M if was_inside else distance <= radius
+            if now_inside == was_inside:
+                self.pending.pop(idx, None)
+                continue
+            count = self.pending.get(idx, 0) + 1
+            if count < GEOFENCE_CONFIRM_PINGS:
+                self.pending[idx] = count
+                continue
+            self.pending.pop(idx, None)
+            if now_inside:
+                self.inside.add(idx)
+                transitions.append((idx, "entry"))
+            else:
+                self.inside.discard(idx)
+                transitions.append((idx, "exit"))
+        return transitions
+
+
+_GEOFENCE_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _geofence_lock(user_id: int) -> asyncio.Lock:
+    lock = _GEOFENCE_LOCKS.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _GEOFENCE_LOCKS[user_id] = lock
+    return lock
+
+
+class _GeoFenceService:
+    """
+    Evaluates location pings against cached per-user fence indexes and only writes a
+    LocationCheckIn when a debounced entry/exit happens. The index is rebuilt after
+    GEOFENCE_INDEX_TTL or invalidate(); the last written check-in per fence seeds its state
+    and, at write time, drops transitions another worker already recorded.
+    """
+
+    def __init__(self) -> None:
+        self._indexes: "OrderedDict[int, _GeoFenceIndex]" = OrderedDict()
+
+    def invalidate(self, user_id: int) -> None:
+        self._indexes.pop(user_id, None)
+
+    async def _load(self, user_id: int) -> _GeoFenceIndex:
+        async with async_session() as session:
+            result = await session.execute(
+                select(GeoFence, UserTask.task_id, UserTask.title)
+                .join(UserTask, UserTask.id == GeoFence.task_id)
+                .where(
+                    GeoFence.user_id == user_id,
+                    GeoFence.is_active.is_(True),
+                    UserTask.status.in_(_ACTIVE_TASK_STATUSES),
+                )
+            )
+            rows = result.all()
+            last_ids = (
+                select(func.max(LocationCheckIn.id))
+                .where(LocationCheckIn.user_id == user_id)
+                .group_by(LocationCheckIn.geofence_id)
+            )
+            result = await session.execute(
+                select(LocationCheckIn.geofence_id, LocationCheckIn.action).where(LocationCheckIn.id.in_(last_ids))
+            )
+            last_action = dict(result.all())
+        fences = [
+            {
+                "id": fence.id,
+                "geofence_id": fence.geofence_id,
+                "name": fence.name,
+                "task_id": task_id,
+                "task_title": task_title,
+                "latitude": fence.latitude,
+                "longitude": fence.longitude,
+                "radius": float(fence.radius_meters or 100),
+                "entry_action": fence.entry_action,
+                "exit_action": fence.exit_action,
+            }
+            for fence, task_id, task_title in rows
+        ]
+        inside = {idx for idx, fence in enumerate(fences) if last_action.get(fence["id"]) == "entry"}
+        return _GeoFenceIndex(fences, inside, time.monotonic())
+
+    async def _index(self, user_id: int) -> _GeoFenceIndex:
+        index = self._indexes.get(user_id)
+        if index is not None and time.monotonic() - index.built_at < GEOFENCE_INDEX_TTL:
+            self._indexes.move_to_end(user_id)
+            return index
+        fresh = await self._load(user_id)
+        if index is not None:
+            fresh.last_seen = index.last_seen
+        self._indexes[user_id] = fresh
+        self._indexes.move_to_end(user_id)
+        while len(self._indexes) > GEOFENCE_INDEX_CACHE_SIZE:
+            self._indexes.popitem(last=False)
+        return fresh
+
+    async def evaluate(self, user_id: int, pings: List[LocationPing]) -> LocationCheckInResponse:
+        now = datetime.utcnow()
+        timed: List[Tuple[datetime, LocationPing]] = []
+        for ping in pings:
+            if ping.accuracy_meters is not None and ping.accuracy_meters > GEOFENCE_MAX_ACCURACY_M:
+                continue
+            try:
+                recorded_at = _naive_utc(datetime.fromisoformat(ping.recorded_at)) if ping.recorded_at else now
+            except ValueError:
+                continue
+            timed.append((min(recorded_at, now), ping))
+        timed.sort(key=lambda item: item[0])
+
+        async with _geofence_lock(user_id):
+            index = await self._index(user_id)
+            if index.last_seen is not None:
+                # pingهای بافرشدهٔ قدیمی‌تر از آخرین ping پردازش‌شده state را خراب می‌کنند
+                timed = [item for item in timed if item[0] >= index.last_seen]
+            events: List[Tuple[int, str, datetime, LocationPing]] = []
+            if timed and index.fences:
+                rows = index.distances([(ping.latitude, ping.longitude) for _, ping in timed])
+                for (recorded_at, ping), distances in zip(timed, rows):
+                    for idx, action in index.step(distances):
+                        events.append((idx, action, recorded_at, ping))
+            if timed:
+                index.last_seen = timed[-1][0]
+            checkins: List[LocationCheckIn] = []
+            if events:
+                try:
+                    events, checkins = await self._record(user_id, index, events)
+                except Exception:
+                    # state حافظه از DB جلو افتاده است؛ دفعهٔ بعد از روی check-inها بازسازی شود
+                    self.invalidate(user_id)
+                    raise
+            inside = [index.fences[idx]["geofence_id"] for idx in sorted(index.inside)]
+
+        M_GEOFENCE_PINGS.inc("evaluated", amount=len(timed))
+        M_GEOFENCE_PINGS.inc("ignored", amount=len(pings) - len(timed))
+        response_events = []
+        for (idx, action, recorded_at, ping), checkin in zip(events, checkins):
+            fence = index.fences[idx]
+            M_GEOFENCE_TRANSITIONS.inc(action)
+            fence_action = fence["entry_action"] if action == "entry" else fence["exit_action"]
+            if fence_action in _GEOFENCE_NOTIFY_ACTIONS:
+                asyncio.create_task(self._notify(user_id, checkin.id, fence, action))
+            response_events.append(GeoFenceEvent(
+                geofence_id=fence["geofence_id"],
+                name=fence["name"],
+                task_id=fence["task_id"],
+                action=action,
+                latitude=ping.latitude,
+                longitude=ping.longitude,
+                recorded_at=recorded_at,
+            ))
+        return LocationCheckInResponse(
+            processed=len(timed),
+            ignored=len(pings) - len(timed),
+            events=response_events,
+            inside=inside,
+        )
+
+    async def _record(
+        self,
+        user_id: int,
+        index: _GeoFenceIndex,
+        events: List[Tuple[int, str, datetime, LocationPing]],
+    ) -> Tuple[List[Tuple[int, str, datetime, LocationPing]], List[LocationCheckIn]]:
+        """
+        Insert the transitions that are not already stored. State lives per process, so pings
+        of one user handled by different workers can confirm the same transition; the fence
+        rows are locked and each event is checked against the fence's latest stored action.
+        """
+        fence_ids = sorted({index.fences[idx]["id"] for idx, _, _, _ in events})
+        async with async_session() as session:
+            await session.execute(select(GeoFence.id).where(GeoFence.id.in_(fence_ids)).with_for_update())
+            last_ids = (
+                select(func.max(LocationCheckIn.id))
+                .where(LocationCheckIn.geofence_id.in_(fence_ids))
+                .group_by(LocationCheckIn.geofence_id)
+            )
+            result = await session.execute(
+                select(LocationCheckIn.geofence_id, LocationCheckIn.action).where(LocationCheckIn.id.in_(last_ids))
+            )
+            last_action = dict(result.all())
+            kept: List[Tuple[int, str, datetime, LocationPing]] = []
+            checkins: List[LocationCheckIn] = []
+            for item in events:
+                idx, action, recorded_at, ping = item
+                fence_id = index.fences[idx]["id"]
+                if last_action.get(fence_id) == action:
+                    # worker دیگری همین ورود/خروج را ثبت کرده است
+                    M_GEOFENCE_PINGS.inc("duplicate")
+                    continue
+                last_action[fence_id] = action
+                kept.append(item)
+                checkins.append(LocationCheckIn(
+                    user_id=user_id,
+                    geofence_id=fence_id,
+                    latitude=ping.latitude,
+                    longitude=ping.longitude,
+                    action=action,
+                    created_at=recorded_at,
+                ))
+            session.add_all(checkins)
+            await session.commit()
+        return kept, checkins
+
+    async def _notify(self, user_id: int, checkin_id: int, fence: Dict[str, Any], action: str) -> None:
+        verb = "رسیدید به" if action == "entry" else "خارج شدید از"
+        try:
+            sent = await _send_push_notification(
+                user_id, "یادآوری مکانی", f"{verb} «{fence['name']}»: {fence['task_title']}"
+            )
+        except HTTPException:
+            # FCM پیکربندی نشده است
+            sent = False
+        except Exception as exc:  # noqa: BLE001
+            log.warning("Geofence %s push failed: %s", fence["geofence_id"], exc)
+            sent = False
+        if not sent:
+            return
+        async with async_session() as session:
+            await session.execute(
+                update(LocationCheckIn)
+                .where(LocationCheckIn.id == checkin_id)
+                .values(reminder_sent=True, reminder_sent_at=datetime.utcnow())
+            )
+            await session.commit()
+
+
+_GEOFENCE_SERVICE = _GeoFenceService()
+
+
+@app.post("/location/checkin", response_model=LocationCheckInResponse)
+async def location_checkin(body: LocationPing, current_user: User = Depends(get_current_user)):
+    """Evaluate one location ping against the user's active geofences."""
+    return await _GEOFENCE_SERVICE.evaluate(current_user.id, [body])
+
+
+@app.post("/location/checkin/batch", response_model=LocationCheckInResponse)
+async def location_checkin_batch(
+    body: LocationCheckInBatchRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Evaluate pings buffered on the device, in recorded_at order, in a single pass."""
+    if not body.pings:
+        raise HTTPException(status_code=400, detail="لیست موقعیت‌ها خالی است.")
+    if len(body.pings) > GEOFENCE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"حداکثر {GEOFENCE_BATCH_MAX} موقعیت در هر درخواست مجاز است.")
+    return await _GEOFENCE_SERVICE.evaluate(current_user.id, body.pings)
+
+# ═══════════════════════════════════════════════════════════════════
+# DELTA SYNC
+# ═══════════════════════════════════════════════════════════════════
+SYNC_PAGE_DEFAULT = int(os.getenv("SYNC_PAGE_DEFAULT", "500"))
+SYNC_PAGE_MAX = int(os.getenv("SYNC_PAGE_MAX", "2000"))
+# entity -> (model, public id column, response key)
+_SYNC_ENTITIES: Dict[str, Tuple[Any, str, str]] = {
+    "task": (UserTask, "task_id", "tasks"),
+    "habit": (Habit, "habit_id", "habits"),
+    "goal": (UserGoal, "goal_id", "goals"),
+    "mood": (MoodSnapshot, "snapshot_id", "moods"),
+}
+_SYNC_ENTITY_BY_MODEL = {model: entity for entity, (model, _, _) in _SYNC_ENTITIES.items()}
+# جزو sync نیستند ولی در snapshot کاربر هستند؛ نوشتن روی آن‌ها فقط نسخه (seq) را بالا می‌برد
+_CONTEXT_ONLY_MODELS = (UserProfile, HabitLog, HabitStats)
+
+
+def _bump_sync_counter(connection: Any, user_id: int, amount: int) -> int:
+    """Advance the user's seq (also the user-context version) and return the new value."""
+    counters = SyncCounter.__table__
+    if connection.dialect.name == "mysql":
+        # اولین نوشتنِ هم‌زمانِ دو تراکنش هر دو INSERT نمی‌کنند؛ دومی روی همان ردیف قفل می‌ماند
+        stmt = mysql_insert(counters).values(user_id=user_id, seq=amount, seeded=False)
+        connection.execute(stmt.on_duplicate_key_update(seq=counters.c.seq + amount))
+    else:
+        bumped = connection.execute(
+            counters.update().where(counters.c.user_id == user_id).values(seq=counters.c.seq + amount)
+        )
+        if bumped.rowcount == 0:
+            connection.execute(counters.insert().values(user_id=user_id, seq=amount, seeded=False))
+    return connection.execute(select(counters.c.seq).where(counters.c.user_id == user_id)).scalar_one()
+
+
+def _bump_context_seq(session: SyncSession, user_id: int) -> None:
+    """Seq bump for context-only writes, once per transaction; takes the counter row lock."""
+    bumped = session.info.setdefault("context_seq_bumped", set())
+    if user_id in bumped:
+        return
+    _bump_sync_counter(session.connection(), user_id, 1)
+    bumped.add(user_id)
+
+
+def _write_sync_changes(connection: Any, user_id: int, changes: List[Tuple[str, str, str]]) -> None:
+    """
+    Record (entity, entity_id, op) changes in the caller's transaction. The counter UPDATE
+    takes the user's row lock first, so concurrent writers of one user commit in seq order
+    and a client cursor never skips a change that commits late.
+    """
+    latest: Dict[Tuple[str, str], str] = {}
+    for entity, entity_id, op in changes:
+        latest[(entity, entity_id)] = op
+    if not latest:
+        return
+    log_table = SyncChange.__table__
+    last = _bump_sync_counter(connection, user_id, len(latest))
+    now = datetime.utcnow()
+    for seq, ((entity, entity_id), op) in enumerate(latest.items(), start=last - len(latest) + 1):
+        updated = connection.execute(
+            log_table.update()
+            .where(
+                log_table.c.user_id == user_id,
+                log_table.c.entity == entity,
+                log_table.c.entity_id == entity_id,
+            )
+            .values(seq=seq, op=op, changed_at=now)
+        )
+        if updated.rowcount == 0:
+            connection.execute(log_table.insert().values(
+                user_id=user_id, seq=seq, entity=entity, entity_id=entity_id, op=op, changed_at=now
+            ))
+
+
+@event.listens_for(SyncSession, "after_flush")
+def _sync_after_flush(session, flush_context):
+    """
+    Every ORM write to a synced entity lands in sync_changes in the same transaction;
+    writes to context-only models just bump the user's seq.
+    """
+    by_user: Dict[int, List[Tuple[str, str, str]]] = {}
+    touched: set = set()
+    for objects, op in ((session.new, "upsert"), (session.dirty, "upsert"), (session.deleted, "delete")):
+        for obj in objects:
+            if op == "upsert" and obj in session.dirty and not session.is_modified(obj):
+                continue
+            if isinstance(obj, _CONTEXT_ONLY_MODELS):
+                if obj.user_id is not None:
+                    touched.add(obj.user_id)
+                continue
+            entity = _SYNC_ENTITY_BY_MODEL.get(type(obj))
+            if entity is None:
+                continue
+            entity_id = getattr(obj, _SYNC_ENTITIES[entity][1], None)
+            if entity_id and obj.user_id is not None:
+                by_user.setdefault(obj.user_id, []).append((entity, entity_id, op))
+    touched.difference_update(by_user)
+    if by_user or touched:
+        connection = session.connection()
+        for user_id, changes in by_user.items():
+            _write_sync_changes(connection, user_id, changes)
+        for user_id in touched:
+            _bump_context_seq(session, user_id)
+
+
+@event.listens_for(SyncSession, "after_transaction_end")
+def _sync_transaction_end(session, transaction):
+    # بعد از commit/rollback (و savepoint) دوباره bump لازم است؛ bump اضافه بی‌ضرر است
+    session.info.pop("context_seq_bumped", None)
+
+
+async def _record_sync_changes(session: AsyncSession, user_id: int, changes: List[Tuple[str, str, str]]) -> None:
+    """For bulk update()/delete() statements that bypass the ORM flush."""
+    if changes:
+        await session.run_sync(lambda sync_session: _write_sync_changes(sync_session.connection(), user_id, changes))
+
+
+def _sync_payload(entity: str, obj: Any) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {}
+    for attr in sa_inspect(obj).mapper.column_attrs:
+        if attr.key in ("id", "user_id"):
+            continue
+        value = getattr(obj, attr.key)
+        if entity == "task" and attr.key in ("subtasks", "tags"):
+            value = _json_list(value)
+        elif isinstance(value, (datetime, date)):
+            value = value.isoformat()
+        payload[attr.key] = value
+    return payload
+
+
+async def _seed_sync_log(user_id: int) -> None:
+    """First sync of a user: entities written before the change log existed get an upsert row."""
+    async with async_session() as session:
+        seeded = (
+            await session.execute(select(SyncCounter.seeded).where(SyncCounter.user_id == user_id))
+        ).scalar_one_or_none()
+        if seeded:
+            return
+        changes: List[Tuple[str, str, str]] = []
+        for entity, (model, id_column, _) in _SYNC_ENTITIES.items():
+            column = getattr(model, id_column)
+            logged = select(SyncChange.entity_id).where(SyncChange.user_id == user_id, SyncChange.entity == entity)
+            result = await session.execute(
+                select(column).where(model.user_id == user_id, column.not_in(logged)).order_by(model.id)
+            )
+            changes.extend((entity, entity_id, "upsert") for entity_id in result.scalars().all())
+        await _record_sync_changes(session, user_id, changes)
+        await session.execute(update(SyncCounter).where(SyncCounter.user_id == user_id).values(seeded=True))
+        if not changes and seeded is None:
+            session.add(SyncCounter(user_id=user_id, seq=0, seeded=True))
+        try:
+            await session.commit()
+        except IntegrityError:
+            # sync هم‌زمانِ دیگری seed را انجام داده است
+            await session.rollback()
+
+
+@app.get("/sync")
+async def delta_sync(
+    cursor: int = Query(0, ge=0),
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Tasks, habits, goals and mood snapshots changed since `cursor` (0 = everything).
+
+    Each entity appears once with its latest state, deletions come back as ids under
+    `deleted`, and empty groups are omitted. Keep calling with the returned cursor while
+    has_more is true.
+    """
+    if cursor == 0:
+        await _seed_sync_log(current_user.id)
+    async with async_session() as session:
+        result = await session.execute(
+            select(SyncChange.seq, SyncChange.entity, SyncChange.entity_id, SyncChange.op)
+            .where(SyncChange.user_id == current_user.id, SyncChange.seq > cursor)
+            .order_by(SyncChange.seq.asc())
+            .limit(limit + 1)
+        )
+        rows = result.all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        wanted: Dict[str, List[str]] = {}
+        deleted: Dict[str, List[str]] = {}
+        for _, entity, entity_id, op in rows:
+            if entity not in _SYNC_ENTITIES:
+                continue
+            target = wanted if op == "upsert" else deleted
+            target.setdefault(entity, []).append(entity_id)
+        changed: Dict[str, List[Dict[str, Any]]] = {}
+        for entity, entity_ids in wanted.items():
+            model, id_column, key = _SYNC_ENTITIES[entity]
+            column = getattr(model, id_column)
+            result = await session.execute(
+                select(model).where(model.user_id == current_user.id, column.in_(entity_ids))
+            )
+            found = {getattr(obj, id_column): obj for obj in result.scalars().all()}
+            if found:
+                changed[key] = [_sync_payload(entity, found[entity_id]) for entity_id in entity_ids if entity_id in found]
+            missing = [entity_id for entity_id in entity_ids if entity_id not in found]
+            if missing:
+                deleted.setdefault(entity, []).extend(missing)
+
+    return {
+        "cursor": rows[-1][0] if rows else cursor,
+        "has_more": has_more,
+        "changed": changed,
+        "deleted": {_SYNC_ENTITIES[entity][2]: entity_ids for entity, entity_ids in deleted.items()},
+    }
+
+# ═══════════════════════════════════════════════════════════════════
+# BULK WRITES (offline replay)
+# ═══════════════════════════════════════════════════════════════════
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "500"))
+
+
+def _bulk_parse_datetime(raw: Optional[str], default: datetime) -> datetime:
+    return _naive_utc(datetime.fromisoformat(raw.replace("Z", "+00:00"))) if raw else default
+
+
+def _bulk_task(user_id: int, item: BulkTaskCreateItem, now: datetime) -> UserTask:
+    if not item.title.strip():
+        raise ValueError("عنوان تسک خالی است.")
+    if not 1 <= item.priority <= 5:
+        raise ValueError("اولویت باید بین ۱ تا ۵ باشد.")
+    task = UserTask(
+        user_id=user_id,
+        task_id=str(uuid.uuid4()),
+        title=item.title,
+        description=item.description,
+        category=item.category,
+        priority=item.priority,
+        due_date=_bulk_parse_datetime(item.due_date, None),
+        estimated_duration_minutes=item.estimated_duration_minutes,
+        linked_goal_id=item.linked_goal_id,
+        location=item.location,
+        subtasks=json.dumps([s.dict() for s in item.subtasks]) if item.subtasks else json.dumps([]),
+        tags=json.dumps(item.tags) if item.tags else json.dumps([]),
+        created_at=now,
+        status="pending",
+        reminder_sent=False,
+    )
+    task.reminder_before_minutes = item.reminder_before_minutes if item.reminder_before_minutes is not None else 30
+    return task
+
+
+def _bulk_habit_log(item: BulkHabitLogItem, habits: Dict[str, Habit], now: datetime) -> Tuple[Habit, date, BulkHabitLogItem]:
+    """Validated (habit, day, item); written through _log_habit_day after the multi-row inserts."""
+    habit = habits.get(item.habit_id)
+    if habit is None:
+        raise LookupError("عادت یافت نشد")
+    if item.count < 1:
+        raise ValueError("تعداد باید حداقل ۱ باشد.")
+    logged = date.fromisoformat(item.logged_date[:10]) if item.logged_date else now.date()
+    return habit, logged, item
+
+
+def _bulk_mood(user_id: int, item: BulkMoodSnapshotItem, now: datetime) -> MoodSnapshot:
+    if not (1 <= item.energy <= 10 and 1 <= item.mood <= 10):
+        raise ValueError("انرژی و حال باید بین ۱ تا ۱۰ باشند.")
+    if not item.context.strip():
+        raise ValueError("context خالی است.")
+    return MoodSnapshot(
+        user_id=user_id,
+        snapshot_id=str(uuid.uuid4()),
+        timestamp=min(_bulk_parse_datetime(item.recorded_at, now), now),
+        energy=item.energy,
+        mood=item.mood,
+        context=item.context,
+        activity=item.activity,
+        notes=item.notes,
+        created_at=now,
+    )
+
+
+async def _apply_bulk_write(user_id: int, body: BulkWriteRequest) -> BulkWriteResponse:
+    """
+    Validate the whole batch, then write every accepted item in one transaction: one flush
+    per table (multi-row INSERT), reminders and idempotency records in the same commit.
+    Items whose idempotency key is already stored are answered from the record instead.
+    """
+    now = datetime.utcnow()
+    groups = (
+        ("tasks", "task", body.tasks),
+        ("habit_logs", "habit_log", body.habit_logs),
+        ("mood_snapshots", "mood", body.mood_snapshots),
+    )
+    keys = {item.idempotency_key for _, _, items in groups for item in items if item.idempotency_key}
+    results: Dict[str, List[Optional[BulkItemResult]]] = {name: [None] * len(items) for name, _, items in groups}
+    async with async_session() as session:
+        stored: Dict[str, IdempotencyRecord] = {}
+        if keys:
+            result = await session.execute(
+                select(IdempotencyRecord).where(IdempotencyRecord.user_id == user_id, IdempotencyRecord.key.in_(keys))
+            )
+            stored = {record.key: record for record in result.scalars().all()}
+        habit_ids = {item.habit_id for item in body.habit_logs}
+        habits: Dict[str, Habit] = {}
+        if habit_ids:
+            result = await session.execute(
+                select(Habit).where(Habit.user_id == user_id, Habit.habit_id.in_(habit_ids))
+            )
+            habits = {habit.habit_id: habit for habit in result.scalars().all()}
+
+        # (group, index, key, scope, row)
+        accepted: List[Tuple[str, int, Optional[str], str, Any]] = []
+        first_in_batch: Dict[str, Tuple[str, str, int]] = {}
+        duplicates: List[Tuple[str, int, str, str]] = []
+        for name, scope, items in groups:
+            for index, item in enumerate(items):
+                key = item.idempotency_key
+                if key and key in stored:
+                    record = stored[key]
+                    results[name][index] = (
+                        BulkItemResult(index=index, status=200, id=record.resource_id, replayed=True)
+                        if record.scope == scope
+                        else BulkItemResult(index=index, status=409, error="کلید idempotency برای عملیات دیگری استفاده شده است.")
+                    )
+                    continue
+                if key and key in first_in_batch:
+                    duplicates.append((name, index, key, scope))
+                    continue
+                try:
+                    if scope == "task":
+                        row = _bulk_task(user_id, item, now)
+                    elif scope == "habit_log":
+                        row = _bulk_habit_log(item, habits, now)
+                    else:
+                        row = _bulk_mood(user_id, item, now)
+                except LookupError as exc:
+                    results[name][index] = BulkItemResult(index=index, status=404, error=str(exc))
+                    continue
+                except ValueError as exc:
+                    results[name][index] = BulkItemResult(index=index, status=400, error=str(exc))
+                    continue
+                if key:
+                    first_in_batch[key] = (scope, name, index)
+                accepted.append((name, index, key, scope, row))
+
+        if accepted:
+            session.add_all([row for _, _, _, scope, row in accepted if scope != "habit_log"])
+            await session.flush()
+            for position, (name, index, key, scope, row) in enumerate(accepted):
+                if scope == "habit_log":
+                    habit, day, item = row
+                    entry = await _log_habit_day(session, habit, day, item.count, item.notes)
+                    accepted[position] = (name, index, key, scope, entry)
+            reminders = [
+                reminder
+                for _, _, _, scope, row in accepted
+                if scope == "task" and (reminder := _task_reminder_row(row, now)) is not None
+            ]
+            session.add_all(reminders)
+            records = []
+            for name, index, key, scope, row in accepted:
+                resource_id = row.task_id if scope == "task" else row.snapshot_id if scope == "mood" else str(row.id)
+                results[name][index] = BulkItemResult(index=index, status=201, id=resource_id)
+                if key:
+                    records.append(IdempotencyRecord(user_id=user_id, key=key, scope=scope, resource_id=resource_id, created_at=now))
+            session.add_all(records)
+            moods = [row for _, _, _, scope, row in accepted if scope == "mood"]
+            if moods:
+                await _add_mood_aggregates(session, user_id, moods)
+                latest = max(moods, key=lambda snapshot: snapshot.timestamp)
+                await session.execute(
+                    update(UserProfile)
+                    .where(UserProfile.user_id == user_id)
+                    .values(avg_energy=latest.energy, avg_mood=latest.mood, last_mood_update=now, updated_at=now)
+                )
+            await session.commit()
+            for reminder in reminders:
+                _REMINDER_ENGINE.notify(reminder.scheduled_at)
+
+    for name, index, key, scope in duplicates:
+        first_scope, first_name, first_index = first_in_batch[key]
+        first = results[first_name][first_index]
+        results[name][index] = (
+            BulkItemResult(index=index, status=200, id=first.id, replayed=True)
+            if first_scope == scope
+            else BulkItemResult(index=index, status=409, error="کلید idempotency برای عملیات دیگری استفاده شده است.")
+        )
+    return BulkWriteResponse(**results)
+
+
+@app.post("/bulk", response_model=BulkWriteResponse)
+async def bulk_write(body: BulkWriteRequest, current_user: User = Depends(get_current_user)):
+    """
+    Replay queued offline writes (task creates, habit logs, mood snapshots) in one request.
+    Results are per item, in request order; send an idempotency_key per item so retries
+    after a dropped response are answered without writing twice.
+    """
+    total = len(body.tasks) + len(body.habit_logs) + len(body.mood_snapshots)
+    if total == 0:
+        raise HTTPException(status_code=400, detail="هیچ عملیاتی ارسال نشده است.")
+    if total > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"حداکثر {BULK_MAX_ITEMS} عملیات در هر درخواست مجاز است.")
+    try:
+        return await _apply_bulk_write(current_user.id, body)
+    except IntegrityError:
+        # درخواست هم‌زمان با همین کلیدها زودتر commit شده است؛ این بار پاسخ از رکوردها می‌آید
+        return await _apply_bulk_write(current_user.id, body)
+
 # ============================================================================
 # Suggested Prompts Endpoint
 # ============================================================================
@@ -6533,9 +12645,42 @@ class NotificationTriageRequest(BaseModel):
 async def classify_notifications(body: NotificationTriageRequest, current_user: User = Depends(get_current_user)):
     """
     دسته‌بندی اعلان‌ها به مهم/فوری/عادی و ایجاد خلاصه
+    (اعلان‌های واضح با رده‌بند محلی، فقط بقیه با LLM)
     """
+    verdicts, ambiguous = _route_triage_notifications(body.notifications, "classify")
+    escalated = set(ambiguous)
+    local_kinds = [verdict[0] for idx, verdict in enumerate(verdicts) if idx not in escalated]
+
+    def _local_item(item: Dict[str, Any], verdict: Tuple[str, float, str]) -> Dict[str, Any]:
+        profile = _LOCAL_NOTIFICATION_PROFILES[verdict[0]]
+        title, text = _notification_dict_text(item)
+        return {
+            "title": title or profile["label"],
+            "category": profile["triage"],
+            "summary": text[:200],
+            "action": profile["action"] or "",
+            "source": "local",
+        }
+
+    def _triage_response(classified: List[Dict[str, Any]], summary: str) -> Dict[str, Any]:
+        critical_count = sum(
+            1 for item in classified
+            if str(item.get("category", "")).lower() in ["critical", "important"]
+        )
+        return {
+            "success": True,
+            "total": len(body.notifications),
+            "critical": critical_count,
+            "classified": classified,
+            "summary": summary,
+        }
+
+    if not ambiguous:
+        classified = _merge_triage_results(body.notifications, verdicts, [], [], _local_item)
+        return _triage_response(classified, _local_triage_summary(local_kinds))
+
     try:
-        notifications_text = json.dumps(body.notifications, ensure_ascii=False)
+        notifications_text = json.dumps([body.notifications[i] for i in ambiguous], ensure_ascii=False)
         
         async with AsyncClient() as client:
             response = await client.create_completion(
@@ -6574,19 +12719,13 @@ async def classify_notifications(body: NotificationTriageRequest, current_user:
                     "summary": result_text
                 }
             
-            # شمارش اعلان‌های مهم
-            critical_count = sum(
-                1 for item in result.get("classified", [])
-                if item.get("category", "").lower() in ["critical", "important"]
+            classified = _merge_triage_results(
+                body.notifications, verdicts, ambiguous, result.get("classified", []), _local_item
             )
-            
-            return {
-                "success": True,
-                "total": len(body.notifications),
-                "critical": critical_count,
-                "classified": result.get("classified", []),
-                "summary": result.get("summary", "")
-            }
+            summary = " ".join(
+                part for part in (_local_triage_summary(local_kinds), str(result.get("summary") or "")) if part
+            )
+            return _triage_response(classified, summary)
     except Exception as e:
         log.error(f"Error classifying notifications: {e}")
         return {
@@ -0,0 +1,243 @@
+# میکروبنچمارک توابع داغ app.py
+# هر تابع روی fixtureهای نمونه (گفتگوی فارسی، HTML صفحهٔ نتایج/مقاله، JSON داخل fence)
+# اندازه‌گیری می‌شود و با baseline ذخیره‌شده مقایسه می‌شود. برای هر تابع یک تست
+# مقیاس‌پذیری هم اجرا می‌شود (ورودی ×4) تا رفتار غیرخطی (مثلاً quadratic) زود دیده شود.
+#
+# اگر فایل‌های HTML واقعی در backend/bench_fixtures/*.html باشند، به‌جای HTML ساختگی
+# استفاده می‌شوند.
+#
+# نمونه:
+#   python bench_helpers.py
+#   python bench_helpers.py --save-baseline
+#   python bench_helpers.py --compare --tolerance 0.25
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BASE_DIR / "bench_helpers_baseline.json"
+FIXTURE_DIR = BASE_DIR / "bench_fixtures"
+# نسبت زمان (ورودی ×4) / (ورودی ×1) بالاتر از این مقدار یعنی رشد بیش از خطی
+SCALING_LIMIT = 8.0
+
+
+# ============================================================================
+# 1. Fixtures
+# ============================================================================
+
+PERSIAN_TURNS = [
+    "سلام، می‌خواستم برای هفتهٔ آینده یک برنامهٔ مطالعه بچینم که با کارم تداخل نداشته باشد.",
+    "حتماً! لطفاً بگویید چند ساعت در روز وقت آزاد دارید و کدام درس‌ها اولویت دارند؟",
+    "روزهای کاری حدود دو ساعت بعد از ساعت ۱۸ و آخر هفته‌ها تقریباً پنج ساعت. ریاضی و زبان انگلیسی مهم‌ترند.",
+    "پیشنهاد من این است: شنبه تا چهارشنبه یک ساعت ریاضی و یک ساعت زبان، پنجشنبه مرور و جمعه آزمون تمرینی.",
+    "عالی است. می‌شود یادآور هم برایش تنظیم کنی و اگر جلسه‌ای پیش آمد برنامه را جابه‌جا کنی؟",
+]
+
+ARTICLE_PARAGRAPH = (
+    "<p>هوش مصنوعی در سال‌های اخیر به بخش جدایی‌ناپذیر زندگی روزمره تبدیل شده است. "
+    "از دستیارهای صوتی گرفته تا سامانه‌های پیشنهاددهنده، این فناوری تصمیم‌های کوچک و بزرگ ما را شکل می‌دهد. "
+    "<a href=\"https://example.com/ai\">بیشتر بخوانید</a> درباره اثرات آن بر بازار کار.</p>\n"
+)
+
+SERP_RESULT = (
+    "<div class=\"g\"><a href=\"https://example.com/result\"><h3>نتیجهٔ جست‌وجو دربارهٔ برنامه‌ریزی روزانه</h3></a>"
+    "<div class=\"VwiC3b\">راهنمای کامل برنامه‌ریزی روزانه برای افزایش بهره‌وری و مدیریت زمان...</div></div>\n"
+)
+
+FENCED_JSON = (
+    "حتماً، خروجی به شکل زیر است:\n```json\n"
+    + json.dumps(
+        {
+            "action": "create_task",
+            "payload": {
+                "title": "جلسه با تیم طراحی",
+                "datetime": "2024-05-04T10:00:00+03:30",
+                "reminders": [15, 60],
+                "notes": "بررسی نسخهٔ جدید اپلیکیشن و جمع‌بندی بازخوردها",
+            },
+        },
+        ensure_ascii=False,
+        indent=2,
+    )
+    + "\n```\nاگر تغییری لازم بود بگویید."
+)
+
+
+def persian_transcript(app_module, turns: int) -> List[Any]:
+    messages = [app_module.Message(role="system", content="تو یک دستیار برنامه‌ریزی شخصی هستی.")]
+    for idx in range(turns):
+        role = "user" if idx % 2 == 0 else "assistant"
+        messages.append(app_module.Message(role=role, content=PERSIAN_TURNS[idx % len(PERSIAN_TURNS)]))
+    return messages
+
+
+def article_html(paragraphs: int) -> str:
+    nav = "<nav>" + "".join(f"<a href='/c/{i}'>دسته {i}</a>" for i in range(30)) + "</nav>"
+    script = "<script>var tracking = {id: 42, events: []};</script><style>.x{color:red}</style>"
+    body = "".join(ARTICLE_PARAGRAPH for _ in range(paragraphs))
+    return (
+        f"<html><head><title>مقاله نمونه</title>{script}</head><body>{nav}"
+        f"<main><article>{body}</article></main><footer>حقوق محفوظ است</footer></body></html>"
+    )
+
+
+def serp_html(results: int) -> str:
+    body = "".join(SERP_RESULT for _ in range(results))
+    return f"<html><head><title>نتایج</title></head><body><div id=\"search\">{body}</div></body></html>"
+
+
+def saved_html_fixtures() -> List[str]:
+    if not FIXTURE_DIR.is_dir():
+        return []
+    return [path.read_text(encoding="utf-8", errors="ignore") for path in sorted(FIXTURE_DIR.glob("*.html"))]
+
+
+class _Obj:
+    def __init__(self, **kwargs: Any):
+        self.__dict__.update(kwargs)
+
+
+# ============================================================================
+# 2. Benchmarks: name -> (setup(scale) -> callable)
+# ============================================================================
+
+def build_benchmarks(app_module) -> Dict[str, Callable[[int], Callable[[], Any]]]:
+    saved = saved_html_fixtures()
+
+    def html_input(scale: int) -> str:
+        if saved:
+            return "".join(saved) * scale
+        return article_html(20 * scale)
+
+    def try_json_loads(scale: int):
+        raw = "\n".join([FENCED_JSON] * scale)
+        return lambda: app_module._try_json_loads(raw)
+
+    def normalize_token_piece(scale: int):
+        pieces = ["سلام", " دنیا", "‌", "!", "  ", "ادامه‌ی متن"] * (50 * scale)
+        return lambda: [app_module._normalize_token_piece(p) for p in pieces]
+
+    def extract_text_piece(scale: int):
+        chunks = [
+            _Obj(choices=[_Obj(delta=_Obj(content="توکن "), message=None)]),
+            _Obj(choices=[_Obj(delta={"content": "بعدی"}, message=None)]),
+            _Obj(choices=[_Obj(delta=None, message={"content": "کامل"})]),
+            _Obj(content="fallback"),
+        ] * (50 * scale)
+        return lambda: [app_module._extract_text_piece(c) for c in chunks]
+
+    def strip_html(scale: int):
+        raw = html_input(scale)
+        return lambda: app_module._strip_html(raw)
+
+    def strip_html_serp(scale: int):
+        raw = serp_html(10 * scale)
+        return lambda: app_module._strip_html(raw)
+
+    def extract_main_body(scale: int):
+        raw = html_input(scale)
+        return lambda: app_module._extract_main_body(raw)
+
+    def trim_messages_to_budget(scale: int):
+        messages = persian_transcript(app_module, 40 * scale)
+        budget = app_module._estimate_tokens_for_messages(messages) // 3
+        return lambda: app_module._trim_messages_to_budget(messages, budget, len(messages))
+
+    def sse_event(scale: int):
+        payloads = [json.dumps({"text": PERSIAN_TURNS[i % len(PERSIAN_TURNS)]}, ensure_ascii=False) for i in range(100 * scale)]
+        return lambda: [app_module._sse_event("token", p) for p in payloads]
+
+    return {
+        "_try_json_loads": try_json_loads,
+        "_normalize_token_piece": normalize_token_piece,
+        "_extract_text_piece": extract_text_piece,
+        "_strip_html[article]": strip_html,
+        "_strip_html[serp]": strip_html_serp,
+        "_extract_main_body": extract_main_body,
+        "_trim_messages_to_budget": trim_messages_to_budget,
+        "_sse_event": sse_event,
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    """Best-of-`repeat` seconds per call."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(app_module, repeat: int, only: Optional[List[str]]) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name, factory in build_benchmarks(app_module).items():
+        if only and not any(key in name for key in only):
+            continue
+        base = measure(factory(1), repeat)
+        scaled = measure(factory(4), repeat)
+        results[name] = {
+            "us_per_call": round(base * 1e6, 2),
+            "scaling_x4": round(scaled / base, 2) if base > 0 else 0.0,
+        }
+    return results
+
+
+# ============================================================================
+# 3. گزارش و baseline
+# ============================================================================
+
+def check(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Any]], tolerance: float) -> List[str]:
+    problems: List[str] = []
+    for name, stats in results.items():
+        if stats["scaling_x4"] > SCALING_LIMIT:
+            problems.append(f"{name}: super-linear growth (x4 input -> x{stats['scaling_x4']} time)")
+        previous = (baseline or {}).get("results", {}).get(name)
+        if previous and stats["us_per_call"] > previous["us_per_call"] * (1.0 + tolerance):
+            problems.append(f"{name}: {previous['us_per_call']}us -> {stats['us_per_call']}us")
+    return problems
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Microbenchmarks for app.py hot helpers")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", default="", help="comma separated substrings of benchmark names")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown (0.25 = 25%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    os.environ.setdefault("METRICS_ENABLED", "0")
+    sys.path.insert(0, str(BASE_DIR))
+    import app as app_module  # noqa: WPS433
+
+    only = [item.strip() for item in args.only.split(",") if item.strip()] or None
+    results = run(app_module, args.repeat, only)
+    print("benchmark".ljust(30) + "us/call".rjust(14) + "x4 scaling".rjust(14))
+    for name, stats in results.items():
+        print(name.ljust(30) + f"{stats['us_per_call']:.2f}".rjust(14) + f"{stats['scaling_x4']:.2f}".rjust(14))
+
+    baseline_path = Path(args.baseline)
+    baseline = None
+    if args.compare:
+        if not baseline_path.exists():
+            print(f"baseline not found: {baseline_path}", file=sys.stderr)
+            return 2
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    problems = check(results, baseline, args.tolerance)
+    for line in problems:
+        print(f"REGRESSION {line}")
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps({"results": results}, indent=2), encoding="utf-8")
+        print(f"baseline saved to {baseline_path}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+# بنچمارک بار (load test) آفلاین برای app.py
+# AsyncClient مربوط به g4f با یک provider ساختگی محلی جایگزین می‌شود تا نتایج
+# به providerهای زنده وابسته نباشند. سرور با uvicorn در همین پروسه بالا می‌آید.
+#
+# نمونه:
+#   python bench_load.py --concurrency 16 --requests 200
+#   python bench_load.py --scenarios chat --mock-ttft 0.4 --mock-stall-rate 0.1
+#   python bench_load.py --save-baseline          # ذخیرهٔ نتیجه به‌عنوان baseline
+#   python bench_load.py --compare                 # مقایسه با baseline (exit 1 در صورت regression)
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BASE_DIR / "bench_baseline.json"
+SCENARIOS = ("chat", "assistant", "tasks", "goals")
+
+
+# ============================================================================
+# 1. Mock provider (جایگزین g4f AsyncClient)
+# ============================================================================
+
+class MockProviderConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.ttft = args.mock_ttft
+        self.token_interval = args.mock_token_interval
+        self.tokens = args.mock_tokens
+        self.completion_latency = args.mock_completion_latency
+        self.fail_rate = args.mock_fail_rate
+        self.midstream_fail_rate = args.mock_midstream_fail_rate
+        self.stall_rate = args.mock_stall_rate
+        self.jitter = args.mock_jitter
+        self.rng = random.Random(args.seed)
+
+    def delay(self, base: float) -> float:
+        if base <= 0:
+            return 0.0
+        return max(0.0, base * (1.0 + self.rng.uniform(-self.jitter, self.jitter)))
+
+
+class _Obj:
+    def __init__(self, **kwargs: Any):
+        self.__dict__.update(kwargs)
+
+
+def _chunk(text: str) -> _Obj:
+    return _Obj(choices=[_Obj(delta=_Obj(content=text), message=None)])
+
+
+class _MockStream:
+    def __init__(self, config: MockProviderConfig):
+        self.config = config
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def _generate(self):
+        cfg = self.config
+        if cfg.rng.random() < cfg.stall_rate:
+            # provider که هیچ توکنی نمی‌دهد (برای سنجش hedge/timeout)
+            await asyncio.sleep(3600)
+        await asyncio.sleep(cfg.delay(cfg.ttft))
+        fail_at = cfg.rng.randint(1, max(1, cfg.tokens - 1)) if cfg.rng.random() < cfg.midstream_fail_rate else None
+        for idx in range(cfg.tokens):
+            if fail_at is not None and idx == fail_at:
+                raise RuntimeError("mock provider dropped the stream")
+            yield _chunk(f"token{idx} ")
+            await asyncio.sleep(cfg.delay(cfg.token_interval))
+
+    async def aclose(self) -> None:
+        return None
+
+
+class _MockCompletions:
+    def __init__(self, config: MockProviderConfig):
+        self.config = config
+
+    def stream(self, **kwargs: Any) -> _MockStream:
+        if self.config.rng.random() < self.config.fail_rate:
+            raise RuntimeError("mock provider init failure")
+        return _MockStream(self.config)
+
+    async def create(self, **kwargs: Any) -> _Obj:
+        cfg = self.config
+        await asyncio.sleep(cfg.delay(cfg.completion_latency))
+        if cfg.rng.random() < cfg.fail_rate:
+            raise RuntimeError("mock provider completion failure")
+        content = json.dumps(
+            {
+                "action": "note",
+                "payload": {"title": "mock"},
+                "briefing": "mock briefing",
+                "highlights": [],
+                "next_actions": [],
+                "suggested": {"title": "mock", "reason": "bench", "duration_estimate_min": 15},
+                "alternatives": [],
+            },
+            ensure_ascii=False,
+        )
+        return _Obj(choices=[_Obj(message=_Obj(content=content), delta=None)])
+
+
+def make_mock_client_class(config: MockProviderConfig):
+    class MockAsyncClient:
+        def __init__(self, *args: Any, **kwargs: Any):
+            self.chat = _Obj(completions=_MockCompletions(config))
+
+    return MockAsyncClient
+
+
+# ============================================================================
+# 2. Bootstrapping app.py با provider ساختگی
+# ============================================================================
+
+def load_app(args: argparse.Namespace):
+    workdir = Path(tempfile.mkdtemp(prefix="wqa-bench-"))
+    # همیشه DB موقت؛ DATABASE_URL سرور نباید هدف بنچ شود
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{workdir / 'bench.db'}"
+    # workerهای پس‌زمینه push واقعی می‌فرستند یا ردیف با LLM ساختگی می‌نویسند
+    for flag in ("REMINDER_ENGINE_ENABLED", "SNOOZE_SCHEDULER_ENABLED", "PREGEN_ENABLED"):
+        os.environ[flag] = "0"
+    os.environ.setdefault("AUTH_SECRET", "bench-secret")
+    os.environ.setdefault("TRACE_LOG_ENABLED", "0")
+    sys.path.insert(0, str(BASE_DIR))
+    import app as app_module  # noqa: WPS433
+
+    config = MockProviderConfig(args)
+    app_module.AsyncClient = make_mock_client_class(config)
+    # همهٔ providerهای زنجیره برای mock قابل استفاده‌اند
+    app_module._provider_requirements = lambda provider_name: (True, None, {})
+    return app_module
+
+
+async def prepare_users(app_module, count: int) -> List[str]:
+    async with app_module.engine.begin() as conn:
+        await conn.run_sync(app_module.Base.metadata.create_all)
+    tokens: List[str] = []
+    async with app_module.async_session() as session:
+        users = [app_module.User(phone=f"+98900{idx:07d}") for idx in range(count)]
+        session.add_all(users)
+        await session.commit()
+        for user in users:
+            tokens.append(app_module._issue_jwt(user.id, user.phone))
+    return tokens
+
+
+async def start_server(app_module, port: int):
+    import uvicorn
+
+    # lifespan خاموش است تا worker‌ها و ربات تلگرام در بنچمارک اجرا نشوند
+    config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+# ============================================================================
+# 3. سناریوها
+# ============================================================================
+
+class Sample:
+    __slots__ = ("scenario", "ok", "latency", "ttft", "status")
+
+    def __init__(self, scenario: str, ok: bool, latency: float, ttft: Optional[float] = None, status: int = 0):
+        self.scenario = scenario
+        self.ok = ok
+        self.latency = latency
+        self.ttft = ttft
+        self.status = status
+
+
+async def run_chat(client, headers: Dict[str, str], idx: int) -> Sample:
+    body = {"messages": [{"role": "user", "content": f"سلام، درخواست بنچمارک شماره {idx}"}]}
+    started = time.perf_counter()
+    ttft: Optional[float] = None
+    ok = False
+    async with client.stream("POST", "/chat/stream", json=body, headers=headers) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            return Sample("chat", False, time.perf_counter() - started, status=resp.status_code)
+        event = ""
+        async for line in resp.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:].strip()
+                if event == "token" and ttft is None:
+                    ttft = time.perf_counter() - started
+            elif line.startswith("data:") and event == "done":
+                ok = '"reason"' not in line
+                break
+    return Sample("chat", ok, time.perf_counter() - started, ttft, 200)
+
+
+ASSISTANT_CALLS = (
+    ("/assistant/intent", {"text": "فردا ساعت ۱۰ جلسه با تیم بگذار"}),
+    ("/assistant/daily-briefing", {"tasks": [{"title": "گزارش هفتگی"}], "energy": "normal"}),
+    ("/assistant/next-action", {"available_minutes": 30, "tasks": ["ایمیل‌ها", "گزارش"]}),
+)
+
+
+async def run_assistant(client, headers: Dict[str, str], idx: int) -> Sample:
+    path, body = ASSISTANT_CALLS[idx % len(ASSISTANT_CALLS)]
+    started = time.perf_counter()
+    resp = await client.post(path, json=body, headers=headers)
+    return Sample("assistant", resp.status_code == 200, time.perf_counter() - started, status=resp.status_code)
+
+
+async def run_tasks(client, headers: Dict[str, str], idx: int) -> Sample:
+    started = time.perf_counter()
+    if idx % 2 == 0:
+        resp = await client.post(
+            "/tasks",
+            json={"title": f"تسک بنچمارک {idx}", "category": "Work", "priority": 1 + idx % 5},
+            headers=headers,
+        )
+    else:
+        resp = await client.get("/tasks", headers=headers)
+    return Sample("tasks", resp.status_code == 200, time.perf_counter() - started, status=resp.status_code)
+
+
+async def run_goals(client, headers: Dict[str, str], idx: int) -> Sample:
+    started = time.perf_counter()
+    if idx % 2 == 0:
+        resp = await client.post(
+            "/user/goals",
+            json={
+                "title": f"هدف بنچمارک {idx}",
+                "category": "Learning",
+                "description": "bench",
+                "deadline": "2030-01-01T00:00:00",
+                "priority": 3,
+            },
+            headers=headers,
+        )
+    else:
+        resp = await client.get("/user/goals", headers=headers)
+    return Sample("goals", resp.status_code == 200, time.perf_counter() - started, status=resp.status_code)
+
+
+RUNNERS = {"chat": run_chat, "assistant": run_assistant, "tasks": run_tasks, "goals": run_goals}
+
+
+async def drive(base_url: str, tokens: List[str], scenarios: List[str], requests: int, concurrency: int) -> Dict[str, Any]:
+    import httpx
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for idx in range(requests):
+        queue.put_nowait(idx)
+    samples: List[Sample] = []
+
+    async def worker(worker_id: int) -> None:
+        headers = {"Authorization": f"Bearer {tokens[worker_id % len(tokens)]}"}
+        timeout = httpx.Timeout(120.0, connect=10.0)
+        async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+            while True:
+                try:
+                    idx = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                scenario = scenarios[idx % len(scenarios)]
+                started = time.perf_counter()
+                try:
+                    samples.append(await RUNNERS[scenario](client, headers, idx))
+                except Exception:  # noqa: BLE001
+                    samples.append(Sample(scenario, False, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    wall = time.perf_counter() - started
+    return summarize(samples, wall)
+
+
+# ============================================================================
+# 4. گزارش و baseline
+# ============================================================================
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 1)
+
+
+def summarize(samples: List[Sample], wall: float) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"wall_seconds": round(wall, 3), "scenarios": {}}
+    for scenario in sorted({s.scenario for s in samples}):
+        group = [s for s in samples if s.scenario == scenario]
+        latencies = [s.latency for s in group if s.ok]
+        ttfts = [s.ttft for s in group if s.ok and s.ttft is not None]
+        stats: Dict[str, Any] = {
+            "requests": len(group),
+            "errors": sum(1 for s in group if not s.ok),
+            "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+            "p50_ms": _ms(percentile(latencies, 50)),
+            "p95_ms": _ms(percentile(latencies, 95)),
+            "p99_ms": _ms(percentile(latencies, 99)),
+        }
+        if ttfts:
+            stats.update({
+                "ttft_p50_ms": _ms(percentile(ttfts, 50)),
+                "ttft_p95_ms": _ms(percentile(ttfts, 95)),
+                "ttft_p99_ms": _ms(percentile(ttfts, 99)),
+            })
+        report["scenarios"][scenario] = stats
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    columns = ("requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms")
+    print(f"wall: {report['wall_seconds']}s")
+    print("scenario".ljust(10) + "".join(col.rjust(15) for col in columns))
+    for scenario, stats in report["scenarios"].items():
+        row = scenario.ljust(10)
+        for col in columns:
+            value = stats.get(col)
+            row += ("-" if value is None else str(value)).rjust(15)
+        print(row)
+
+
+# کمتر بهتر است مگر throughput
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms")
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions: List[str] = []
+    for scenario, stats in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not base:
+            continue
+        for key in LOWER_IS_BETTER:
+            current, previous = stats.get(key), base.get(key)
+            if current is None or not previous:
+                continue
+            if current > previous * (1.0 + tolerance):
+                regressions.append(f"{scenario}.{key}: {previous} -> {current}")
+        current, previous = stats.get("throughput_rps"), base.get("throughput_rps")
+        if current is not None and previous and current < previous * (1.0 - tolerance):
+            regressions.append(f"{scenario}.throughput_rps: {previous} -> {current}")
+        if stats.get("errors", 0) > base.get("errors", 0):
+            regressions.append(f"{scenario}.errors: {base.get('errors', 0)} -> {stats['errors']}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load benchmark with a mock g4f provider")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=8, help="number of bench users (per-user caps apply)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--mock-ttft", type=float, default=0.3)
+    parser.add_argument("--mock-token-interval", type=float, default=0.02)
+    parser.add_argument("--mock-tokens", type=int, default=40)
+    parser.add_argument("--mock-completion-latency", type=float, default=0.4)
+    parser.add_argument("--mock-fail-rate", type=float, default=0.0)
+    parser.add_argument("--mock-midstream-fail-rate", type=float, default=0.0)
+    parser.add_argument("--mock-stall-rate", type=float, default=0.0)
+    parser.add_argument("--mock-jitter", type=float, default=0.2)
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression (0.15 = 15%%)")
+    parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+    return parser.parse_args(argv)
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in RUNNERS]
+    if unknown:
+        print(f"unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    app_module = load_app(args)
+    tokens = await prepare_users(app_module, max(1, args.users))
+    server, task = await start_server(app_module, args.port)
+    try:
+        report = await drive(f"http://127.0.0.1:{args.port}", tokens, scenarios, args.requests, args.concurrency)
+    finally:
+        server.should_exit = True
+        await task
+    report["config"] = {
+        key: value for key, value in vars(args).items()
+        if key.startswith("mock_") or key in ("requests", "concurrency", "users", "scenarios", "seed")
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    baseline_path = Path(args.baseline)
+    exit_code = 0
+    if args.compare:
+        if not baseline_path.exists():
+            print(f"baseline not found: {baseline_path}", file=sys.stderr)
+            return 2
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if baseline.get("config") != report["config"]:
+            print("warning: baseline was recorded with a different configuration", file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("REGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            exit_code = 1
+        else:
+            print("no regressions against baseline")
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"baseline saved to {baseline_path}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main_async(parse_args())))